@@ -0,0 +1,126 @@
+from typing import Callable, Dict
+
+MB: float = 1024 * 1024
+
+# The interval grows by this factor on every tick the metrics stay within the deadband, e.g. 1, 2, 4, 8... seconds.
+GROWTH: float = 2.0
+
+
+class Deadband:
+    '''
+    Tells whether a sample has moved away from a reference sample by more than the threshold of any metric:
+    CPU percentage points, MB of working set or private bytes, or handles.
+    '''
+
+    def __init__(self, cpu: float = 1.0, megabytes: float = 1.0, handles: float = 5) -> None:
+        self.thresholds: Dict[str, float] = {
+            "CPU": cpu,
+            "working_set": megabytes * MB,
+            "private_bytes": megabytes * MB,
+            "handles": handles
+        }
+        self.reference: Dict[str, float|int]|None = None
+
+    def exceeded(self, values: Dict[str, float|int]) -> bool:
+        if self.reference is None:
+            return True
+        reference: Dict[str, float|int] = self.reference
+        for metric, threshold in self.thresholds.items():
+            if abs(values[metric] - reference[metric]) > threshold:
+                return True
+        return False
+
+    def reset(self, values: Dict[str, float|int]) -> None:
+        '''
+        Makes "values" the reference that the following samples are compared with.
+        '''
+        self.reference = {metric: values[metric] for metric in self.thresholds}
+
+
+
+class AdaptiveInterval:
+    '''
+    Stretches the interval towards "ceiling" while the metrics stay within the deadband
+    and snaps it back to "base" as soon as one of them moves, e.g. on a CPU spike, memory growth or a handle jump.
+    '''
+
+    def __init__(self, base: float, ceiling: float, deadband: Deadband, growth: float = GROWTH) -> None:
+        if ceiling < base:
+            raise ValueError(f"Max interval ({ceiling}) is shorter than the interval ({base}). Please use a longer max interval.")
+        self.base: float = base
+        self.ceiling: float = ceiling
+        self.deadband: Deadband = deadband
+        self.growth: float = growth
+        self.interval: float = base
+        self.stretches: int = 0
+        self.snaps: int = 0
+
+    def next(self, values: Dict[str, float|int]) -> float:
+        '''
+        Returns the interval until the next sample, given the latest one.
+        '''
+
+        if self.deadband.exceeded(values):
+            self.deadband.reset(values)
+            if self.interval != self.base:
+                self.snaps += 1
+            self.interval = self.base
+        elif self.interval < self.ceiling:
+            self.interval = min(self.ceiling, self.interval * self.growth)
+            self.stretches += 1
+        return self.interval
+
+
+
+class ChangeFilter:
+    '''
+    Writes a sample through its "write" callable only if it has moved beyond the deadband since the last written one,
+    or if no sample has been written for "keyframe_interval" seconds.
+    The last sample that was held back is written right before a change and when the filter gets closed,
+    so the written rows show exactly until when the previous values lasted and when monitoring ended.
+    '''
+
+    def __init__(self, deadband: Deadband, keyframe_interval: float) -> None:
+        if keyframe_interval <= 0:
+            raise ValueError(f"Keyframe interval has a non-positive value: {keyframe_interval}. Please use a positive value.")
+        self.deadband: Deadband = deadband
+        self.keyframe_interval: float = keyframe_interval
+        self.last_written: float|None = None
+        self.held: Callable[[], None]|None = None
+        self.written: int = 0
+        self.suppressed: int = 0
+        self.closed: bool = False
+
+    def offer(self, elapsed: float, values: Dict[str, float|int], write: Callable[[], None], force: bool = False) -> bool:
+        '''
+        Offers a sample taken "elapsed" seconds after monitoring has started. "write" writes the sample when it's called,
+        which may be on a later call if the sample is held back, so it has to be bound to the sample, e.g. by functools.partial().
+        "force" writes the sample like a change, e.g. when an alert has put a marker on it.
+        Returns whether the sample has been written.
+        '''
+
+        keyframe: bool = self.last_written is None or elapsed - self.last_written >= self.keyframe_interval
+        changed: bool = force or self.deadband.exceeded(values)
+        if not keyframe and not changed:
+            self.held = write
+            self.suppressed += 1
+            return False
+        # Before a change the held sample shows until when the previous values lasted, while a keyframe makes it redundant.
+        if self.held is not None and changed:
+            self.held()
+            self.written += 1
+            self.suppressed -= 1
+        self.held = None
+        self.deadband.reset(values)
+        self.last_written = elapsed
+        write()
+        self.written += 1
+        return True
+
+    def close(self) -> None:
+        if self.held is not None:
+            self.held()
+            self.written += 1
+            self.suppressed -= 1
+            self.held = None
+        self.closed = True
@@ -0,0 +1,57 @@
+import unittest, functools
+from adaptive import AdaptiveInterval, ChangeFilter, Deadband, MB
+
+def values(cpu: float = 0.0, megabytes: float = 100.0, handles: int = 100) -> dict:
+    return {"CPU": cpu, "working_set": megabytes * MB, "private_bytes": megabytes * MB, "handles": handles}
+
+class TestAdaptive(unittest.TestCase):
+    def test_deadband(self):
+        deadband = Deadband(cpu=1.0, megabytes=1.0, handles=5)
+        self.assertTrue(deadband.exceeded(values()))
+        deadband.reset(values())
+        self.assertFalse(deadband.exceeded(values(cpu=0.9, megabytes=100.9, handles=105)))
+        self.assertTrue(deadband.exceeded(values(cpu=1.5)))
+        self.assertTrue(deadband.exceeded(values(megabytes=98.5)))
+        self.assertTrue(deadband.exceeded(values(handles=106)))
+
+
+
+    def test_interval_stretches_and_snaps_back(self):
+        adaptive = AdaptiveInterval(1.0, 10.0, Deadband())
+        intervals = [adaptive.next(values()) for _ in range(6)]
+        self.assertEqual(intervals, [1.0, 2.0, 4.0, 8.0, 10.0, 10.0])
+        self.assertEqual(adaptive.next(values(cpu=50)), 1.0)
+        self.assertEqual(adaptive.snaps, 1)
+        # Slow memory growth adds up against the reference until it leaves the deadband.
+        self.assertEqual(adaptive.next(values(cpu=50, megabytes=100.6)), 2.0)
+        self.assertEqual(adaptive.next(values(cpu=50, megabytes=101.2)), 1.0)
+        self.assertRaises(ValueError, AdaptiveInterval, 5.0, 1.0, Deadband())
+
+
+
+    def test_change_filter(self):
+        rows = []
+        change_filter = ChangeFilter(Deadband(), keyframe_interval=10.0)
+        for elapsed in range(25):
+            cpu = 50.0 if elapsed == 15 else 0.0
+            change_filter.offer(float(elapsed), values(cpu=cpu), functools.partial(rows.append, elapsed))
+        change_filter.close()
+        # The first sample, the keyframes after 10 s, the held sample before the spike and the spike,
+        # the sample after the spike and the last one, written on close.
+        self.assertEqual(rows, [0, 10, 14, 15, 16, 24])
+        self.assertEqual(change_filter.written, 6)
+        self.assertEqual(change_filter.suppressed, 19)
+
+
+
+    def test_change_filter_force(self):
+        rows = []
+        change_filter = ChangeFilter(Deadband(), keyframe_interval=60.0)
+        for elapsed in range(6):
+            change_filter.offer(float(elapsed), values(), functools.partial(rows.append, elapsed), force=elapsed == 3)
+        self.assertEqual(rows, [0, 2, 3])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
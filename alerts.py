@@ -0,0 +1,352 @@
+import configparser, datetime, math, operator, os, re, shlex, subprocess
+from collections import deque
+from typing import Callable, Deque, Dict, List, Tuple
+from csv_writer import BufferedCSVWriter
+from formatting import calculate_elapsed_time, format_timestamp
+
+ACTIONS: List[str] = ["log", "marker", "command", "boost"]
+
+# Metrics of the aggregated sample that rules can refer to. The byte metrics are compared in MB like in data.csv .
+METRICS: List[str] = ["CPU", "working_set", "private_bytes", "handles", "threads"]
+BYTE_METRICS: List[str] = ["working_set", "private_bytes"]
+MB: float = 1024 * 1024
+
+# A rolling window is split into this many buckets of partial sums, so its memory and update cost don't depend
+# on the number of samples in it. The window covers between (1 - 1 / WINDOW_BUCKETS) and 1 times its duration.
+WINDOW_BUCKETS: int = 64
+
+UNITS: Dict[str, float] = {"s": 1, "sec": 1, "second": 1, "seconds": 1, "min": 60, "minute": 60, "minutes": 60,
+                           "h": 3600, "hour": 3600, "hours": 3600, "d": 86400, "day": 86400, "days": 86400}
+OPERATORS: Dict[str, Callable[[float, float], bool]] = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+NUMBER: str = r"(?P<value>-?\d+(?:\.\d+)?)"
+COMPARISON: str = r"\s*(?P<op>>=|<=|>|<)\s*"
+DURATION: str = r"(?P<amount>\d+(?:\.\d+)?)\s*(?:consecutive\s+)?(?P<unit>[a-z]+)"
+# The forms of conditions, e.g. "CPU > 90% for 5 consecutive samples", "CPU > 90 for 2 min", "private_bytes slope > 5 MB/h over 30 min",
+# "handles growth > 20% over 10 min", "handles grew 20% in 10 min" (the same as ">=") and "working_set mean > 500 MB over 1 h".
+CONDITIONS: List[Tuple[str, str]] = [
+    ("slope", rf"^(?P<metric>\w+)\s+slope{COMPARISON}{NUMBER}\s*(?:MB)?\s*/\s*h\s+over\s+{DURATION}$"),
+    ("growth", rf"^(?P<metric>\w+)\s+(?:growth{COMPARISON}|grew\s+(?:by\s+)?){NUMBER}\s*%\s+(?:over|in)\s+{DURATION}$"),
+    ("mean", rf"^(?P<metric>\w+)\s+mean{COMPARISON}{NUMBER}\s*(?:MB|%)?\s+over\s+{DURATION}$"),
+    ("value", rf"^(?P<metric>\w+){COMPARISON}{NUMBER}\s*(?:MB|%)?(?:\s+for\s+{DURATION})?$")
+]
+
+
+class RollingWindow:
+    '''
+    Keeps the count, sums and first value of the samples of the last "duration" seconds in time buckets,
+    which gives the mean, the least squares slope and the growth of the window in constant time and memory.
+    The times are relative to an origin that moves along with the window, so the sums stay small however long the run is.
+    '''
+
+    def __init__(self, duration: float, buckets: int = WINDOW_BUCKETS) -> None:
+        self.duration: float = duration
+        self.buckets: int = buckets
+        self.width: float = duration / buckets
+        self.start: float|None = None
+        self.origin: float = 0.0
+        # Every bucket is [index, n, sx, sy, sxx, sxy, first time, first value].
+        self.window: Deque[List[float]] = deque()
+        self.n: float = 0
+        self.sx: float = 0.0
+        self.sy: float = 0.0
+        self.sxx: float = 0.0
+        self.sxy: float = 0.0
+        self.last_time: float = 0.0
+        self.last_value: float = 0.0
+        self.full: bool = False
+
+    def add(self, time: float, value: float) -> None:
+        if self.start is None:
+            self.start = self.origin = time
+        index: int = int((time - self.start) // self.width)
+        if not self.window or self.window[-1][0] != index:
+            self.window.append([index, 0, 0.0, 0.0, 0.0, 0.0, time, value])
+        x: float = time - self.origin
+        bucket: List[float] = self.window[-1]
+        bucket[1] += 1
+        bucket[2] += x
+        bucket[3] += value
+        bucket[4] += x * x
+        bucket[5] += x * value
+        self.n += 1
+        self.sx += x
+        self.sy += value
+        self.sxx += x * x
+        self.sxy += x * value
+        self.last_time, self.last_value = time, value
+        while self.window[0][0] <= index - self.buckets:
+            # Once samples older than the window are dropped, the window is covered and the statistics are
+            # no longer based on the first few samples only. It stays covered from then on, so a rule doesn't flicker.
+            self.full = True
+            _, n, sx, sy, sxx, sxy, _, _ = self.window.popleft()
+            self.n -= n
+            self.sx -= sx
+            self.sy -= sy
+            self.sxx -= sxx
+            self.sxy -= sxy
+        if time - self.origin > 4 * self.duration:
+            self._rebase()
+
+    def _rebase(self) -> None:
+        '''
+        Moves the origin to the first sample of the window and recomputes the sums from the buckets,
+        which also drops the rounding errors of the subtractions. This takes O(buckets) once every few windows.
+        '''
+
+        shift: float = self.window[0][6] - self.origin
+        self.origin += shift
+        self.n = self.sx = self.sy = self.sxx = self.sxy = 0
+        for bucket in self.window:
+            _, n, sx, sy, sxx, sxy, _, _ = bucket
+            bucket[2] = sx - n * shift
+            bucket[4] = sxx - 2 * shift * sx + n * shift * shift
+            bucket[5] = sxy - shift * sy
+            self.n += n
+            self.sx += bucket[2]
+            self.sy += sy
+            self.sxx += bucket[4]
+            self.sxy += bucket[5]
+
+    def mean(self) -> float:
+        return self.sy / self.n
+
+    def slope(self) -> float:
+        '''
+        Returns the least squares slope per second.
+        '''
+
+        denominator: float = self.n * self.sxx - self.sx * self.sx
+        return (self.n * self.sxy - self.sx * self.sy) / denominator if denominator > 0 else 0.0
+
+    def growth(self) -> float:
+        '''
+        Returns the growth from the first value of the window to the latest one in percent.
+        '''
+
+        first: float = self.window[0][7]
+        if first <= 0:
+            return math.inf if self.last_value > 0 else 0.0
+        return (self.last_value - first) / first * 100
+
+
+
+class Rule:
+    '''
+    A named condition on one metric of the aggregated sample and the actions to take when it becomes true.
+    Every sample is evaluated in constant time: consecutive samples and durations are counted,
+    while slopes, growths and means come from a RollingWindow.
+    '''
+
+    def __init__(self, name: str, condition: str, actions: List[str], command: str|None = None,
+                 boost_interval: float|None = None, boost_duration: float = 60.0, cooldown: float|None = None) -> None:
+        self.name: str = name
+        self.condition: str = " ".join(condition.split())
+        for kind, pattern in CONDITIONS:
+            match = re.match(pattern, self.condition, re.I)
+            if match:
+                break
+        else:
+            raise ValueError(f'Alert "{name}" has an invalid condition: "{condition}". '
+                             'Please use e.g. "CPU > 90 for 5 samples", "private_bytes slope > 5 MB/h over 30 min", '
+                             '"handles growth > 20% over 10 min" or "working_set mean > 500 MB over 1 h".')
+        metrics: Dict[str, str] = {metric.lower(): metric for metric in METRICS}
+        if match["metric"].lower() not in metrics:
+            raise ValueError(f'Alert "{name}" refers to an unknown metric: "{match["metric"]}". Please use one of: {", ".join(METRICS)}.')
+        self.kind: str = kind
+        self.metric: str = metrics[match["metric"].lower()]
+        self.scale: float = MB if self.metric in BYTE_METRICS else 1
+        self.compare: Callable[[float, float], bool] = OPERATORS[match["op"] or ">="]
+        self.threshold: float = float(match["value"])
+        # "for 5 samples" counts consecutive samples, "for 5 min" measures how long the condition has held.
+        self.samples: int = 1
+        self.duration: float = 0.0
+        if match["unit"] is not None:
+            unit: str = match["unit"].lower()
+            if kind == "value" and unit in ("sample", "samples"):
+                self.samples = max(1, int(float(match["amount"])))
+            elif unit in UNITS:
+                self.duration = float(match["amount"]) * UNITS[unit]
+            else:
+                raise ValueError(f'Alert "{name}" has an unknown unit: "{match["unit"]}". Please use samples, s, min, h or d.')
+        if kind != "value" and self.duration <= 0:
+            raise ValueError(f'Alert "{name}" needs a positive window duration.')
+        self.window: RollingWindow|None = RollingWindow(self.duration) if kind != "value" else None
+
+        for action in actions:
+            if action not in ACTIONS:
+                raise ValueError(f'Alert "{name}" has an unknown action: "{action}". Please use some of: {", ".join(ACTIONS)}.')
+        if "command" in actions and not command:
+            raise ValueError(f'Alert "{name}" uses the command action, but has no command. Please add "command = ..." to it.')
+        if boost_interval is not None and boost_interval <= 0:
+            raise ValueError(f'Alert "{name}" has a non-positive boost interval: {boost_interval}. Please use a positive value.')
+        self.actions: List[str] = actions
+        self.command: str|None = command
+        self.boost_interval: float|None = boost_interval
+        self.boost_duration: float = boost_duration
+        self.cooldown: float|None = cooldown
+
+        self.consecutive: int = 0
+        self.since: float|None = None
+        self.active: bool = False
+        self.last_fired: float|None = None
+        self.observed: float = math.nan
+        self.fired: int = 0
+
+    def _holds(self, elapsed: float, value: float) -> bool:
+        if self.window is None:
+            self.observed = value
+            if not self.compare(value, self.threshold):
+                self.consecutive, self.since = 0, None
+                return False
+            self.consecutive += 1
+            if self.since is None:
+                self.since = elapsed
+            return self.consecutive >= self.samples and elapsed - self.since >= self.duration
+        self.window.add(elapsed, value)
+        if not self.window.full:
+            return False
+        if self.kind == "slope":
+            self.observed = self.window.slope() * 3600
+        elif self.kind == "growth":
+            self.observed = self.window.growth()
+        else:
+            self.observed = self.window.mean()
+        return self.compare(self.observed, self.threshold)
+
+    def evaluate(self, elapsed: float, values: Dict[str, float|int]) -> bool:
+        '''
+        Adds the latest sample and tells whether the rule fires: when its condition becomes true,
+        and again every "cooldown" seconds as long as it stays true, if a cooldown is set.
+        '''
+
+        holds: bool = self._holds(elapsed, values[self.metric] / self.scale)
+        fires: bool = holds and (not self.active or (self.cooldown is not None and elapsed - self.last_fired >= self.cooldown))
+        self.active = holds
+        if fires:
+            self.last_fired = elapsed
+            self.fired += 1
+        return fires
+
+
+
+def _number(name: str, options: configparser.SectionProxy, key: str, default: float|None = None) -> float|None:
+    if key not in options:
+        return default
+    try:
+        return float(options[key])
+    except ValueError:
+        raise ValueError(f'Alert "{name}" has an invalid {key}: "{options[key]}". Please use a number.')
+
+
+
+def load_rules(paths: List[str]) -> List[Rule]:
+    '''
+    Reads the "[alert <name>]" sections of the given .ini files, e.g. settings.ini and a rules file:
+
+    [alert private bytes leak]
+    condition = private_bytes slope > 5 MB/h over 30 min
+    actions = log, marker, command
+    command = notify.exe "leak"
+    '''
+
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(paths)
+    rules: List[Rule] = []
+    for section in parser.sections():
+        if not section.lower().startswith("alert "):
+            continue
+        options = parser[section]
+        name: str = section[6:].strip()
+        if "condition" not in options:
+            raise ValueError(f'Alert "{name}" has no condition. Please add "condition = ..." to it.')
+        rules.append(Rule(name, options["condition"],
+                          [action.strip().lower() for action in options.get("actions", "log").split(",") if action.strip()],
+                          command=options.get("command"),
+                          boost_interval=_number(name, options, "boost_interval"),
+                          boost_duration=_number(name, options, "boost_duration", 60.0),
+                          cooldown=_number(name, options, "cooldown")))
+    return rules
+
+
+
+class AlertEngine:
+    '''
+    Evaluates the rules on every aggregated sample and takes the actions of the rules that fire:
+    "log" appends a line to alerts.log, "marker" writes a row with the time columns of data.csv to alerts.csv,
+    "command" starts a local command without waiting for it, with the alert in PMT_* environment variables,
+    and "boost" samples every "boost_interval" seconds (a tenth of the interval by default) for "boost_duration" seconds.
+    '''
+
+    def __init__(self, rules: List[Rule], directory: str, interval: float) -> None:
+        self.rules: List[Rule] = rules
+        self.log_path: str = os.path.join(directory, "alerts.log")
+        self.markers_path: str = os.path.join(directory, "alerts.csv")
+        self.markers: BufferedCSVWriter|None = None
+        self.interval: float = interval
+        self.boost_until: float = -math.inf
+        self.boost_interval: float = interval
+        self.commands: List[subprocess.Popen] = []
+        self.fired: int = 0
+        self.closed: bool = False
+
+    def evaluate(self, elapsed: float, now: datetime.datetime, values: Dict[str, float|int]) -> bool:
+        '''
+        Evaluates every rule on the latest sample. Returns whether a marker was written,
+        in which case the sample itself should be written to data.csv too.
+        '''
+
+        marked: bool = False
+        for rule in self.rules:
+            if rule.evaluate(elapsed, values):
+                marked |= self.fire(rule, elapsed, now)
+        return marked
+
+    def fire(self, rule: Rule, elapsed: float, now: datetime.datetime) -> bool:
+        self.fired += 1
+        timestamp: Dict[str, str] = {"elapsed_time": calculate_elapsed_time(elapsed), **format_timestamp(now)}
+        value: str = f"{rule.observed:.4g}"
+        if "log" in rule.actions:
+            self.log(f'{timestamp["date"]} {timestamp["time"]} ({timestamp["elapsed_time"]}) {rule.name}: {rule.condition} (observed {value})')
+        if "marker" in rule.actions:
+            if self.markers is None:
+                self.markers = BufferedCSVWriter(self.markers_path, ["elapsed_time", "date", "time", "alert", "condition", "observed"], flush_rows=1)
+            self.markers.write({**timestamp, "alert": rule.name, "condition": rule.condition, "observed": value})
+        if "command" in rule.actions:
+            self._reap()
+            environment: Dict[str, str] = {**os.environ, "PMT_ALERT": rule.name, "PMT_CONDITION": rule.condition,
+                                           "PMT_OBSERVED": value, "PMT_ELAPSED": f"{elapsed:.3f}"}
+            try:
+                arguments: str|List[str] = rule.command if os.name == "nt" else shlex.split(rule.command)
+                self.commands.append(subprocess.Popen(arguments, env=environment, stdin=subprocess.DEVNULL))
+            except (OSError, ValueError) as e:
+                self.log(f'{timestamp["date"]} {timestamp["time"]} {rule.name}: the command "{rule.command}" could not be started: {e}')
+        if "boost" in rule.actions:
+            self.boost_interval = rule.boost_interval or self.interval / 10
+            self.boost_until = elapsed + rule.boost_duration
+        return "marker" in rule.actions
+
+    def log(self, line: str) -> None:
+        # Alerts are rare, so the log is only opened when there is something to write.
+        with open(self.log_path, "a", encoding="utf-8") as file:
+            file.write(line + "\n")
+
+    def next_interval(self, elapsed: float, interval: float) -> float:
+        '''
+        Returns the interval to use after the sample taken at "elapsed", given the one that would be used otherwise.
+        '''
+        return min(interval, self.boost_interval) if elapsed < self.boost_until else interval
+
+    def _reap(self) -> None:
+        '''
+        Collects the exit status of the finished commands, so they don't linger as zombie processes.
+        '''
+        self.commands = [command for command in self.commands if command.poll() is None]
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._reap()
+        if self.markers is not None:
+            self.markers.close()
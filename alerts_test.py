@@ -0,0 +1,138 @@
+import unittest, datetime, os, sys, tempfile, time
+from alerts import AlertEngine, RollingWindow, Rule, load_rules, MB
+
+NOW = datetime.datetime(2024, 5, 1, 12, 0, 0)
+
+def values(cpu: float = 0.0, megabytes: float = 100.0, handles: int = 100) -> dict:
+    return {"CPU": cpu, "working_set": megabytes * MB, "private_bytes": megabytes * MB, "handles": handles, "threads": 10}
+
+class TestAlerts(unittest.TestCase):
+    def test_rolling_window(self):
+        window = RollingWindow(60.0, buckets=6)
+        for second in range(1000):
+            window.add(float(second), 3.0 + 2.0 * second)
+        # Only the buckets of the last minute are kept, whatever the length of the run.
+        self.assertLessEqual(len(window.window), 7)
+        self.assertTrue(window.full)
+        self.assertAlmostEqual(window.slope(), 2.0)
+        # The window holds the buckets from 940 s on, i.e. the values 1883 to 2001.
+        self.assertEqual(window.n, 60)
+        self.assertAlmostEqual(window.mean(), 1942.0)
+        self.assertAlmostEqual(window.growth(), (2001 - 1883) / 1883 * 100)
+
+
+
+    def test_invalid_rules(self):
+        self.assertRaises(ValueError, Rule, "a", "CPU is high", ["log"])
+        self.assertRaises(ValueError, Rule, "a", "memory > 90", ["log"])
+        self.assertRaises(ValueError, Rule, "a", "CPU > 90 for 5 fortnights", ["log"])
+        self.assertRaises(ValueError, Rule, "a", "CPU > 90", ["page"])
+        self.assertRaises(ValueError, Rule, "a", "CPU > 90", ["command"])
+        self.assertRaises(ValueError, Rule, "a", "CPU > 90", ["boost"], boost_interval=0)
+
+
+
+    def test_consecutive_samples(self):
+        rule = Rule("cpu", "CPU > 90% for 3 consecutive samples", ["log"])
+        cpu = [95, 95, 50, 95, 95, 95, 95, 95, 10, 95, 95, 95]
+        fired = [second for second, value in enumerate(cpu) if rule.evaluate(float(second), values(cpu=value))]
+        # Fires once every time the condition becomes true, not on every sample it stays true.
+        self.assertEqual(fired, [5, 11])
+        self.assertEqual(rule.fired, 2)
+
+
+
+    def test_duration_and_cooldown(self):
+        rule = Rule("cpu", "CPU > 90 for 10 s", ["log"], cooldown=30)
+        fired = [second for second in range(100) if rule.evaluate(float(second), values(cpu=95))]
+        self.assertEqual(fired, [10, 40, 70])
+
+
+
+    def test_slope(self):
+        rule = Rule("leak", "private_bytes slope > 5 MB/h over 30 min", ["log"])
+        fired = [second for second in range(0, 7200, 5) if rule.evaluate(float(second), values(megabytes=100 + second / 3600 * 6))]
+        # The window has to be covered before the slope is judged, and the rule stays active from then on.
+        self.assertEqual(len(fired), 1)
+        self.assertGreaterEqual(fired[0], 1800 - 1800 / 64)
+        self.assertAlmostEqual(rule.observed, 6.0)
+        flat = Rule("leak", "private_bytes slope > 5 MB/h over 30 min", ["log"])
+        self.assertFalse(any(flat.evaluate(float(second), values()) for second in range(0, 7200, 5)))
+
+
+
+    def test_growth_and_mean(self):
+        rule = Rule("handles", "handles grew 20% in 10 min", ["log"])
+        handles = lambda second: 100 + (second - 1000) // 10 if second > 1000 else 100
+        fired = [second for second in range(0, 3000, 5) if rule.evaluate(float(second), values(handles=handles(second)))]
+        self.assertEqual(len(fired), 1)
+        self.assertTrue(1000 < fired[0] < 1300)
+        rule = Rule("memory", "working_set mean > 150 MB over 1 min", ["log"])
+        self.assertEqual([second for second in range(200) if rule.evaluate(float(second), values(megabytes=200 if second >= 100 else 100))], [130])
+
+
+
+    def test_load_rules(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rules.ini")
+            with open(path, "w") as file:
+                file.write("[myvars]\nset_path = \n\n"
+                           "[alert leak]\ncondition = private_bytes slope > 5 MB/h over 30 min\nactions = log, marker, boost\nboost_interval = 0.5\n\n"
+                           "[alert handles]\ncondition = handles growth > 20% over 10 min\n")
+            rules = load_rules([path])
+            self.assertEqual([rule.name for rule in rules], ["leak", "handles"])
+            self.assertEqual(rules[0].actions, ["log", "marker", "boost"])
+            self.assertEqual(rules[0].boost_interval, 0.5)
+            self.assertEqual(rules[1].actions, ["log"])
+            with open(path, "a") as file:
+                file.write("\n[alert broken]\nactions = log\n")
+            self.assertRaises(ValueError, load_rules, [path])
+
+
+
+    def test_engine_actions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "command.txt")
+            command = f'"{sys.executable}" -c "import os; open(os.environ[\'PMT_OUTPUT\'], \'w\').write(os.environ[\'PMT_ALERT\'])"'
+            os.environ["PMT_OUTPUT"] = output
+            rules = [Rule("hot", "CPU > 90", ["log", "marker", "command", "boost"], command=command, boost_duration=5),
+                     Rule("quiet", "CPU < 0", ["log"])]
+            engine = AlertEngine(rules, directory, interval=1.0)
+            self.assertFalse(engine.evaluate(0.0, NOW, values(cpu=10)))
+            self.assertEqual(engine.next_interval(0.0, 1.0), 1.0)
+            self.assertTrue(engine.evaluate(1.0, NOW, values(cpu=95)))
+            self.assertEqual(engine.next_interval(1.0, 1.0), 0.1)
+            self.assertEqual(engine.next_interval(6.0, 1.0), 1.0)
+            for command in engine.commands:
+                command.wait(30)
+            engine.close()
+            del os.environ["PMT_OUTPUT"]
+            self.assertEqual(engine.fired, 1)
+            with open(os.path.join(directory, "alerts.log")) as file:
+                self.assertIn("hot: CPU > 90 (observed 95)", file.read())
+            with open(os.path.join(directory, "alerts.csv")) as file:
+                lines = file.read().splitlines()
+            self.assertEqual(lines[0], "elapsed_time,date,time,alert,condition,observed")
+            self.assertIn(",hot,CPU > 90,95", lines[1])
+            with open(output) as file:
+                self.assertEqual(file.read(), "hot")
+
+
+
+    def test_evaluation_cost_is_constant(self):
+        rule = Rule("leak", "private_bytes slope > 5 MB/h over 10 min", ["log"])
+        costs = []
+        second = 0
+        for _ in range(3):
+            started = time.perf_counter()
+            for _ in range(20000):
+                rule.evaluate(float(second), values())
+                second += 1
+            costs.append(time.perf_counter() - started)
+        self.assertLess(max(len(rule.window.window), 0), 66)
+        self.assertLess(costs[-1], costs[0] * 3)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,393 @@
+import argparse, asyncio, datetime, io, json, os, platform, shutil, subprocess, sys, tempfile, time, psutil
+from typing import Callable, Dict, List, Tuple
+from scheduler import TickScheduler
+from csv_writer import BufferedCSVWriter
+from process_tree import ProcessSet, aggregate
+from samplers import create_sampler, PsutilSampler, ProcSampler
+from shards import create_shards, ProcessShards, ThreadShards, WORKER_MODES
+from formatting import calculate_elapsed_time, format_timestamp, format_sample
+from sample_store import SampleStore
+from dashboard import Dashboard
+
+# The benchmarks that can be run, in the order they are run.
+BENCHMARKS: List[str] = ["stages", "throughput", "jitter", "scaling"]
+
+# The stages of a tick, in the order write_stats() runs them.
+STAGES: List[str] = ["sample", "aggregate", "binary_write", "gui", "format", "csv_write"]
+
+TITLES: List[str] = ["elapsed_time", "date", "time", "CPU", "working_set", "private_bytes", "handles", "skipped_ticks"]
+
+# Version of the layout of the results, so results of different versions of this script are not compared by mistake.
+RESULTS_VERSION: int = 3
+
+
+class MockSampler:
+    '''
+    A sampler that returns fixed values without any system call,
+    so the benchmarks can tell the cost of the monitor itself apart from the cost of reading the process data.
+    '''
+
+    name: str = "mock"
+
+    def __init__(self, cpu_count: int = 1) -> None:
+        self.cpu_count: int = cpu_count
+        self.ticks: int = 0
+
+    def track(self, process: psutil.Process) -> None:
+        pass
+
+    def forget(self, pid: int) -> None:
+        pass
+
+    def sample(self, process: psutil.Process) -> Dict[str, str|float|int]:
+        self.ticks += 1
+        return {
+            "pid": process.pid,
+            "name": "mock",
+            "CPU": (self.ticks % 1000) / 10,
+            "working_set": 100 * 1024 * 1024 + self.ticks,
+            "private_bytes": 50 * 1024 * 1024 + self.ticks,
+            "handles": 100 + self.ticks % 50,
+            "threads": 4
+        }
+
+    def close(self) -> None:
+        pass
+
+
+
+def make_sampler(kind: str, mode: str|None = None, workers: int = 1) -> MockSampler|PsutilSampler|ProcSampler|ThreadShards|ProcessShards:
+    cpu_count: int = psutil.cpu_count() or 1
+    if kind == "mock":
+        return MockSampler(cpu_count)
+    return create_sampler(kind, cpu_count) if mode is None else create_shards(mode, kind, cpu_count, workers=workers)
+
+
+
+def spawn_children(count: int) -> List[subprocess.Popen]:
+    '''
+    Starts "count" idle child processes to be monitored. The sleep command is used where it exists,
+    since it takes a fraction of the memory of a Python interpreter.
+    '''
+
+    sleep: str|None = shutil.which("sleep")
+    command: List[str] = [sleep, "3600"] if sleep else [sys.executable, "-c", "import time; time.sleep(3600)"]
+    return [subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL) for _ in range(count)]
+
+
+
+def stop_children(children: List[subprocess.Popen]) -> None:
+    for child in children:
+        child.kill()
+    for child in children:
+        child.wait()
+
+
+
+def distribution(values: List[float]) -> Dict[str, float|None]:
+    '''
+    Returns the mean, p50, p99 and max of durations in seconds, in microseconds.
+    '''
+
+    if not values:
+        return {"mean_us": None, "p50_us": None, "p99_us": None, "max_us": None}
+    ordered: List[float] = sorted(values)
+    def percentile(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "mean_us": round(sum(ordered) / len(ordered) * 1e6, 3),
+        "p50_us": round(percentile(0.5) * 1e6, 3),
+        "p99_us": round(percentile(0.99) * 1e6, 3),
+        "max_us": round(ordered[-1] * 1e6, 3)
+    }
+
+
+
+class TickPipeline:
+    '''
+    Runs the work of a single tick of write_stats() without waiting for the scheduler:
+    sampling, aggregating, writing data.bin, handing the sample over to the cli GUI (whose render thread is not started),
+    formatting and writing data.csv, to files in a temporary directory.
+    '''
+
+    def __init__(self, pids: List[int], sampler: str, directory: str, mode: str|None = None, workers: int = 1) -> None:
+        self.processes = ProcessSet(pids, sampler=make_sampler(sampler, mode, workers))
+        self.csv_writer = BufferedCSVWriter(os.path.join(directory, "data.csv"), TITLES)
+        self.sample_store = SampleStore(os.path.join(directory, "data.bin"), start_time=time.time(), interval=1.0)
+        self.dashboard = Dashboard(stream=io.StringIO())
+        self.ticks: int = 0
+
+    def tick(self, timings: Dict[str, List[float]]|None = None) -> None:
+        clock: Callable[[], float] = time.perf_counter
+        started: float = clock()
+        samples = self.processes.sample()
+        sampled: float = clock()
+        total = aggregate(samples)
+        aggregated: float = clock()
+        elapsed: float = self.ticks * 0.5
+        now = datetime.datetime.now()
+        self.sample_store.write((elapsed, total["CPU"], total["working_set"], total["private_bytes"], total["handles"], 0))
+        stored: float = clock()
+        self.dashboard.update(elapsed, now, total)
+        shown: float = clock()
+        row: Dict[str, str|float|int] = {"elapsed_time": calculate_elapsed_time(elapsed), **format_timestamp(now),
+                                         **format_sample(total), "skipped_ticks": 0}
+        formatted: float = clock()
+        self.csv_writer.write(row)
+        written: float = clock()
+        self.ticks += 1
+        if timings is not None:
+            for stage, duration in zip(STAGES, (sampled - started, aggregated - sampled, stored - aggregated,
+                                                shown - stored, formatted - shown, written - formatted)):
+                timings[stage].append(duration)
+
+    def warm_up(self) -> None:
+        '''
+        Runs a tick that isn't measured, which starts the worker processes of a sharded sampler, and waits for them to be ready.
+        '''
+
+        self.tick()
+        if isinstance(self.processes.sampler, ProcessShards):
+            self.processes.sampler.wait(60)
+        self.tick()
+
+    def close(self) -> None:
+        self.processes.close()
+        self.csv_writer.close()
+        self.sample_store.close()
+
+
+
+def bench_stages(pids: List[int], samplers: List[str], ticks: int) -> Dict[str, object]:
+    '''
+    Measures the latency of every stage of a tick.
+    '''
+
+    results: Dict[str, object] = {}
+    for sampler in samplers:
+        with tempfile.TemporaryDirectory() as directory:
+            pipeline = TickPipeline(pids, sampler, directory)
+            timings: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+            for _ in range(ticks):
+                pipeline.tick(timings)
+            pipeline.close()
+        totals: List[float] = [sum(durations) for durations in zip(*timings.values())]
+        results[sampler] = {**{stage: distribution(timings[stage]) for stage in STAGES}, "tick": distribution(totals)}
+    return results
+
+
+
+def bench_throughput(pids: List[int], samplers: List[str], seconds: float) -> Dict[str, object]:
+    '''
+    Measures how many ticks per second can be run back to back, which is the upper bound of the sampling rate.
+    '''
+
+    results: Dict[str, object] = {}
+    for sampler in samplers:
+        with tempfile.TemporaryDirectory() as directory:
+            pipeline = TickPipeline(pids, sampler, directory)
+            ticks: int = 0
+            started: float = time.perf_counter()
+            while time.perf_counter() - started < seconds:
+                pipeline.tick()
+                ticks += 1
+            duration: float = time.perf_counter() - started
+            pipeline.close()
+        results[sampler] = {"ticks": ticks, "ticks_per_second": round(ticks / duration, 1)}
+    return results
+
+
+
+async def _measure_jitter(pipeline: TickPipeline, interval: float, ticks: int) -> Dict[str, object]:
+    scheduler = TickScheduler(interval)
+    lateness: List[float] = []
+    for _ in range(ticks):
+        tick = await scheduler.wait()
+        lateness.append(tick.lateness)
+        pipeline.tick()
+    return {"ticks": scheduler.ticks, "late_ticks": scheduler.late_ticks, "skipped_ticks": scheduler.skipped_ticks,
+            "lateness": distribution(lateness)}
+
+
+
+def bench_jitter(pids: List[int], sampler: str, intervals: List[float], seconds: float) -> Dict[str, object]:
+    '''
+    Measures how late the ticks of the scheduler fire at each interval while a real tick runs between them.
+    Every interval runs for about "seconds", but at least 5 ticks.
+    '''
+
+    results: Dict[str, object] = {}
+    for interval in intervals:
+        with tempfile.TemporaryDirectory() as directory:
+            pipeline = TickPipeline(pids, sampler, directory)
+            ticks: int = max(5, int(seconds / interval))
+            results[str(interval)] = asyncio.run(_measure_jitter(pipeline, interval, ticks))
+            pipeline.close()
+    return results
+
+
+
+def bench_scaling(counts: List[int], samplers: List[str], ticks: int, workers: int) -> Dict[str, object]:
+    '''
+    Measures the latency of a tick with a growing number of monitored child processes, sampled one after another by every sampler
+    and sharded across up to "workers" threads and processes by the last sampler. The runs with thousands of processes
+    measure fewer ticks, about as many samples as "ticks" ticks of 100 processes, but at least 10 ticks.
+    '''
+
+    results: Dict[str, object] = {}
+    runs: List[Tuple[str, str, str|None]] = [(sampler, sampler, None) for sampler in samplers] + \
+                                            [(f"{samplers[-1]}_{mode}", samplers[-1], mode) for mode in WORKER_MODES]
+    children: List[subprocess.Popen] = spawn_children(max(counts))
+    try:
+        for count in counts:
+            pids: List[int] = [child.pid for child in children[:count]]
+            measured: int = min(ticks, max(10, ticks * 100 // count))
+            results[str(count)] = {}
+            for name, sampler, mode in runs:
+                with tempfile.TemporaryDirectory() as directory:
+                    pipeline = TickPipeline(pids, sampler, directory, mode, workers)
+                    pipeline.warm_up()
+                    timings: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+                    for _ in range(measured):
+                        pipeline.tick(timings)
+                    pipeline.close()
+                tick: Dict[str, float] = distribution([sum(durations) for durations in zip(*timings.values())])
+                results[str(count)][name] = {**tick, "per_pid_us": round(tick["mean_us"] / count, 3)}
+    finally:
+        stop_children(children)
+    return results
+
+
+
+def environment() -> Dict[str, object]:
+    '''
+    Describes the machine and the version of the code the results belong to.
+    '''
+
+    try:
+        commit: str = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                     capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "results_version": RESULTS_VERSION,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "psutil": psutil.__version__,
+        "cpu_count": psutil.cpu_count() or 1
+    }
+
+
+
+def run_benchmarks(args: argparse.Namespace) -> Dict[str, object]:
+    samplers: List[str] = ["mock", "psutil"] + (["proc"] if sys.platform.startswith("linux") else [])
+    results: Dict[str, object] = {"environment": environment()}
+    children: List[subprocess.Popen] = spawn_children(1)
+    try:
+        pids: List[int] = [children[0].pid]
+        if "stages" in args.benchmarks:
+            results["stages"] = bench_stages(pids, samplers, args.ticks)
+        if "throughput" in args.benchmarks:
+            results["throughput"] = bench_throughput(pids, samplers, args.seconds)
+        if "jitter" in args.benchmarks:
+            results["jitter"] = bench_jitter(pids, samplers[-1], args.intervals, args.seconds)
+    finally:
+        stop_children(children)
+    if "scaling" in args.benchmarks:
+        results["scaling"] = bench_scaling(args.pids, samplers[1:], args.ticks, args.workers)
+    return results
+
+
+
+def flatten(results: Dict[str, object], prefix: str = "") -> Dict[str, float]:
+    '''
+    Flattens the numeric results to "benchmark.sampler.stage.value" keys.
+    '''
+
+    values: Dict[str, float] = {}
+    for key, value in results.items():
+        name: str = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+
+def compare(baseline: Dict[str, object], results: Dict[str, object], threshold: float) -> List[str]:
+    '''
+    Returns a line for every result that got worse than the baseline by more than "threshold" percent.
+    Rates are better when higher, while durations and late or skipped ticks are better when lower.
+    '''
+
+    old: Dict[str, float] = flatten({key: value for key, value in baseline.items() if key != "environment"})
+    new: Dict[str, float] = flatten({key: value for key, value in results.items() if key != "environment"})
+    regressions: List[str] = []
+    for name in sorted(old.keys() & new.keys()):
+        if name.endswith(".ticks") or not old[name]:
+            continue
+        change: float = (new[name] - old[name]) / old[name] * 100
+        worse: float = -change if name.endswith("per_second") else change
+        if worse > threshold:
+            regressions.append(f"{name}: {old[name]} -> {new[name]} ({change:+.1f}%)")
+    return regressions
+
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmarks of the cost of monitoring: stage latency, throughput, jitter and scaling",
+                                     epilog="example: python benchmark.py -o results.json --compare baseline.json")
+    parser.add_argument("benchmarks", type=str, nargs="*", metavar="benchmark",
+                        help=f'benchmarks to run, out of: {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument("-o", "--output", type=str, metavar=" ", help="path of the JSON file the results are written to (default: stdout)")
+    parser.add_argument("--ticks", type=int, default=1000, metavar=" ", help="ticks measured per stage and scaling run (default: 1000)")
+    parser.add_argument("--seconds", type=float, default=2.0, metavar=" ",
+                        help="duration of every throughput run and of every jitter interval (default: 2)")
+    parser.add_argument("--intervals", type=float, nargs="+", default=[0.01, 0.05, 0.1, 0.5, 1.0], metavar=" ",
+                        help="intervals of the jitter benchmark in seconds (default: 0.01 0.05 0.1 0.5 1)")
+    parser.add_argument("--pids", type=int, nargs="+", default=[10, 100, 1000, 5000], metavar=" ",
+                        help="numbers of monitored child processes of the scaling benchmark (default: 10 100 1000 5000)")
+    parser.add_argument("--workers", type=int, default=max(2, psutil.cpu_count() or 1), metavar=" ",
+                        help="workers of the sharded runs of the scaling benchmark (default: the number of CPUs, at least 2)")
+    parser.add_argument("--compare", type=str, metavar=" ", help="JSON results of an earlier run to report regressions against")
+    parser.add_argument("--threshold", type=float, default=10.0, metavar=" ",
+                        help="change in percent that --compare reports as a regression (default: 10)")
+    args = parser.parse_args(argv)
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error(f'Unknown benchmark: "{benchmark}". Please use one of: {", ".join(BENCHMARKS)}.')
+    args.benchmarks = args.benchmarks or BENCHMARKS
+    if args.ticks <= 0 or args.seconds <= 0 or min(args.intervals) <= 0 or min(args.pids) <= 0 or args.workers <= 0:
+        parser.error("--ticks, --seconds, --intervals, --pids and --workers need positive values.")
+    if args.compare is not None and not os.path.isfile(args.compare):
+        parser.error(f'"{args.compare}" file path does not exist. Please use an appropriate path.')
+    return args
+
+
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+    results: Dict[str, object] = run_benchmarks(args)
+    text: str = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline: Dict[str, object] = json.load(file)
+        regressions: List[str] = compare(baseline, results, args.threshold)
+        print(f"{len(regressions)} regression(s) of more than {args.threshold}% against {args.compare}", file=sys.stderr)
+        for line in regressions:
+            print("  " + line, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,71 @@
+import unittest, os, tempfile, json, io, contextlib
+import benchmark
+from benchmark import TickPipeline, STAGES, bench_stages, compare, parse_args, spawn_children, stop_children
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.children = spawn_children(2)
+        self.pids = [child.pid for child in self.children]
+
+    def tearDown(self):
+        stop_children(self.children)
+
+
+
+    def test_pipeline_writes_every_tick(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pipeline = TickPipeline(self.pids, "mock", directory)
+            timings = {stage: [] for stage in STAGES}
+            for _ in range(20):
+                pipeline.tick(timings)
+            pipeline.close()
+            with open(os.path.join(directory, "data.csv"), encoding="utf-8") as file:
+                self.assertEqual(len(file.readlines()), 21)
+            self.assertGreater(os.path.getsize(os.path.join(directory, "data.bin")), 0)
+        self.assertEqual({len(durations) for durations in timings.values()}, {20})
+
+
+
+    def test_stages_of_every_sampler(self):
+        results = bench_stages(self.pids, ["mock", "psutil"], 10)
+        self.assertEqual(set(results["psutil"]), set(STAGES) | {"tick"})
+        self.assertGreater(results["psutil"]["tick"]["mean_us"], 0)
+        json.dumps(results)
+
+
+
+    def test_quick_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            self.assertEqual(benchmark.main(["-o", output, "--ticks", "5", "--seconds", "0.05", "--intervals", "0.01", "--pids", "1", "2"]), 0)
+            with open(output, encoding="utf-8") as file:
+                results = json.load(file)
+        self.assertEqual(results["environment"]["results_version"], benchmark.RESULTS_VERSION)
+        self.assertGreater(results["throughput"]["mock"]["ticks_per_second"], 0)
+        self.assertGreaterEqual(results["jitter"]["0.01"]["ticks"], 5)
+        self.assertEqual(set(results["scaling"]), {"1", "2"})
+        sampler = "proc" if "proc" in results["scaling"]["2"] else "psutil"
+        self.assertLessEqual({f"{sampler}_thread", f"{sampler}_process"}, set(results["scaling"]["2"]))
+
+
+
+    def test_compare(self):
+        baseline = {"environment": {"cpu_count": 4}, "throughput": {"proc": {"ticks": 100, "ticks_per_second": 1000.0}},
+                    "stages": {"proc": {"tick": {"mean_us": 50.0, "p99_us": 100.0}}}}
+        results = {"environment": {"cpu_count": 8}, "throughput": {"proc": {"ticks": 50, "ticks_per_second": 850.0}},
+                   "stages": {"proc": {"tick": {"mean_us": 52.0, "p99_us": 150.0}}}}
+        regressions = compare(baseline, results, 10.0)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith("stages.proc.tick.p99_us"))
+        self.assertTrue(regressions[1].startswith("throughput.proc.ticks_per_second"))
+
+
+
+    def test_unknown_benchmark(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, parse_args, ["latency"])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,496 @@
+import argparse, asyncio, datetime, json, os, re, select, signal, socket, stat, struct, time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Sequence, Tuple
+from csv_writer import BufferedCSVWriter, FSYNC_POLICIES
+from formatting import calculate_elapsed_time, format_timestamp, format_sample
+from metrics import Metric, format_metrics, metric_columns, parse_metric_sets
+from rollups import RollupEngine, TIERS
+from sample_store import SampleStore, process_columns, sample_columns
+from time_index import INDEX_INTERVAL, INDEX_ROWS
+
+# Every frame starts with its type and the length of the payload that follows it.
+FRAME = struct.Struct("<BI")
+PROTOCOL_VERSION: int = 1
+# HELLO introduces a monitor with a JSON payload. A batch is sent as NAMES, the JSON names of the PIDs that are new or renamed,
+# PROCESSES, the records of the single processes, and SAMPLES, the aggregated records in the layout of data.bin .
+# The collector answers every batch with an ACK once it has been written to the files. BYE ends monitoring.
+HELLO, NAMES, PROCESSES, SAMPLES, BYE, ACK = 1, 2, 3, 4, 5, 6
+# A longer frame is taken as a broken stream, e.g. when something other than a monitor has connected.
+MAX_FRAME: int = 256 * 1024 * 1024
+# How long a monitor waits for the collector to take a batch before it falls back to local files.
+TIMEOUT: float = 5.0
+DEFAULT_DIRECTORY: str = os.path.join(os.path.expanduser('~'), "Documents", "Process monitor data")
+
+
+def record_struct(columns: List[Tuple[str, str]]) -> struct.Struct:
+    return struct.Struct("<" + "".join(kind for _, kind in columns))
+
+
+
+def frame(kind: int, payload: bytes = b"") -> bytes:
+    return FRAME.pack(kind, len(payload)) + payload
+
+
+
+def parse_address(address: str) -> Tuple[str, str|Tuple[str, int]]:
+    '''
+    Tells a TCP address, given as "port" or "host:port" with 127.0.0.1 as the default host,
+    from the path of a Unix domain socket. Returns ("tcp", (host, port)) or ("unix", path).
+    '''
+
+    match = re.fullmatch(r"(?:(?P<host>[^:\\/]+):)?(?P<port>\d+)", address)
+    if match:
+        port: int = int(match["port"])
+        if not 0 < port < 65536:
+            raise ValueError(f"Collector port {port} is out of range. Please use a port from 1 to 65535.")
+        return "tcp", (match["host"] or "127.0.0.1", port)
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError(f'"{address}" would be a Unix domain socket, which this platform doesn\'t support. Please use a TCP port.')
+    return "unix", address
+
+
+
+def connect(address: str, timeout: float = TIMEOUT) -> socket.socket:
+    '''
+    Connects to a collector and raises an OSError if none is listening at the address.
+    '''
+
+    kind, target = parse_address(address)
+    if kind == "tcp":
+        connection: socket.socket = socket.create_connection(target, timeout=timeout)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(target)
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+
+class CollectorClient:
+    '''
+    Streams the samples of a monitor to a collector instead of writing them to files.
+    The records are buffered like the rows of a BufferedCSVWriter and every batch is sent with a single call,
+    when flush_rows samples are pending, when flush_interval seconds have passed or when the client gets closed.
+    The batches are kept until the collector acknowledges them. Once the collector can't be reached anymore,
+    the samples that it hasn't acknowledged and all the following ones are passed to "fallback", which writes them to local files.
+    '''
+
+    def __init__(self, address: str, name: str, static_data: Dict[str, object], metric_sets: List[str], start_time: float,
+                 interval: float, fallback: Callable[[Sequence[float|int], List[Sequence[str|float|int]]], None],
+                 flush_rows: int = 100, flush_interval: float = 5.0, timeout: float = TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        extended: List[Metric] = metric_columns(metric_sets)
+        self.address: str = address
+        self.record: struct.Struct = record_struct(sample_columns(extended))
+        self.process_record: struct.Struct = record_struct(process_columns(extended))
+        self.fallback: Callable[[Sequence[float|int], List[Sequence[str|float|int]]], None] = fallback
+        self.flush_rows: int = flush_rows
+        self.flush_interval: float = flush_interval
+        self.clock: Callable[[], float] = clock
+        self.last_flush: float = clock()
+        # Every entry is the aggregated record of a tick and the records of its processes, with the name after the PID.
+        self.pending: List[Tuple[Sequence[float|int], List[Sequence[str|float|int]]]] = []
+        self.unacknowledged: Deque[List[Tuple[Sequence[float|int], List[Sequence[str|float|int]]]]] = deque()
+        self.acknowledgements: bytearray = bytearray()
+        self.names: Dict[int, str] = {}
+        self.batches: int = 0
+        self.failed: bool = False
+        self.closed: bool = False
+        hello: Dict[str, object] = {"version": PROTOCOL_VERSION, "name": name, "static_data": static_data,
+                                    "metric_sets": metric_sets, "start_time": start_time, "interval": interval}
+        self.socket: socket.socket = connect(address, timeout)
+        try:
+            self.socket.sendall(frame(HELLO, json.dumps(hello).encode("utf-8")))
+        except OSError:
+            self.socket.close()
+            raise
+
+    def write(self, values: Sequence[float|int], processes: List[Sequence[str|float|int]] = []) -> None:
+        '''
+        Buffers the aggregated record of a tick, in the order of sample_columns(), and the records of its processes,
+        in the order of process_columns() with the name of the process after the PID.
+        '''
+
+        if self.failed:
+            self.fallback(values, processes)
+            return
+        self.pending.append((values, processes))
+        if len(self.pending) >= self.flush_rows or self.clock() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def pack(self, entries: List[Tuple[Sequence[float|int], List[Sequence[str|float|int]]]]) -> bytes:
+        names: Dict[str, str] = {}
+        samples: bytearray = bytearray()
+        processes: bytearray = bytearray()
+        for values, process_values in entries:
+            samples += self.record.pack(*values)
+            for process in process_values:
+                if self.names.get(process[1]) != process[2]:
+                    self.names[process[1]] = names[str(process[1])] = process[2]
+                processes += self.process_record.pack(process[0], process[1], *process[3:])
+        # The names and processes come first, so the acknowledgement of the samples covers the whole batch.
+        return ((frame(NAMES, json.dumps(names).encode("utf-8")) if names else b"") +
+                (frame(PROCESSES, bytes(processes)) if processes else b"") + frame(SAMPLES, bytes(samples)))
+
+    def flush(self) -> None:
+        '''
+        Sends the pending samples as one batch.
+        '''
+
+        self.last_flush = self.clock()
+        if self.failed or not self.pending:
+            return
+        try:
+            self.read_acknowledgements(wait=False)
+            self.socket.sendall(self.pack(self.pending))
+        except (OSError, ValueError):
+            self.fail()
+            return
+        self.unacknowledged.append(self.pending)
+        self.pending = []
+        self.batches += 1
+
+    def read_acknowledgements(self, wait: bool) -> None:
+        '''
+        Forgets the batches that the collector has acknowledged. With "wait" it waits until all of them are,
+        with the timeout applying to every read.
+        '''
+
+        while self.unacknowledged:
+            if not wait and not select.select([self.socket], [], [], 0)[0]:
+                return
+            data: bytes = self.socket.recv(FRAME.size * len(self.unacknowledged) - len(self.acknowledgements))
+            if not data:
+                raise ConnectionError("The collector has closed the connection.")
+            self.acknowledgements += data
+            while len(self.acknowledgements) >= FRAME.size:
+                kind, _ = FRAME.unpack_from(self.acknowledgements)
+                del self.acknowledgements[:FRAME.size]
+                if kind != ACK:
+                    raise ValueError(f"The collector has sent an unknown frame type: {kind}.")
+                self.unacknowledged.popleft()
+
+    def fail(self) -> None:
+        '''
+        Gives up on the collector and passes every sample that it hasn't acknowledged to the fallback, in order.
+        A batch that the collector has stored right before going away can end up in both places, but none gets lost.
+        '''
+
+        self.failed = True
+        self.socket.close()
+        entries: List[Tuple[Sequence[float|int], List[Sequence[str|float|int]]]] = [entry for batch in self.unacknowledged for entry in batch] + self.pending
+        self.unacknowledged.clear()
+        self.pending = []
+        for values, processes in entries:
+            self.fallback(values, processes)
+
+    def close(self) -> None:
+        '''
+        Sends the pending samples, says goodbye and waits for the collector to acknowledge everything.
+        Calling it more than once is harmless.
+        '''
+
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        if self.failed:
+            return
+        try:
+            self.socket.sendall(frame(BYE))
+            self.read_acknowledgements(wait=True)
+        except (OSError, ValueError):
+            self.fail()
+            return
+        self.socket.close()
+
+
+
+class MonitorSink:
+    '''
+    Stores the samples of one monitor on the collector in a directory of its own, in the same files the monitor would write:
+    static_data.json, data.csv with its time index, data.bin, processes.csv and the rollups.
+    '''
+
+    def __init__(self, directory: str, hello: Dict[str, object], storage: str = "csv", rollups: bool = False,
+                 rollup_tiers: List[str] = list(TIERS), p95: bool = False, index_options: Dict[str, bool|int|float] = {},
+                 **writer_options) -> None:
+        self.directory: str = directory
+        self.extended: List[Metric] = metric_columns(parse_metric_sets(hello["metric_sets"]))
+        self.start_time: float = float(hello["start_time"])
+        columns: List[Tuple[str, str]] = sample_columns(self.extended)
+        self.columns: List[str] = [name for name, _ in columns]
+        self.record: struct.Struct = record_struct(columns)
+        self.process_columns: List[str] = [name for name, _ in process_columns(self.extended)]
+        self.process_record: struct.Struct = record_struct(process_columns(self.extended))
+        self.process_names: Dict[int, str] = {}
+        self.index_options: Dict[str, bool|int|float] = index_options
+        self.writer_options: Dict[str, object] = writer_options
+        self.samples_written: int = 0
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "static_data.json"), "w") as jsonfile:
+            json.dump([hello["static_data"]], jsonfile)
+
+        self.csv_writer: BufferedCSVWriter|None = None
+        if storage in ("csv", "both"):
+            titles: List[str] = ["elapsed_time", "date", "time"] + self.columns[1:]
+            self.csv_writer = BufferedCSVWriter(os.path.join(directory, "data.csv"), titles, **writer_options, **index_options)
+        self.sample_store: SampleStore|None = None
+        if storage in ("binary", "both"):
+            self.sample_store = SampleStore(os.path.join(directory, "data.bin"), columns=columns, start_time=self.start_time,
+                                            interval=hello["interval"], flush_interval=writer_options.get("flush_interval", 5.0),
+                                            fsync=writer_options.get("fsync", "never"))
+        self.rollups: RollupEngine|None = RollupEngine(directory, tiers=rollup_tiers, p95=p95, **writer_options) if rollups else None
+        # processes.csv is only written for the monitors that send the records of single processes.
+        self.processes_writer: BufferedCSVWriter|None = None
+
+    def timestamp(self, elapsed: float) -> Dict[str, str]:
+        return {"elapsed_time": calculate_elapsed_time(elapsed), **format_timestamp(datetime.datetime.fromtimestamp(self.start_time + elapsed))}
+
+    def samples(self, payload: bytes) -> None:
+        if len(payload) % self.record.size:
+            raise ValueError(f"A batch of {len(payload)} bytes doesn't hold whole records of {self.record.size} bytes.")
+        for values in self.record.iter_unpack(payload):
+            total: Dict[str, float|int] = dict(zip(self.columns, values))
+            if self.sample_store is not None:
+                self.sample_store.write(values)
+            if self.rollups is not None:
+                self.rollups.add(self.start_time + values[0], total)
+            if self.csv_writer is not None:
+                self.csv_writer.write({**self.timestamp(values[0]), **format_sample(total), **format_metrics(total, self.extended),
+                                       "skipped_ticks": values[-1]})
+            self.samples_written += 1
+
+    def processes(self, payload: bytes) -> None:
+        if len(payload) % self.process_record.size:
+            raise ValueError(f"A batch of {len(payload)} bytes doesn't hold whole records of {self.process_record.size} bytes.")
+        if self.processes_writer is None:
+            titles: List[str] = ["elapsed_time", "date", "time", "pid", "name"] + self.process_columns[2:]
+            self.processes_writer = BufferedCSVWriter(os.path.join(self.directory, "processes.csv"), titles,
+                                                      **self.writer_options, **self.index_options)
+        for values in self.process_record.iter_unpack(payload):
+            sample: Dict[str, float|int] = dict(zip(self.process_columns, values))
+            self.processes_writer.write({**self.timestamp(values[0]), "pid": values[1], "name": self.process_names.get(values[1], ""),
+                                         **format_sample(sample), **format_metrics(sample, self.extended)})
+
+    def flush(self) -> None:
+        for writer in (self.csv_writer, self.sample_store, self.processes_writer):
+            if writer is not None:
+                writer.flush()
+
+    def close(self) -> None:
+        for writer in (self.csv_writer, self.sample_store, self.processes_writer, self.rollups):
+            if writer is not None:
+                writer.close()
+
+
+
+class Collector:
+    '''
+    Receives the samples of many monitors and stores every monitor's in a directory of its own under "directory",
+    named after the monitor, so one process does the buffered writing, the indexing and the rollups for all of them.
+    The files of all the monitors are flushed together every flush_interval seconds, and only then the batches they hold
+    get acknowledged, so a monitor keeps every batch that would be lost if the collector went away before.
+    '''
+
+    def __init__(self, directory: str = DEFAULT_DIRECTORY, storage: str = "csv", rollups: bool = False,
+                 rollup_tiers: List[str] = list(TIERS), p95: bool = False, index: bool = True, index_rows: int = INDEX_ROWS,
+                 index_interval: float = INDEX_INTERVAL, flush_interval: float = 5.0, **writer_options) -> None:
+        self.directory: str = directory
+        self.flush_interval: float = flush_interval
+        self.sink_options: Dict[str, object] = {"storage": storage, "rollups": rollups, "rollup_tiers": rollup_tiers, "p95": p95,
+                                                "index_options": {"index": index, "index_rows": index_rows, "index_interval": index_interval},
+                                                "flush_interval": flush_interval, **writer_options}
+        self.sinks: Dict[str, MonitorSink] = {}
+        self.streams: Dict[str, asyncio.StreamWriter] = {}
+        self.unacknowledged: Dict[str, int] = {}
+        self.monitors: int = 0
+        self.batches: int = 0
+
+    def open(self, hello: Dict[str, object]) -> str:
+        '''
+        Opens the sink of a monitor that has introduced itself and returns the name of its directory.
+        The name is made safe to be used as a directory, and a monitor that uses the name of a connected one gets a number after it.
+        '''
+
+        if hello.get("version") != PROTOCOL_VERSION:
+            raise ValueError(f'The monitor uses version {hello.get("version")} of the protocol, only version {PROTOCOL_VERSION} is supported.')
+        name: str = re.sub(r"[^\w.\-]", "_", str(hello.get("name", ""))).lstrip(".") or "monitor"
+        unique: str = name
+        number: int = 2
+        while unique in self.sinks:
+            unique = f"{name}_{number}"
+            number += 1
+        self.sinks[unique] = MonitorSink(os.path.join(self.directory, unique), hello, **self.sink_options)
+        self.unacknowledged[unique] = 0
+        self.monitors += 1
+        return unique
+
+    def acknowledge(self, name: str) -> None:
+        '''
+        Flushes the files of a monitor and acknowledges the batches that they hold.
+        '''
+
+        if self.unacknowledged.get(name) and name in self.streams:
+            self.sinks[name].flush()
+            self.streams[name].write(FRAME.pack(ACK, 0) * self.unacknowledged[name])
+            self.unacknowledged[name] = 0
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            for name in list(self.sinks):
+                self.acknowledge(name)
+
+    def close_sink(self, name: str) -> None:
+        sink: MonitorSink|None = self.sinks.pop(name, None)
+        self.streams.pop(name, None)
+        self.unacknowledged.pop(name, None)
+        if sink is not None:
+            sink.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''
+        Serves the connection of a monitor until it says goodbye or goes away.
+        '''
+
+        name: str|None = None
+        try:
+            while True:
+                kind, length = FRAME.unpack(await reader.readexactly(FRAME.size))
+                if length > MAX_FRAME:
+                    raise ValueError(f"A frame of {length} bytes is longer than the limit of {MAX_FRAME} bytes.")
+                payload: bytes = await reader.readexactly(length)
+                if kind == HELLO and name is None:
+                    name = self.open(json.loads(payload))
+                    self.streams[name] = writer
+                    print(f'"{name}" has connected.')
+                elif name is None:
+                    raise ValueError("The monitor has sent data before introducing itself.")
+                elif kind == NAMES:
+                    self.sinks[name].process_names.update({int(pid): process for pid, process in json.loads(payload).items()})
+                elif kind == PROCESSES:
+                    self.sinks[name].processes(payload)
+                elif kind == SAMPLES:
+                    self.sinks[name].samples(payload)
+                    self.unacknowledged[name] += 1
+                    self.batches += 1
+                elif kind == BYE:
+                    # The monitor waits for the last batches to be acknowledged before it exits.
+                    self.acknowledge(name)
+                    await writer.drain()
+                    break
+                else:
+                    raise ValueError(f"The monitor has sent an unknown frame type: {kind}.")
+        except asyncio.IncompleteReadError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, struct.error) as error:
+            print(f'The connection of "{name or "an unknown monitor"}" has been dropped. {type(error).__name__}: {error}')
+        finally:
+            if name is not None:
+                self.close_sink(name)
+                print(f'"{name}" has disconnected.')
+            writer.close()
+
+    def close(self) -> None:
+        for name in list(self.sinks):
+            self.close_sink(name)
+
+
+
+def remove_stale_socket(path: str) -> None:
+    '''
+    Removes a Unix domain socket that a collector has left behind, and raises an error if another collector is still listening on it.
+    '''
+
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise FileExistsError(f'"{path}" exists and is not a socket. Please use another path.')
+    except FileNotFoundError:
+        return
+    try:
+        connect(path, timeout=1.0).close()
+    except OSError:
+        os.remove(path)
+        return
+    raise OSError(f'Another collector is listening on "{path}". Please use another path.')
+
+
+
+async def serve(collector: Collector, address: str, stop: asyncio.Event|None = None, ready: Callable[[], None]|None = None) -> None:
+    '''
+    Runs the collector on the address until "stop" gets set, SIGINT or SIGTERM is received, and then closes every sink.
+    '''
+
+    kind, target = parse_address(address)
+    if kind == "unix":
+        remove_stale_socket(target)
+        server = await asyncio.start_unix_server(collector.handle, path=target)
+    else:
+        server = await asyncio.start_server(collector.handle, host=target[0], port=target[1])
+    stop = stop or asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Windows and the threads other than the main one have no signal handlers, so Ctrl + C ends the collector there.
+            pass
+    flushing: asyncio.Task = asyncio.create_task(collector.flush_periodically())
+    if ready is not None:
+        ready()
+    try:
+        await stop.wait()
+    finally:
+        flushing.cancel()
+        server.close()
+        collector.close()
+        if kind == "unix" and os.path.exists(target):
+            os.remove(target)
+
+
+
+def collect_command(argv: List[str]) -> None:
+    '''
+    Implements the "collect" subcommand, which runs a collector until it gets stopped with Ctrl + C or SIGTERM.
+    '''
+
+    parser = argparse.ArgumentParser(prog="process_monitor_tool.py collect",
+                                     description="Receive the samples of monitors started with --collector and store them centrally")
+    parser.add_argument("address", type=str, help='path of a Unix domain socket, or "port" or "host:port" of a TCP socket (default host: 127.0.0.1)')
+    parser.add_argument("-sp", "--save_path", type=str, default=DEFAULT_DIRECTORY, metavar=" ",
+                        help="directory in which every monitor gets a directory of its own (default: Documents\\Process monitor data)")
+    parser.add_argument("--storage", choices=["csv", "binary", "both", "none"], default="csv", help="write data.csv, data.bin, both or none of them (default: csv)")
+    parser.add_argument("--rollups", action="store_true", help="write per minute, hour and day rollups of every monitor")
+    parser.add_argument("--rollup_tiers", choices=list(TIERS), nargs="+", default=list(TIERS), help="rollup tiers to write (default: all of them)")
+    parser.add_argument("--p95", action="store_true", help="also estimate the 95th percentile in the rollups")
+    parser.add_argument("--flush_rows", type=int, default=100, metavar=" ", help="flush the files after this many buffered rows (default: 100)")
+    parser.add_argument("--flush_interval", type=float, default=5.0, metavar=" ", help="flush the files after this many seconds (default: 5)")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="never", help="when to fsync the files: never, on every flush or on close (default: never)")
+    parser.add_argument("--no_index", action="store_true", help="don't keep the time index (.csv.idx) next to data.csv and processes.csv")
+    parser.add_argument("--index_rows", type=int, default=INDEX_ROWS, metavar=" ", help=f"index a row every this many rows (default: {INDEX_ROWS})")
+    parser.add_argument("--index_interval", type=float, default=INDEX_INTERVAL, metavar=" ",
+                        help=f"index a row at least every this many seconds (default: {INDEX_INTERVAL:g})")
+    args = parser.parse_args(argv)
+    if args.storage == "none" and not args.rollups:
+        parser.error('storage "none" would not write any data. Please use it together with --rollups.')
+    if args.flush_rows < 1:
+        parser.error(f"flush rows has a value of {args.flush_rows}. Please use a value of at least 1.")
+    try:
+        parse_address(args.address)
+    except ValueError as error:
+        parser.error(str(error))
+
+    collector = Collector(args.save_path, storage=args.storage, rollups=args.rollups, rollup_tiers=args.rollup_tiers, p95=args.p95,
+                          index=not args.no_index, index_rows=args.index_rows, index_interval=args.index_interval,
+                          flush_rows=args.flush_rows, flush_interval=args.flush_interval, fsync=args.fsync)
+    print(f"\nThe collector is listening on {args.address} and storing the data of every monitor under: \n{args.save_path}\n")
+    try:
+        asyncio.run(serve(collector, args.address))
+    except KeyboardInterrupt:
+        collector.close()
+    print(f"\nThe collector has finished: {collector.monitors} monitor(s), {collector.batches} batch(es) stored.\n")
@@ -0,0 +1,122 @@
+import unittest, asyncio, csv, json, os, shutil, socket, tempfile, threading
+from collector import Collector, CollectorClient, parse_address, serve
+from sample_store import SampleStoreReader
+
+MB = 1024 * 1024
+
+def sample(elapsed: float, handles: int, *extended) -> tuple:
+    return (elapsed, 12.5, 300 * MB, 200 * MB, handles, *extended, 0)
+
+def processes(elapsed: float) -> list:
+    return [(elapsed, 10, "web", 10.0, 200 * MB, 150 * MB, 40), (elapsed, 11, "worker", 2.5, 100 * MB, 50 * MB, 20)]
+
+class RunningCollector:
+    '''
+    Runs a collector on an event loop of its own thread, like the collect subcommand does in its process.
+    '''
+
+    def __init__(self, collector: Collector, address: str) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.stop = asyncio.Event()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(serve(collector, address, self.stop, ready.set),))
+        self.thread.start()
+        ready.wait(5)
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.stop.set)
+        self.thread.join(5)
+        self.loop.close()
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "the tests use a Unix domain socket")
+class TestCollector(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, "collector.sock")
+        self.fallen_back = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fallback(self, values, process_values):
+        self.fallen_back.append((values, process_values))
+
+    def client(self, name: str = "web_10", metric_sets: list = [], **options) -> CollectorClient:
+        return CollectorClient(self.address, name, {"process_name": "web"}, metric_sets, 1700000000.0, 0.5, self.fallback, **options)
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address("47800"), ("tcp", ("127.0.0.1", 47800)))
+        self.assertEqual(parse_address("localhost:47800"), ("tcp", ("localhost", 47800)))
+        self.assertEqual(parse_address("/run/process_monitor.sock"), ("unix", "/run/process_monitor.sock"))
+        with self.assertRaises(ValueError):
+            parse_address("70000")
+
+    def test_monitors_stream_to_one_collector(self):
+        collector = Collector(os.path.join(self.directory, "store"), storage="both", rollups=True)
+        running = RunningCollector(collector, self.address)
+        web = self.client(flush_rows=3)
+        worker = self.client("worker", ["io"], flush_rows=100)
+        for tick in range(10):
+            web.write(sample(tick * 0.5, 40 + tick), processes(tick * 0.5))
+            worker.write(sample(tick * 0.5, 7, 1000.0, 0.0, 5.0, 0.0))
+        web.close()
+        worker.close()
+        running.close()
+        self.assertEqual(self.fallen_back, [])
+        self.assertEqual((web.batches, worker.batches), (4, 1))
+        self.assertEqual(collector.monitors, 2)
+
+        store = os.path.join(self.directory, "store")
+        self.assertEqual(sorted(os.listdir(store)), ["web_10", "worker"])
+        with open(os.path.join(store, "web_10", "data.csv"), newline="") as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual([int(row["handles"]) for row in rows], list(range(40, 50)))
+        self.assertEqual((rows[0]["working_set"], rows[0]["private_bytes"], rows[-1]["elapsed_time"]), ("300.0", "200.0", "0 day(s) 00:00:04.500"))
+        with open(os.path.join(store, "web_10", "processes.csv"), newline="") as file:
+            names = [row["name"] for row in csv.DictReader(file)]
+        self.assertEqual(names, ["web", "worker"] * 10)
+        with SampleStoreReader(os.path.join(store, "worker", "data.bin")) as reader:
+            self.assertEqual(len(reader), 10)
+            self.assertEqual(reader[0][reader.columns.index("read_bytes_per_s")], 1000.0)
+        with open(os.path.join(store, "worker", "static_data.json")) as file:
+            self.assertEqual(json.load(file), [{"process_name": "web"}])
+        self.assertTrue(os.path.exists(os.path.join(store, "worker", "rollup_minute.csv")))
+        self.assertTrue(os.path.exists(os.path.join(store, "web_10", "data.csv.idx")))
+        self.assertFalse(os.path.exists(self.address))
+
+    def test_monitors_with_the_same_name_get_their_own_directories(self):
+        collector = Collector(self.directory)
+        self.assertEqual([collector.open({"version": 1, "name": name, "static_data": {}, "metric_sets": [], "start_time": 0.0, "interval": 1})
+                          for name in ["../web", "../web", ".."]], ["_web", "_web_2", "monitor"])
+        collector.close()
+
+    def test_no_collector(self):
+        with self.assertRaises(OSError):
+            self.client()
+
+    def test_unacknowledged_samples_fall_back(self):
+        # A collector that takes the frames but goes away without acknowledging any of them.
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.address)
+        server.listen()
+        client = self.client(flush_rows=2)
+        connection, _ = server.accept()
+        for tick in range(5):
+            client.write(sample(tick, tick), processes(tick))
+        connection.recv(1024 * 1024)
+        connection.close()
+        server.close()
+        client.close()
+        self.assertTrue(client.failed)
+        self.assertEqual([values[-2] for values, _ in self.fallen_back], [0, 1, 2, 3, 4])
+        self.assertEqual(self.fallen_back[0][1], processes(0))
+        # Once the collector is gone the following samples go straight to the fallback.
+        client.write(sample(5, 5))
+        self.assertEqual(self.fallen_back[-1], (sample(5, 5), []))
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
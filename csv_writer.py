@@ -0,0 +1,106 @@
+import csv, os, time
+from typing import TYPE_CHECKING, Callable, Dict, List
+# The time index is only imported by the writers that keep one.
+if TYPE_CHECKING:
+    from time_index import TimeIndexWriter
+
+# fsync policies:
+# "never" leaves it up to the OS when the data reaches the disk,
+# "flush" calls fsync after every flush of the buffer,
+# "close" calls fsync only once, when the file gets closed.
+FSYNC_POLICIES: List[str] = ["never", "flush", "close"]
+
+
+class BufferedCSVWriter:
+    '''
+    Keeps a single handle to a .csv file open and batches the rows in memory.
+    The rows are flushed to the file when flush_rows rows are pending, when flush_interval seconds
+    have passed since the last flush or when the writer gets closed.
+    With "index" set, the byte offset of a row is written to the sparse time index next to the file (<path>.idx)
+    every "index_rows" rows or "index_interval" seconds (by default the ones of time_index.py), which lets the query subcommand
+    seek straight to a time range.
+    '''
+
+    def __init__(self, path: str, fieldnames: List[str], flush_rows: int = 100, flush_interval: float = 5.0,
+                 fsync: str = "never", write_header: bool = True, clock: Callable[[], float] = time.monotonic,
+                 index: bool = False, index_rows: int|None = None, index_interval: float|None = None) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy: "{fsync}". Please use one of: {", ".join(FSYNC_POLICIES)}.')
+        if flush_rows < 1:
+            raise ValueError(f"Flush rows has a value of {flush_rows}. Please use a value of at least 1.")
+        self.path: str = path
+        self.fieldnames: List[str] = fieldnames
+        self.flush_rows: int = flush_rows
+        self.flush_interval: float = flush_interval
+        self.fsync: str = fsync
+        self.clock: Callable[[], float] = clock
+        self.pending: List[Dict[str, str|float|int]] = []
+        self.rows_written: int = 0
+        self.flushes: int = 0
+        self.last_flush: float = clock()
+        self.file = open(path, 'w' if write_header else 'a', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames = fieldnames)
+        self.index: TimeIndexWriter|None = None
+        # The positions of the pending rows that get indexed. Their offsets are only known once the rows before them are written.
+        self.index_marks: List[int] = []
+        if index and "date" in fieldnames and "time" in fieldnames:
+            from time_index import TimeIndexWriter, index_path, INDEX_INTERVAL, INDEX_ROWS
+            self.index = TimeIndexWriter(index_path(path), INDEX_ROWS if index_rows is None else index_rows,
+                                         INDEX_INTERVAL if index_interval is None else index_interval, append=not write_header)
+        if write_header:
+            self.writer.writeheader()
+            self.flush()
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def write(self, row: Dict[str, str|float|int]) -> None:
+        '''
+        Buffers a row and flushes the buffer if the row count or the elapsed time calls for it.
+        '''
+
+        if self.index is not None and self.index.due(self.clock()):
+            self.index_marks.append(len(self.pending))
+        self.pending.append(row)
+        if len(self.pending) >= self.flush_rows or self.clock() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        '''
+        Writes the pending rows to the file and applies the fsync policy.
+        '''
+
+        if self.pending:
+            start: int = 0
+            for position in self.index_marks:
+                self.writer.writerows(self.pending[start:position])
+                # tell() flushes the buffer of the file, which only happens once per indexed row.
+                self.index.add(self.pending[position], self.file.tell(), self.rows_written + position)
+                start = position
+            self.writer.writerows(self.pending[start:])
+            self.rows_written += len(self.pending)
+            self.pending.clear()
+            self.index_marks.clear()
+        self.file.flush()
+        # The index is flushed after the rows, so its entries never point past the end of the file.
+        if self.index is not None:
+            self.index.flush()
+        if self.fsync == "flush":
+            os.fsync(self.file.fileno())
+        self.flushes += 1
+        self.last_flush = self.clock()
+
+    def close(self) -> None:
+        '''
+        Drains the buffer and closes the file. Calling it more than once is harmless.
+        '''
+
+        if self.file.closed:
+            return
+        self.flush()
+        if self.fsync == "close":
+            os.fsync(self.file.fileno())
+        self.file.close()
+        if self.index is not None:
+            self.index.close()
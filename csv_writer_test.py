@@ -0,0 +1,67 @@
+import unittest, os, tempfile, csv
+from csv_writer import BufferedCSVWriter
+
+class FakeClock:
+    def __init__(self, now: float = 0.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+def read_rows(path: str) -> list:
+    with open(path, newline='', encoding='utf-8') as csvfile:
+        return list(csv.reader(csvfile))
+
+class TestBufferedCSVWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "data.csv")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+
+    def test_flush_by_row_count(self):
+        writer = BufferedCSVWriter(self.path, ["a", "b"], flush_rows=3, flush_interval=3600, clock=FakeClock())
+        writer.write({"a": 1, "b": 2})
+        writer.write({"a": 3, "b": 4})
+        self.assertEqual(read_rows(self.path), [["a", "b"]])
+        writer.write({"a": 5, "b": 6})
+        self.assertEqual(len(read_rows(self.path)), 4)
+        writer.close()
+
+
+
+    def test_flush_by_elapsed_time(self):
+        clock = FakeClock()
+        writer = BufferedCSVWriter(self.path, ["a"], flush_rows=1000, flush_interval=5, clock=clock)
+        writer.write({"a": 1})
+        self.assertEqual(len(read_rows(self.path)), 1)
+        clock.now = 5
+        writer.write({"a": 2})
+        self.assertEqual(read_rows(self.path), [["a"], ["1"], ["2"]])
+        writer.close()
+
+
+
+    def test_close_drains_buffer(self):
+        writer = BufferedCSVWriter(self.path, ["a"], flush_rows=1000, flush_interval=3600, fsync="close", clock=FakeClock())
+        for value in range(10):
+            writer.write({"a": value})
+        writer.close()
+        writer.close()
+        self.assertTrue(writer.closed)
+        self.assertEqual(len(read_rows(self.path)), 11)
+        self.assertEqual(writer.rows_written, 10)
+
+
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, BufferedCSVWriter, self.path, ["a"], fsync="always")
+        self.assertRaises(ValueError, BufferedCSVWriter, self.path, ["a"], flush_rows=0)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import datetime, math, os, sys, threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, TextIO, Tuple
+from formatting import calculate_elapsed_time
+
+# Sparkline characters from the lowest to the highest value, and the fallback for consoles that can't encode them.
+SPARK_CHARACTERS: str = "▁▂▃▄▅▆▇█"
+ASCII_SPARK_CHARACTERS: str = "_.-~=+*#"
+
+WIDTH: int = 125
+RULE: str = "-" * WIDTH
+# Precompiled, locale-independent formats of the rows of the table.
+HEADER: str = "{:<28} {:<12} {:<17} {:<12} {:<13} {:<10} {:<10}".format(
+    "     Elapsed time [24 h]", "|    Date", "|   Time [24 h]", "|   CPU [%]", "| Working set [MB]", "| Private bytes [MB]", "|  Handles")
+ROW: Callable[..., str] = "{:>29}  {:<12} {:<17} {:>9.2f}   {:>16,.2f}   {:>18,.2f}   {:>9,}".format
+SPARK_ROW: Callable[..., str] = "{:<20} {}  {:>12,.2f} .. {:<12,.2f}".format
+STATUS: Callable[..., str] = "{:,} sample(s), {:,} skipped tick(s), redrawn at most {:g} times per second".format
+
+# The values shown by the dashboard, in the units of the sampler.
+METRICS: List[str] = ["CPU", "working_set", "private_bytes", "handles"]
+MB: float = 1024 * 1024
+
+
+def spark_characters(stream: TextIO) -> str:
+    '''
+    Returns the sparkline characters that the encoding of the stream can print.
+    '''
+
+    try:
+        SPARK_CHARACTERS.encode(getattr(stream, "encoding", None) or "ascii")
+        return SPARK_CHARACTERS
+    except (UnicodeEncodeError, LookupError):
+        return ASCII_SPARK_CHARACTERS
+
+
+
+def sparkline(values: List[float], characters: str) -> str:
+    '''
+    Draws the values scaled between their minimum and maximum as a line of characters.
+    '''
+
+    if not values:
+        return ""
+    lowest, highest = min(values), max(values)
+    if highest <= lowest:
+        return characters[0] * len(values)
+    scale: float = (len(characters) - 1) / (highest - lowest)
+    return "".join(characters[int((value - lowest) * scale)] for value in values)
+
+
+
+class Dashboard:
+    '''
+    Shows the latest sample in a fixed-size table that gets redrawn in place, at most "refresh_rate" times per second,
+    together with the min/max of the run and sparklines of the CPU usage and private bytes.
+    The sampling loop only hands over the latest sample through update(), which just stores a reference to it,
+    while formatting and printing run on a thread of their own, so a slow terminal never holds up sampling or writing.
+    If the output is not a terminal, a single plain line is printed per refresh instead of redrawing the table.
+    '''
+
+    def __init__(self, refresh_rate: float = 4.0, stream: TextIO|None = None, history: int = 60) -> None:
+        if refresh_rate <= 0:
+            raise ValueError(f"Refresh rate has a non-positive value: {refresh_rate}. Please use a positive value.")
+        self.refresh_rate: float = refresh_rate
+        self.stream: TextIO = stream or sys.stdout
+        self.interactive: bool = self.stream.isatty()
+        self.characters: str = spark_characters(self.stream)
+        # Written by the sampling loop only.
+        self.latest: Tuple[float, datetime.datetime, Dict[str, float|int]]|None = None
+        self.samples: int = 0
+        self.skipped: int = 0
+        self.minimum: Dict[str, float] = {metric: math.inf for metric in METRICS}
+        self.maximum: Dict[str, float] = {metric: -math.inf for metric in METRICS}
+        # Used by the render thread only.
+        self.rendered_samples: int = 0
+        self.cpu_history: Deque[float] = deque(maxlen=history)
+        self.private_history: Deque[float] = deque(maxlen=history)
+        self.lines_drawn: int = 0
+        self.header_printed: bool = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="dashboard", daemon=True)
+        self.closed: bool = False
+
+    def start(self) -> None:
+        if self.interactive and os.name == "nt":
+            # An empty command turns on the processing of ANSI escape sequences in the Windows console.
+            os.system("")
+        self.thread.start()
+
+    def update(self, elapsed: float, now: datetime.datetime, values: Dict[str, float|int], skipped: int = 0) -> None:
+        '''
+        Hands over the latest sample, called from the sampling loop. "values" must not be changed afterwards.
+        '''
+
+        minimum, maximum = self.minimum, self.maximum
+        for metric in METRICS:
+            value = values[metric]
+            if value < minimum[metric]:
+                minimum[metric] = value
+            if value > maximum[metric]:
+                maximum[metric] = value
+        self.skipped += skipped
+        self.latest = (elapsed, now, values)
+        self.samples += 1
+
+    def _run(self) -> None:
+        while not self.stop_event.wait(1 / self.refresh_rate):
+            self.render()
+
+    def _row(self, label: str, now: datetime.datetime|None, values: Dict[str, float]) -> str:
+        return ROW(label, now.strftime("%d-%m-%Y") if now else "", now.strftime("%H:%M:%S.%f")[:-3] if now else "",
+                   values["CPU"], values["working_set"] / MB, values["private_bytes"] / MB, int(values["handles"]))
+
+    def frame(self) -> List[str]:
+        '''
+        Returns the lines of the table for the latest sample. Their number never changes, so they can be redrawn in place.
+        '''
+
+        elapsed, now, values = self.latest
+        cpu: List[float] = list(self.cpu_history)
+        private: List[float] = list(self.private_history)
+        return [
+            RULE,
+            HEADER,
+            RULE,
+            self._row(calculate_elapsed_time(elapsed), now, values),
+            self._row("min", None, self.minimum),
+            self._row("max", None, self.maximum),
+            RULE,
+            SPARK_ROW("CPU [%]", sparkline(cpu, self.characters).ljust(self.cpu_history.maxlen), min(cpu), max(cpu)),
+            SPARK_ROW("Private bytes [MB]", sparkline(private, self.characters).ljust(self.private_history.maxlen), min(private), max(private)),
+            STATUS(self.samples, self.skipped, self.refresh_rate)
+        ]
+
+    def render(self) -> None:
+        '''
+        Draws the latest sample, unless it has been drawn already.
+        '''
+
+        latest, samples = self.latest, self.samples
+        if latest is None or samples == self.rendered_samples:
+            return
+        self.rendered_samples = samples
+        elapsed, now, values = latest
+        self.cpu_history.append(values["CPU"])
+        self.private_history.append(values["private_bytes"] / MB)
+        if self.interactive:
+            lines: List[str] = self.frame()
+            # Moves the cursor back to the first line of the previous frame and overwrites it line by line.
+            text: str = (f"\x1b[{self.lines_drawn}F" if self.lines_drawn else "") + "".join(line + "\x1b[K\n" for line in lines)
+            self.lines_drawn = len(lines)
+        else:
+            text = ""
+            if not self.header_printed:
+                text = "\n".join([RULE, HEADER, RULE]) + "\n"
+                self.header_printed = True
+            text += self._row(calculate_elapsed_time(elapsed), now, values) + "\n"
+        try:
+            self.stream.write(text)
+            self.stream.flush()
+        except (OSError, ValueError):
+            # The terminal went away, e.g. a closed pipe, which must not end monitoring.
+            self.stop_event.set()
+
+    def close(self) -> None:
+        '''
+        Stops the render thread and draws the last sample, so the final values stay on the screen.
+        '''
+
+        if self.closed:
+            return
+        self.closed = True
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.render()
@@ -0,0 +1,68 @@
+import unittest, io, datetime, time
+from dashboard import Dashboard, sparkline, SPARK_CHARACTERS, ASCII_SPARK_CHARACTERS
+
+class Terminal(io.StringIO):
+    encoding = "utf-8"
+
+    def isatty(self) -> bool:
+        return True
+
+def sample(n: int) -> dict:
+    return {"CPU": n % 10, "working_set": 1024 * 1024 * 1024 + n, "private_bytes": 100 * 1024 * 1024 * (n + 1), "handles": 1000 + n}
+
+class TestDashboard(unittest.TestCase):
+    def test_redraws_in_place_at_capped_rate(self):
+        terminal = Terminal()
+        dashboard = Dashboard(refresh_rate=20, stream=terminal)
+        dashboard.start()
+        started = time.monotonic()
+        # Samples at about 1 kHz for 0.3 s.
+        n = 0
+        while time.monotonic() - started < 0.3:
+            dashboard.update(n * 0.001, datetime.datetime(2022, 6, 1, 12), sample(n))
+            n += 1
+            time.sleep(0.001)
+        dashboard.close()
+        output = terminal.getvalue()
+        frames = output.count("\x1b[10F") + 1
+        self.assertLessEqual(frames, 0.3 * 20 + 2)
+        self.assertLess(frames, n)
+        last_frame = output.split("\x1b[10F")[-1].splitlines()
+        self.assertEqual(len(last_frame), 10)
+        self.assertIn("1,024.00", last_frame[3])
+        self.assertIn(f"{n:,} sample(s)", last_frame[-1])
+        self.assertIn("min", last_frame[4])
+        self.assertIn("100.00", last_frame[4])
+
+
+
+    def test_plain_lines_when_not_a_terminal(self):
+        output = io.StringIO()
+        dashboard = Dashboard(stream=output)
+        for n in range(100):
+            dashboard.update(n, datetime.datetime(2022, 6, 1, 12), sample(n))
+        # Without the render thread only the latest sample is drawn, once.
+        dashboard.render()
+        dashboard.render()
+        dashboard.close()
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertNotIn("\x1b", output.getvalue())
+        self.assertIn("0 day(s) 00:01:39.000", lines[3])
+
+
+
+    def test_sparkline(self):
+        self.assertEqual(sparkline([0, 1, 2, 3, 4, 5, 6, 7], SPARK_CHARACTERS), SPARK_CHARACTERS)
+        self.assertEqual(sparkline([5, 5, 5], ASCII_SPARK_CHARACTERS), "___")
+        self.assertEqual(sparkline([], SPARK_CHARACTERS), "")
+
+
+
+    def test_refresh_rate_must_be_positive(self):
+        self.assertRaises(ValueError, Dashboard, 0)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
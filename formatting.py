@@ -0,0 +1,75 @@
+import datetime
+from typing import Callable, Dict
+
+# The format strings are parsed once here instead of on every call. The "," option of the format
+# specification always groups the thousands with commas, whatever the locale of the host is.
+GROUP_THOUSANDS: Callable[[float|int], str] = "{:,}".format
+ELAPSED_TIME: Callable[..., str] = "{} day(s) {:02d}:{:02d}:{:02d}.{:03d}".format
+
+
+def thousands_separator(value: float|int|str) -> str:
+    '''
+    Adds a comma as thousands separator, independently of the locale, e.g. "1234.5" becomes "1,234.5".
+    '''
+    if isinstance(value, str):
+        value = int(value) if value.lstrip("-").isdigit() else float(value)
+    return GROUP_THOUSANDS(value)
+
+
+
+def padStart(value: int, times: int, character: str) -> str:
+    '''
+    Pads the start of a string so the alignment of the cli GUI doesn't get affected.
+    '''
+    return str(value).rjust(times, character)
+
+
+
+def calculate_elapsed_time(elapsed: float) -> str:
+    '''
+    Formats the elapsed time, measured in seconds on the monotonic clock since monitoring has started.
+    '''
+
+    # The elapsed time gets rounded to milliseconds first, so 59.9996 seconds becomes 1 minute instead of 59 seconds and 1000 ms.
+    time: int = round(elapsed * 1000)
+    day, time = divmod(time, 24 * 3600 * 1000)
+    hour, time = divmod(time, 3600 * 1000)
+    minutes, time = divmod(time, 60 * 1000)
+    seconds, milliseconds = divmod(time, 1000)
+
+    return ELAPSED_TIME(GROUP_THOUSANDS(day), hour, minutes, seconds, milliseconds)
+
+
+
+def parse_elapsed_time(value: str) -> float:
+    '''
+    Parses an elapsed time like "1,234 day(s) 05:06:07.890" back to seconds.
+    '''
+
+    days, clock = value.split(" day(s) ")
+    hours, minutes, seconds = clock.split(":")
+    return int(days.replace(",", "").replace(".", "")) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+
+def format_timestamp(now: datetime.datetime) -> Dict[str, str]:
+    '''
+    Formats the wall clock time of a sample as the "date" and "time" columns of data.csv .
+    '''
+    return {
+    "date": now.strftime("%d-%m-%Y"),
+    "time": now.strftime("%H:%M:%S.%f")[:-3]
+    }
+
+
+
+def format_sample(sample: Dict[str, str|float|int]) -> Dict[str, str|float|int]:
+    '''
+    Rounds the CPU usage and converts the memory usage to MB.
+    '''
+    return {
+    "CPU": float("{:.2f}".format(sample["CPU"])),
+    "working_set": round(sample["working_set"] / (1024 * 1024), 2),
+    "private_bytes": round(sample["private_bytes"] / (1024 * 1024), 2),
+    "handles": sample["handles"]
+    }
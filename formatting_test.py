@@ -0,0 +1,26 @@
+import unittest, locale
+from formatting import thousands_separator, calculate_elapsed_time
+
+class TestFormatting(unittest.TestCase):
+    def test_thousands_separator_ignores_the_locale(self):
+        previous = locale.setlocale(locale.LC_ALL)
+        try:
+            locale.setlocale(locale.LC_ALL, "C")
+            self.assertEqual(thousands_separator("1234567.25"), "1,234,567.25")
+            self.assertEqual(thousands_separator("100.0"), "100.0")
+            self.assertEqual(thousands_separator(12345), "12,345")
+            self.assertEqual(thousands_separator("-1234"), "-1,234")
+        finally:
+            locale.setlocale(locale.LC_ALL, previous)
+
+
+
+    def test_elapsed_time(self):
+        self.assertEqual(calculate_elapsed_time(0), "0 day(s) 00:00:00.000")
+        self.assertEqual(calculate_elapsed_time(59.9996), "0 day(s) 00:01:00.000")
+        self.assertEqual(calculate_elapsed_time(1234 * 86400 + 3723.4567), "1,234 day(s) 01:02:03.457")
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import configparser, time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+
+class Metric(NamedTuple):
+    '''
+    A column of data.csv: its unit, whether it is a "gauge" or a "rate" computed from a cumulative counter,
+    how the values of several processes are combined ("sum" or "max") and its type in data.bin .
+    '''
+
+    name: str
+    unit: str
+    kind: str
+    aggregate: str
+    store: str
+    description: str
+
+
+
+# The columns that are always written, in the units of data.csv .
+BASE_METRICS: List[Metric] = [
+    Metric("CPU", "%", "gauge", "sum", "f", "CPU usage divided by the number of CPUs"),
+    Metric("working_set", "MB", "gauge", "sum", "Q", "working set on Windows, RSS elsewhere"),
+    Metric("private_bytes", "MB", "gauge", "sum", "Q", "private bytes on Windows, resident minus shared memory or USS on Linux"),
+    Metric("handles", "count", "gauge", "sum", "I", "handles on Windows, open file descriptors elsewhere")
+]
+
+# The optional sets of columns. Rates end in RATE_SUFFIX and are computed from the counter without it.
+RATE_SUFFIX: str = "_per_s"
+METRIC_SETS: Dict[str, List[Metric]] = {
+    "io": [
+        Metric("read_bytes_per_s", "B/s", "rate", "sum", "d", "bytes read from storage"),
+        Metric("write_bytes_per_s", "B/s", "rate", "sum", "d", "bytes written to storage"),
+        Metric("read_ops_per_s", "1/s", "rate", "sum", "d", "read calls"),
+        Metric("write_ops_per_s", "1/s", "rate", "sum", "d", "write calls")
+    ],
+    "ctx_switches": [
+        Metric("voluntary_ctx_switches_per_s", "1/s", "rate", "sum", "d", "context switches while waiting for a resource"),
+        Metric("involuntary_ctx_switches_per_s", "1/s", "rate", "sum", "d", "context switches forced by the scheduler")
+    ],
+    "threads": [
+        Metric("threads", "count", "gauge", "sum", "I", "number of threads"),
+        Metric("busiest_thread_CPU", "%", "gauge", "max", "f", "CPU usage of the busiest thread in percent of one CPU")
+    ],
+    "page_faults": [
+        Metric("page_faults_per_s", "1/s", "rate", "sum", "d", "minor and major page faults"),
+        Metric("major_page_faults_per_s", "1/s", "rate", "sum", "d", "page faults that needed a read from storage")
+    ],
+    "open_files": [
+        Metric("open_files", "count", "gauge", "sum", "I", "open regular files")
+    ]
+}
+
+
+def parse_metric_sets(names: Iterable[str]) -> List[str]:
+    '''
+    Validates the names of metric sets, where "all" selects every set, and returns them in the order of METRIC_SETS,
+    so the columns of data.csv don't depend on the order they were given in.
+    '''
+
+    selected: List[str] = []
+    for name in names:
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name != "all" and name not in METRIC_SETS:
+            raise ValueError(f'Unknown metric set: "{name}". Please use some of: {", ".join(METRIC_SETS)} or all.')
+        selected.append(name)
+    return [name for name in METRIC_SETS if name in selected or "all" in selected]
+
+
+
+def load_metric_sets(paths: List[str]) -> List[str]:
+    '''
+    Reads the metric sets from the "sets" option of the [metrics] section of the given .ini files, e.g.
+
+    [metrics]
+    sets = io, page_faults
+    '''
+
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(paths)
+    return parse_metric_sets(parser.get("metrics", "sets", fallback="").split(","))
+
+
+
+def metric_columns(sets: List[str]) -> List[Metric]:
+    return [metric for name in sets for metric in METRIC_SETS[name]]
+
+
+
+def schema(sets: List[str]) -> List[Dict[str, str]]:
+    '''
+    Describes every metric column of data.csv for static_data.json .
+    '''
+
+    return [{"name": metric.name, "unit": metric.unit, "kind": metric.kind, "aggregate": metric.aggregate, "description": metric.description}
+            for metric in BASE_METRICS + metric_columns(sets)]
+
+
+
+def format_metrics(sample: Dict[str, str|float|int], columns: List[Metric]) -> Dict[str, float|int]:
+    '''
+    Rounds the rates and CPU usages of the extended metrics like the CPU column of data.csv .
+    '''
+    return {metric.name: round(sample[metric.name], 2) if metric.store in ("d", "f") else sample[metric.name] for metric in columns}
+
+
+
+class RateTracker:
+    '''
+    Turns the cumulative counters of every process into rates per second, keeping the counters of the previous
+    sample per PID. The first sample of a process only primes it and gets rates of 0, like psutil's cpu_percent().
+    A counter that went down, e.g. after the process has been replaced, is taken as a rate of 0 too.
+    '''
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock: Callable[[], float] = clock
+        self.counters: Dict[int, Tuple[float, Dict[str, float|int]]] = {}
+        self.threads: Dict[int, Tuple[float, Dict[int, float]]] = {}
+
+    def rates(self, pid: int, counters: Dict[str, float|int]) -> Dict[str, float]:
+        now: float = self.clock()
+        previous: Tuple[float, Dict[str, float|int]]|None = self.counters.get(pid)
+        self.counters[pid] = (now, counters)
+        if previous is None or now <= previous[0]:
+            return {name + RATE_SUFFIX: 0.0 for name in counters}
+        elapsed: float = now - previous[0]
+        before: Dict[str, float|int] = previous[1]
+        return {name + RATE_SUFFIX: max(0.0, (value - before.get(name, value)) / elapsed) for name, value in counters.items()}
+
+    def busiest_thread(self, pid: int, cpu_times: Dict[int, float]) -> float:
+        '''
+        Returns the CPU usage of the busiest thread since the previous sample in percent of one CPU,
+        given the CPU time of every thread by its ID.
+        '''
+
+        now: float = self.clock()
+        previous: Tuple[float, Dict[int, float]]|None = self.threads.get(pid)
+        self.threads[pid] = (now, cpu_times)
+        if previous is None or now <= previous[0]:
+            return 0.0
+        elapsed: float = now - previous[0]
+        before: Dict[int, float] = previous[1]
+        # A thread that has started since the previous sample counts from 0.
+        return max([(cpu_time - before.get(tid, 0.0)) / elapsed * 100 for tid, cpu_time in cpu_times.items()] or [0.0])
+
+    def forget(self, pid: int) -> None:
+        self.counters.pop(pid, None)
+        self.threads.pop(pid, None)
+
+    def state(self, pid: int) -> Tuple[Tuple[float, Dict[str, float|int]]|None, Tuple[float, Dict[int, float]]|None]:
+        '''
+        Returns the counters and thread CPU times of the previous sample of a process, so another tracker can go on from them.
+        '''
+
+        return self.counters.get(pid), self.threads.get(pid)
+
+    def restore(self, pid: int, state: Tuple[Tuple[float, Dict[str, float|int]]|None, Tuple[float, Dict[int, float]]|None]) -> None:
+        counters, threads = state
+        if counters is not None:
+            self.counters[pid] = counters
+        if threads is not None:
+            self.threads[pid] = threads
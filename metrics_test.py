@@ -0,0 +1,77 @@
+import unittest, os, tempfile
+from metrics import BASE_METRICS, METRIC_SETS, RateTracker, format_metrics, load_metric_sets, metric_columns, parse_metric_sets, schema
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestMetrics(unittest.TestCase):
+    def test_parse_metric_sets(self):
+        # The order of METRIC_SETS is kept, so the columns don't depend on the order of the arguments.
+        self.assertEqual(parse_metric_sets(["page_faults", "IO", " ", "io"]), ["io", "page_faults"])
+        self.assertEqual(parse_metric_sets(["all"]), list(METRIC_SETS))
+        self.assertEqual(parse_metric_sets([]), [])
+        self.assertRaises(ValueError, parse_metric_sets, ["gpu"])
+
+
+
+    def test_load_metric_sets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "settings.ini")
+            with open(path, "w") as file:
+                file.write("[myvars]\nset_path = \n")
+            self.assertEqual(load_metric_sets([path]), [])
+            with open(path, "a") as file:
+                file.write("\n[metrics]\nsets = threads, io\n")
+            self.assertEqual(load_metric_sets([path]), ["io", "threads"])
+
+
+
+    def test_schema(self):
+        described = schema(["open_files"])
+        self.assertEqual([metric["name"] for metric in described], [metric.name for metric in BASE_METRICS] + ["open_files"])
+        self.assertEqual(described[-1]["kind"], "gauge")
+        self.assertTrue(all(metric.name.endswith("_per_s") for metric in metric_columns(["io"]) if metric.kind == "rate"))
+
+
+
+    def test_rates(self):
+        clock = FakeClock()
+        tracker = RateTracker(clock)
+        self.assertEqual(tracker.rates(1, {"read_bytes": 1000}), {"read_bytes_per_s": 0.0})
+        clock.now = 2.0
+        self.assertEqual(tracker.rates(1, {"read_bytes": 5000}), {"read_bytes_per_s": 2000.0})
+        # A counter that goes down is not a negative rate.
+        clock.now = 3.0
+        self.assertEqual(tracker.rates(1, {"read_bytes": 10}), {"read_bytes_per_s": 0.0})
+        tracker.forget(1)
+        clock.now = 4.0
+        self.assertEqual(tracker.rates(1, {"read_bytes": 100}), {"read_bytes_per_s": 0.0})
+
+
+
+    def test_busiest_thread(self):
+        clock = FakeClock()
+        tracker = RateTracker(clock)
+        self.assertEqual(tracker.busiest_thread(1, {10: 1.0, 11: 5.0}), 0.0)
+        clock.now = 2.0
+        # Thread 12 has started since the previous sample, thread 10 used 1.5 s of CPU in 2 s.
+        self.assertEqual(tracker.busiest_thread(1, {10: 2.5, 11: 5.5, 12: 0.5}), 75.0)
+
+
+
+    def test_format_metrics(self):
+        columns = metric_columns(["io", "open_files"])
+        sample = {metric.name: 1.23456 for metric in columns}
+        sample["open_files"] = 7
+        formatted = format_metrics(sample, columns)
+        self.assertEqual(formatted["read_bytes_per_s"], 1.23)
+        self.assertEqual(formatted["open_files"], 7)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
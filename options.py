@@ -0,0 +1,33 @@
+from typing import Dict, List
+
+# The choices of the command line options, kept apart from the modules that implement them,
+# so parsing the command line doesn't import every feature, see process_monitor_tool.py .
+
+# Samplers of the process data, see samplers.py .
+SAMPLERS: List[str] = ["auto", "psutil", "proc"]
+
+# Where the shards of a sharded sampler run, see shards.py .
+WORKER_MODES: List[str] = ["thread", "process"]
+
+# The least number of PIDs a shard gets. Below it, handing a shard to a worker costs more than sampling it serially saves.
+SHARD_SIZE: int = 250
+
+# The names of the metric sets of metrics.py, in the order of their columns.
+METRIC_SET_NAMES: List[str] = ["io", "ctx_switches", "threads", "page_faults", "open_files"]
+
+# Length of the rollup tiers in seconds, see rollups.py .
+TIERS: Dict[str, int] = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 24 * 3600
+}
+
+# Wall clock periods that data.csv can be rotated at, as the strftime format that changes when a new period begins, see rotation.py .
+ROTATE_PERIODS: Dict[str, str] = {
+    "hour": "%Y%m%d%H",
+    "day": "%Y%m%d",
+    "week": "%G%V",
+    "month": "%Y%m"
+}
+
+COMPRESSIONS: List[str] = ["none", "gzip", "zstd"]
@@ -0,0 +1,30 @@
+import unittest, subprocess, sys
+from options import METRIC_SET_NAMES, SAMPLERS, TIERS
+from metrics import METRIC_SETS
+from rollups import TIERS as ROLLUP_TIERS
+from samplers import create_sampler
+
+# The modules that only some options or subcommands need.
+FEATURE_MODULES = ["adaptive", "alerts", "collector", "dashboard", "metrics", "process_tree", "report", "rollups", "rotation",
+                   "sample_store", "samplers", "self_stats", "shards", "time_index"]
+
+class TestOptions(unittest.TestCase):
+    def test_choices_match_the_modules(self):
+        self.assertEqual(METRIC_SET_NAMES, list(METRIC_SETS))
+        self.assertIs(ROLLUP_TIERS, TIERS)
+        for kind in SAMPLERS[:2]:
+            self.assertIsNotNone(create_sampler(kind, 1))
+
+
+
+    def test_parsing_the_command_line_imports_no_feature(self):
+        code = ("import sys; sys.argv = ['process_monitor_tool.py']; import process_monitor_tool; "
+                "process_monitor_tool.parse_args(['--pid', '1', '-i', '1', '--rollups', '--metrics', 'io']); "
+                f"print(sorted(set({FEATURE_MODULES!r}) & set(sys.modules)))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
+
+
+if __name__ == '__main__':
+    unittest.main()
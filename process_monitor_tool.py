@@ -1,7 +1,22 @@
-import argparse, asyncio, sys, psutil, configparser, datetime, os, json, locale, csv, warnings, pefile, traceback, re
-from pathvalidate.argparse import validate_filepath_arg
-from typing import Dict, List
-from decimal import Decimal
+import argparse, asyncio, sys, psutil, configparser, datetime, functools, importlib, os, json, warnings, traceback, re, time
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple
+from scheduler import TickScheduler
+from csv_writer import BufferedCSVWriter, FSYNC_POLICIES
+from formatting import calculate_elapsed_time, format_timestamp, format_sample
+from options import COMPRESSIONS, METRIC_SET_NAMES, ROTATE_PERIODS, SAMPLERS, SHARD_SIZE, TIERS, WORKER_MODES
+from validation import ValidationCache, is_pe_file, probe_writable
+# The feature modules are imported where their code paths start, so parsing the command line only needs the choices in options.py
+# and every run only loads the features it uses, see lazy_command() too.
+if TYPE_CHECKING:
+    from adaptive import AdaptiveInterval, ChangeFilter
+    from alerts import AlertEngine
+    from collector import CollectorClient
+    from dashboard import Dashboard
+    from process_tree import ProcessSet
+    from rollups import RollupEngine
+    from rotation import RotatingCSVWriter
+    from sample_store import SampleStore
+    from self_stats import SelfStats
 
 # Hides a warning message about deprecation related to asyncio.get_event_loop().run_until_complete(main())
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -10,47 +25,162 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 PID: int = None
 interval: float = 0
+# Gets set by start_process() as soon as the PID of the launched process is known.
+process_started: asyncio.Event = None
+scheduler: TickScheduler = None
+# Every writer that buffers data gets registered here, so it can be drained when monitoring finishes.
+writers: "List[ProcessSet|ChangeFilter|Dashboard|CollectorClient|BufferedCSVWriter|RotatingCSVWriter|SampleStore|RollupEngine|SelfStats|AlertEngine]" = []
+# Measures the cost of monitoring itself, unless --no_self_stats is used.
+self_stats: "SelfStats" = None
+# Set up by write_stats() when --delta or --max_interval are used.
+change_filter: "ChangeFilter" = None
+adaptive: "AdaptiveInterval" = None
+# Set up by write_stats() when settings.ini or --rules declare alerts.
+alert_engine: "AlertEngine" = None
+# Set up by write_stats() when --collector is used and the collector can be reached.
+collector: "CollectorClient" = None
+
+def lazy_command(module: str, command: str) -> Callable[[List[str]], None]:
+    '''
+    Returns a subcommand that only imports its module when it runs, so monitoring doesn't pay for it,
+    e.g. NumPy, which only the report needs, or the sockets of the collector.
+    '''
+
+    def run(argv: List[str]) -> None:
+        getattr(importlib.import_module(module), command)(argv)
+    return run
+
+# Subcommands that work on the data files of a finished run instead of monitoring, e.g. process_monitor_tool.py export data.bin
+SUBCOMMANDS: Dict[str, Callable[[List[str]], None]] = {
+    "export": lazy_command("sample_store", "export_command"),
+    "report": lazy_command("report", "report_command"),
+    "query": lazy_command("time_index", "query_command"),
+    "index": lazy_command("time_index", "index_command"),
+    "collect": lazy_command("collector", "collect_command")
+}
+
+def save_path_arg(path: str) -> str:
+    '''
+    Checks that the save path is a valid file path with pathvalidate, which is only imported when --save_path is used.
+    '''
+
+    from pathvalidate.argparse import validate_filepath_arg
+    return validate_filepath_arg(path)
 
 def parse_args(args):
     '''Defines all the arguments that the current cli app is going to use.'''
-    parser = argparse.ArgumentParser(description="Launch a process, monitor it at a given interval and constantly write the data to a file",
+    # The usage line is given explicitly, since argparse fails to wrap an automatically generated usage line
+    # that is this long when the option strings and metavars contain spaces.
+    parser = argparse.ArgumentParser(usage="process_monitor_tool.py [-h] (-p   | --pid   | --name  ) -i   [options]",
+            description="Launch a process or attach to a running one, monitor it at a given interval and constantly write the data to a file",
             epilog=
             ('Given that C: is the system drive, here are some examples: \
             \n\nprocess_monitor_tool.py -p "C:\Windows\System32\\notepad.exe" -i 1\
             \nprocess_monitor_tool.py -p "C:\Windows\System32\\notepad.exe" -i 1 -hg\
             \nprocess_monitor_tool.py -p "C:\Windows\System32\\notepad.exe" -i 1 -sp "C:\\Users\\Public\\Documents"\
             \nprocess_monitor_tool.py -p "C:\Windows\System32\\notepad.exe" -i 1 -rp\
-            \nprocess_monitor_tool.py -p "C:\Windows\System32\\notepad.exe" -i 1 -d')
+            \nprocess_monitor_tool.py -p "C:\Windows\System32\\notepad.exe" -i 1 -d\
+            \nprocess_monitor_tool.py -p "C:\Windows\System32\\cmd.exe" -i 1 -t --extra_names "notepad*.exe"\
+            \nprocess_monitor_tool.py --pid 1234 -i 1\
+            \nprocess_monitor_tool.py --name "svchost.exe" -i 1\
+            \nprocess_monitor_tool.py --pid 1234 -i 0.05 --storage binary\
+            \nprocess_monitor_tool.py --pid 1234 -i 1 --rotate_period day --retain_days 90\
+            \nprocess_monitor_tool.py --pid 1234 -i 1 --rollups --p95 --storage none\
+            \nprocess_monitor_tool.py --pid 1234 -i 1 --metrics io threads page_faults\
+            \nprocess_monitor_tool.py --name "worker*.exe" -i 0.1 --extra_names "worker*.exe" --workers 8\
+            \nprocess_monitor_tool.py --pid 1234 -i 1 --rules "C:\\Users\\Public\\Documents\\rules.ini"\
+            \nprocess_monitor_tool.py export "C:\\Users\\Public\\Documents\\Process monitor data\\data.bin"\
+            \nprocess_monitor_tool.py report "C:\\Users\\Public\\Documents\\Process monitor data\\data.csv"\
+            \nprocess_monitor_tool.py query "C:\\Users\\Public\\Documents\\Process monitor data\\data.csv" --from "2024-05-07 03:10" --to "2024-05-07 03:20"\
+            \nprocess_monitor_tool.py collect 47800 -sp "C:\\Users\\Public\\Documents"\
+            \nprocess_monitor_tool.py --pid 1234 -i 1 --collector 47800 --collector_name web_1')
             , formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("-p", "--path", type=str, metavar=" ", help="provide the ABSOLUTE path of the process that you want to launch", required=True)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("-p", "--path", type=str, metavar=" ", help="provide the ABSOLUTE path of the process that you want to launch")
+    target.add_argument("--pid", type=int, metavar=" ", help="attach to the already running process with this PID instead of launching one")
+    target.add_argument("--name", type=str, metavar=" ", help="attach to the already running processes whose names match this pattern instead of launching one")
     parser.add_argument("-i", "--interval", type=float, metavar=" ", help="set the interval as an integer or float value as seconds", required=True)
     parser.add_argument("-hg ", "--hide_gui", action="store_true", help="hide cli gui")
+    parser.add_argument("--refresh_rate", type=float, default=4.0, metavar=" ", help="redraw the cli gui at most this many times per second (default: 4)")
     group = parser.add_mutually_exclusive_group()
-    group.add_argument("-sp", "--save_path", type=validate_filepath_arg, metavar="", help="set the current path for storing the data. Provide the ABSOLUTE path")
+    group.add_argument("-sp", "--save_path", type=save_path_arg, metavar="", help="set the current path for storing the data. Provide the ABSOLUTE path")
     group.add_argument("-rp ","--restore_path", action="store_true", help="restore default path for data storing")
     parser.add_argument("-d  ", "--debug", action="store_true", help="display traceback and custom error message")
+    parser.add_argument("-t  ", "--tree", action="store_true", help="also monitor all the descendants of the launched process")
+    parser.add_argument("--extra_pids", type=int, nargs="+", default=[], metavar="", help="also monitor these already running PIDs")
+    parser.add_argument("--extra_names", type=str, nargs="+", default=[], metavar="", help="also monitor the processes whose names match these patterns, e.g. \"worker*.exe\"")
+    parser.add_argument("--discover_interval", type=float, default=1.0, metavar=" ", help="look for new descendants or matching processes every this many seconds (default: 1)")
+    parser.add_argument("--sampler", choices=SAMPLERS, default="auto",
+                        help="read the process data through psutil or straight from /proc on Linux (default: auto, /proc on Linux)")
+    parser.add_argument("--uss", action="store_true", help="read the exact USS from /proc/<pid>/smaps_rollup as private bytes on Linux, which costs more per tick")
+    parser.add_argument("--workers", type=int, default=1, metavar=" ",
+                        help=f"sample the processes on up to this many threads or processes, one for every {SHARD_SIZE} processes (default: 1, one after another)")
+    parser.add_argument("--worker_mode", choices=WORKER_MODES, default="process",
+                        help="sample in worker processes, which use a core each, or in threads sharing the GIL (default: process)")
+    parser.add_argument("--storage", choices=["csv", "binary", "both", "none"], default="csv",
+                        help="write data.csv, the compact data.bin, both or none of them (default: csv).\ndata.bin can be converted to data.csv with the export subcommand")
+    parser.add_argument("--rollups", action="store_true", help="write per minute, hour and day min/max/mean/last rollups to rollup_<tier>.csv")
+    parser.add_argument("--rollup_tiers", choices=list(TIERS), nargs="+", default=list(TIERS), help="rollup tiers to write (default: all of them)")
+    parser.add_argument("--p95", action="store_true", help="also estimate the 95th percentile in the rollups")
+    parser.add_argument("--rotate_size", type=float, metavar=" ", help="start a new data.csv when it grows over this many MB")
+    parser.add_argument("--rotate_period", choices=list(ROTATE_PERIODS), help="start a new data.csv every hour, day, week or month")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="gzip", help="compression of the rotated data.csv segments (default: gzip)")
+    parser.add_argument("--retain_segments", type=int, metavar=" ", help="keep at most this many rotated data.csv segments")
+    parser.add_argument("--retain_days", type=float, metavar=" ", help="delete the rotated data.csv segments older than this many days")
+    parser.add_argument("--flush_rows", type=int, default=100, metavar=" ", help="flush data.csv after this many buffered rows (default: 100)")
+    parser.add_argument("--flush_interval", type=float, default=5.0, metavar=" ", help="flush data.csv after this many seconds (default: 5)")
+    parser.add_argument("--no_index", action="store_true", help="don't keep the time index (.csv.idx) next to data.csv and processes.csv")
+    parser.add_argument("--index_rows", type=int, default=1000, metavar=" ", help="index a row of data.csv every this many rows (default: 1000)")
+    parser.add_argument("--index_interval", type=float, default=60.0, metavar=" ",
+                        help="index a row of data.csv at least every this many seconds (default: 60)")
+    parser.add_argument("--max_interval", type=float, metavar=" ",
+                        help="stretch the interval up to this many seconds while the metrics stay within the deadband\nand go back to --interval as soon as one of them moves")
+    parser.add_argument("--delta", action="store_true",
+                        help="write a row only when a metric moves beyond the deadband, plus a keyframe row every --keyframe_interval seconds")
+    parser.add_argument("--keyframe_interval", type=float, default=60.0, metavar=" ", help="write a row at least every this many seconds with --delta (default: 60)")
+    parser.add_argument("--deadband_cpu", type=float, default=1.0, metavar=" ", help="deadband of the CPU usage in percentage points (default: 1)")
+    parser.add_argument("--deadband_mb", type=float, default=1.0, metavar=" ", help="deadband of the working set and private bytes in MB (default: 1)")
+    parser.add_argument("--deadband_handles", type=int, default=5, metavar=" ", help="deadband of the handles (default: 5)")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="never", help="when to fsync data.csv: never, on every flush or on close (default: never)")
+    parser.add_argument("--no_self_stats", action="store_true", help="don't measure the CPU, memory and tick latency of the monitor itself")
+    parser.add_argument("--self_stats_interval", type=float, default=60.0, metavar=" ",
+                        help="write the stats of the monitor itself to monitor_stats.json every this many seconds (default: 60)")
+    parser.add_argument("--metrics", choices=METRIC_SET_NAMES + ["all"], nargs="+",
+                        help="also collect these metric sets, with the counters written as rates per second\n(default: the sets of [metrics] in settings.ini, otherwise none)")
+    parser.add_argument("--rules", type=str, metavar=" ",
+                        help="evaluate the [alert <name>] sections of this .ini file on every sample, besides the ones in settings.ini")
+    parser.add_argument("--collector", type=str, metavar=" ",
+                        help="stream the samples to the collector at this Unix domain socket, \"port\" or \"host:port\" instead of writing\ndata.csv, data.bin and processes.csv, which are written as usual while the collector can't be reached")
+    parser.add_argument("--collector_name", type=str, metavar=" ",
+                        help="name of the directory of this monitor on the collector (default: <process name>_<PID>)")
     return parser.parse_args(args)
 
 
 
-def validate(args):
+def validate(args, cache: ValidationCache|None = None):
     '''
     Contains conditions for the arguments to test against. This function is also used for unittest.
+    The checks that have passed get remembered in "cache", which defaults to the validation cache of the user.
     '''
 
 
     # Checks if the path or save path exceed 256 characters
-    if len(args.path) > 256:
+    if args.path != None and len(args.path) > 256:
         raise FileNotFoundError("Path name is too long, it exceeds 256 characters. Please make the path shorter.")
     elif args.save_path != None and len(args.save_path) > 256:
         raise FileNotFoundError("Save path name is too long, it exceeds 256 characters. Please make the path shorter.")
 
     # Checks if the path is not existing
-    if not os.path.exists(args.path):
+    if args.path != None and not os.path.exists(args.path):
         raise FileNotFoundError(f'"{args.path}" file path does not exist. Please use an appropriate path.')
     
     # save path validation
-    if args.save_path != None:
+    if args.save_path != None and os.name != "nt":
+        if not os.path.isabs(args.save_path):
+            raise FileNotFoundError(f'"{args.save_path}" is the relative path. Please provide the absolute path.')
+        elif args.save_path != os.path.normpath(args.save_path):
+            raise FileNotFoundError(f'Invalid path. Please use "{os.path.normpath(args.save_path)}" as the appropriate path.')
+    elif args.save_path != None:
         regexp = re.compile(r'^[A-Z]:.+$')
         if regexp.search(args.save_path) and not os.path.exists(args.save_path[:2]):
             raise FileNotFoundError(f'"{args.save_path[:2]}" save path drive does not exist. Please provide an appropriate drive.')
@@ -59,27 +189,45 @@ def validate(args):
         elif args.save_path != os.path.normpath(args.save_path):
             raise FileNotFoundError(f'Invalid path. Please use "{os.path.normpath(args.save_path)}" as the appropriate path.')
 
+    # The checks that have to touch the disk are skipped for the paths that have passed them before and are unchanged since.
+    if cache is None:
+        cache = ValidationCache()
+
     # Checks if a folder is denied access from being created based on the path provided for save path
-    if args.save_path != None:
-        testpath = f"{args.save_path}\\test_directory\\"
-        os.makedirs(testpath, exist_ok=True)
-        if not os.path.exists(testpath):            
+    if args.save_path != None and not cache.passed("save_path", args.save_path):
+        if not probe_writable(args.save_path):
             raise PermissionError("Access denied. Please choose a different save path.")
-        elif os.path.exists(testpath):
-            os.rmdir(testpath)
-
-    # Checks if a file is executable and if it does not end in .exe .
-    if os.access(args.path, os.X_OK) and not args.path.endswith('.exe'):
-        _, file = os.path.split(args.path)
-        raise OSError(f'"{file}" is not a process. It does not end and in .exe . Please pick a file that ends in .exe .') 
-
-    # Checks if a file is not a true .exe .
-    try:
-        if not pefile.PE(args.path):       
-            raise pefile.PEFormatError
-    except pefile.PEFormatError:
-        _, file = os.path.split(args.path)
-        raise OSError(f'"{file}" is not an executable file. This file was masked as a .exe . Please use a valid .exe file.')
+        cache.remember("save_path", args.save_path)
+
+    # Attaching to an already running process skips the validation of the executable.
+    # On the platforms other than Windows, where executables have no extension, the file only has to be executable.
+    if args.path != None and os.name != "nt":
+        if not os.path.isfile(args.path) or not os.access(args.path, os.X_OK):
+            _, file = os.path.split(args.path)
+            raise OSError(f'"{file}" is not an executable file. Please use a file that has the permission to be executed.')
+
+    elif args.path != None:
+        # Checks if a file is executable and if it does not end in .exe .
+        if os.access(args.path, os.X_OK) and not args.path.endswith('.exe'):
+            _, file = os.path.split(args.path)
+            raise OSError(f'"{file}" is not a process. It does not end and in .exe . Please pick a file that ends in .exe .') 
+
+        # Checks if a file is not a true .exe . Only its headers are read.
+        if not cache.passed("executable", args.path):
+            if not is_pe_file(args.path):
+                _, file = os.path.split(args.path)
+                raise OSError(f'"{file}" is not an executable file. This file was masked as a .exe . Please use a valid .exe file.')
+            cache.remember("executable", args.path)
+
+    cache.save()
+
+    if args.pid != None and not psutil.pid_exists(args.pid):
+        raise ProcessLookupError(f"There is no running process with the PID {args.pid}. Please use the PID of a running process.")
+
+    if args.name != None:
+        from process_tree import find_pids
+        if not find_pids(args.name):
+            raise ProcessLookupError(f'There is no running process matching "{args.name}". Please use the name of a running process.')
     
     if args.interval < 0:
         raise ValueError(f"Interval has a negative value: {args.interval}. Please use a positive value.")
@@ -87,20 +235,114 @@ def validate(args):
     if args.interval == 0:
         raise ValueError(f"Interval has a value of zero. Please use a positive value.")
 
+    for pid in args.extra_pids:
+        if not psutil.pid_exists(pid):
+            raise ProcessLookupError(f"There is no running process with the PID {pid}. Please use the PID of a running process.")
+
+    if args.discover_interval < 0:
+        raise ValueError(f"Discover interval has a negative value: {args.discover_interval}. Please use a positive value.")
+
+    if args.workers < 1:
+        raise ValueError(f"Workers has a value of {args.workers}. Please use a value of at least 1.")
+
+    if args.flush_rows < 1:
+        raise ValueError(f"Flush rows has a value of {args.flush_rows}. Please use a value of at least 1.")
+
+    if args.flush_interval < 0:
+        raise ValueError(f"Flush interval has a negative value: {args.flush_interval}. Please use a positive value.")
+
+    if args.index_rows < 1:
+        raise ValueError(f"Index rows has a value of {args.index_rows}. Please use a value of at least 1.")
+
+    if args.index_interval <= 0:
+        raise ValueError(f"Index interval has a non-positive value: {args.index_interval}. Please use a positive value.")
+
+    if args.max_interval != None and args.max_interval < args.interval:
+        raise ValueError(f"Max interval ({args.max_interval}) is shorter than the interval ({args.interval}). Please use a longer max interval.")
+
+    if args.keyframe_interval <= 0:
+        raise ValueError(f"Keyframe interval has a non-positive value: {args.keyframe_interval}. Please use a positive value.")
+
+    if args.deadband_cpu < 0 or args.deadband_mb < 0 or args.deadband_handles < 0:
+        raise ValueError("A deadband has a negative value. Please use positive values.")
+
+    if args.refresh_rate <= 0:
+        raise ValueError(f"Refresh rate has a non-positive value: {args.refresh_rate}. Please use a positive value.")
+
+    if args.self_stats_interval <= 0:
+        raise ValueError(f"Self stats interval has a non-positive value: {args.self_stats_interval}. Please use a positive value.")
+
+    if args.storage == "none" and not args.rollups and args.collector == None:
+        raise ValueError('Storage "none" would not write any data. Please use it together with --rollups.')
+
+    if args.rotate_size != None and args.rotate_size <= 0:
+        raise ValueError(f"Rotate size has a non-positive value: {args.rotate_size}. Please use a positive value.")
+
+    if args.retain_segments != None and args.retain_segments < 1:
+        raise ValueError(f"Retain segments has a value of {args.retain_segments}. Please use a value of at least 1.")
+
+    if args.retain_days != None and args.retain_days <= 0:
+        raise ValueError(f"Retain days has a non-positive value: {args.retain_days}. Please use a positive value.")
+
+    if args.rotate_size != None or args.rotate_period != None:
+        from rotation import check_compression
+        check_compression(args.compression)
+
+    if args.collector != None:
+        from collector import parse_address
+        parse_address(args.collector)
+
+    if args.rules != None and not os.path.isfile(args.rules):
+        raise FileNotFoundError(f'"{args.rules}" rules file does not exist. Please use an appropriate path.')
+
+    # The metric sets of settings.ini are only used without --metrics, but a mistake in them shows up anyway.
+    from metrics import load_metric_sets
+    load_metric_sets(["settings.ini"])
+
+    # Parses the alert rules, so a mistake in them shows up before anything gets launched.
+    from alerts import load_rules
+    load_rules(["settings.ini"] + ([args.rules] if args.rules != None else []))
+
     return
 
     
 
 def print_data_csv_location():
     '''
-    Prints the location of the data files as a result of monitoring.
+    Drains the buffered rows to data.csv and prints the location of the data files as a result of monitoring.
     '''
 
     global abs_path_csv
     global abs_path_json
+    for writer in writers:
+        writer.close()
     print("\nMonitoring has finished!")
-    print("\nProcess monitoring data is stored at: \n" + abs_path_csv)    
-    print("\nStatic data is stored at: \n" + abs_path_json + "\n")    
+    # The samples that the collector has taken are stored by it, unless it has gone away in the meantime.
+    streamed: bool = collector is not None and not collector.failed
+    if streamed:
+        print(f"\nProcess monitoring data was streamed in {collector.batches} batch(es) to the collector at: \n{args.collector}")
+    if args.storage in ("csv", "both") and not streamed:
+        print("\nProcess monitoring data is stored at: \n" + abs_path_csv)
+    if args.storage in ("csv", "both") and not streamed and (args.rotate_size != None or args.rotate_period != None):
+        print("\nThe rotated segments of data.csv are listed in: \n" + os.path.join(os.path.dirname(abs_path_csv), "manifest.json"))
+    if args.storage in ("binary", "both") and not streamed:
+        print("\nBinary process monitoring data is stored at: \n" + abs_path_bin)
+    if args.rollups:
+        print("\nRollups are stored next to static_data.json as: \n" + ", ".join(f"rollup_{tier}.csv" for tier in args.rollup_tiers))
+    if not streamed:
+        print("\nStatic data is stored at: \n" + abs_path_json)
+    print("")
+    if scheduler is not None:
+        print("Sampling: " + scheduler.summary() + "\n")
+    if change_filter is not None:
+        print(f"Recording: {change_filter.written} row(s) written, {change_filter.suppressed} held back within the deadband\n")
+    if adaptive is not None:
+        print(f"Interval: stretched {adaptive.stretches} time(s), back to {adaptive.base} s {adaptive.snaps} time(s)\n")
+    if alert_engine is not None:
+        print(f"Alerts: {alert_engine.fired} fired, logged to: \n{alert_engine.log_path}\nmarked in: \n{alert_engine.markers_path}\n")
+    if self_stats is not None:
+        print("The cost of monitoring is stored at: \n" + self_stats.path)
+        print("Monitor: " + self_stats.summary() + "\n")
 
 
 
@@ -113,10 +355,28 @@ async def start_process():
     global interval
     proc = await asyncio.create_subprocess_exec(path, stdin=asyncio.subprocess.PIPE, preexec_fn=None)
     PID = proc.pid
+    process_started.set()
     await proc.communicate()
 
 
 
+def attach_process():
+    '''
+    Stores the PID of the already running process that has been provided as a value for the argument "pid" or "name".
+    If more than one process matches the name, the rest of them are monitored as extra PIDs.
+    '''
+
+    global PID
+    if args.pid != None:
+        PID = args.pid
+    else:
+        from process_tree import find_pids
+        PID, *others = find_pids(args.name)
+        args.extra_pids += [pid for pid in others if pid not in args.extra_pids]
+    process_started.set()
+
+
+
 async def main():
     '''
     Validates the passed arguments, launches a specified process,
@@ -145,10 +405,32 @@ async def main():
     interval = args.interval
     global path
     path = args.path
+    global process_started
+    process_started = asyncio.Event()
+
+    # When attaching, there is nothing to launch and monitoring ends when write_stats finds that the target has exited.
+    if path == None:
+        attach_process()
+        try:
+            await write_stats()
+        except (ProcessLookupError, PermissionError) as e:
+            # The attached process has exited or can't be read by this user.
+            print("\n\t", str(type(e).__name__) + ":", e, "\n")
+            for writer in writers:
+                writer.close()
+            sys.exit(1)
+        print_data_csv_location()
+        return
+
     task = asyncio.create_task(write_stats())
     await start_process()
-    print_data_csv_location()
     task.cancel()
+    try:
+        await task
+    # A launched process that exits right away is gone before the first tick.
+    except (asyncio.CancelledError, psutil.NoSuchProcess, ProcessLookupError):
+        pass
+    print_data_csv_location()
 
 
 
@@ -164,11 +446,8 @@ async def write_stats():
     # if the hide_gui argument is used, the cli GUI will be hidden.
     show_gui: bool = not args.hide_gui
 
-    # Sets current locale to en_US for adding the capability of displaying thousands separator for numbers.
-    locale.setlocale(locale.LC_ALL, 'en_US')
-
     # Sets the default path to current user's "Documents" folder, regardless of the username.
-    default_path: str = f"{os.path.expanduser('~')}\\Documents\\Process monitor data"
+    default_path: str = os.path.join(os.path.expanduser('~'), "Documents", "Process monitor data")
     if not os.path.exists(default_path):
         os.makedirs(default_path)
 
@@ -185,12 +464,23 @@ async def write_stats():
 
     def write_to_ini(var: str, value: str) -> None:
         '''
-        Writes the value of the variable to settings.ini .
+        Writes the value of the variable to settings.ini . When many monitors share settings.ini, they only rewrite it
+        if the value has changed, and a temporary file replaces it in one step, so none of them reads it half written.
         '''
 
+        if config.get("myvars", var) == value:
+            return
         config.set("myvars", var, value)
-        with open("settings.ini", "w", newline='') as configfile:
+        temporary: str = f"settings.ini.{os.getpid()}.tmp"
+        with open(temporary, "w", newline='') as configfile:
             config.write(configfile)
+        try:
+            os.replace(temporary, "settings.ini")
+        except PermissionError:
+            # Windows refuses to replace a file that another process has open, in which case it gets rewritten in place.
+            os.remove(temporary)
+            with open("settings.ini", "w", newline='') as configfile:
+                config.write(configfile)
 
     # Restores the default path for data storing
     if args.restore_path:    
@@ -206,7 +496,7 @@ async def write_stats():
     # while also setting the current path to the same path passed as an argument
     # and setting the restore flag to 0. 
     elif args.save_path != None:
-        parent_folder: str = f"{args.save_path}\Process monitor data"
+        parent_folder: str = os.path.join(args.save_path, "Process monitor data")
         if not os.path.exists(parent_folder):
             os.makedirs(parent_folder)
         write_to_ini("set_path", f"{parent_folder}")
@@ -219,138 +509,322 @@ async def write_stats():
 
     # Sets the absoulute path for storing data.csv .
     global abs_path_csv
-    abs_path_csv = f'{current_path}\data.csv'
+    abs_path_csv = os.path.join(current_path, "data.csv")
 
     # Sets the absoulute path for storing static_data.json.
     global abs_path_json
-    abs_path_json = f'{current_path}\static_data.json'
+    abs_path_json = os.path.join(current_path, "static_data.json")
 
-    def thousands_separator(value: float|str) -> str:
-        '''
-        Adds thousands separator.
-        '''
-        return '{0:n}'.format(Decimal(value))
+    # Sets the absoulute path for storing data.bin .
+    global abs_path_bin
+    abs_path_bin = os.path.join(current_path, "data.bin")
+    write_csv: bool = args.storage in ("csv", "both")
+    write_binary: bool = args.storage in ("binary", "both")
 
     print("\n")
     print("Monitoring has started!")
     print("\n")
-    print("Process monitoring data is currently being written to \"data.csv\" at: \n" + abs_path_csv + "\n")    
-    print("Static data was written to \"static_data.json\" at: \n" + abs_path_json)    
+    if args.collector != None:
+        print("Process monitoring data is currently being streamed to the collector at: \n" + args.collector + "\n")
+    elif write_csv:
+        print("Process monitoring data is currently being written to \"data.csv\" at: \n" + abs_path_csv + "\n")    
+    if write_binary and args.collector == None:
+        print("Binary process monitoring data is currently being written to \"data.bin\" at: \n" + abs_path_bin + "\n")    
+    if args.collector == None:
+        print("Static data was written to \"static_data.json\" at: \n" + abs_path_json)    
     print("\n")
 
-    # Draws the table headers of the cli GUI.
-    if show_gui:    
-        print("-" * 125)
-        print("{:<28} {:<12} {:<17} {:<12} {:<13} {:<10} {:<10}".format(
-            "     Elapsed time [24 h]",
-            "|    Date",
-            "|   Time [24 h]",
-            "|   CPU [%]",
-            "| Working set [MB]",
-            "| Private bytes [MB]",
-            "|  Handles")
-            )
-        print("-" * 125)
-
-    process_path_info = os.path.split(args.path)
+    # The cli GUI gets drawn on a thread of its own at a capped refresh rate, from the latest sample only,
+    # so printing to the terminal doesn't slow down sampling at short intervals or flood the scrollback.
+    if show_gui:
+        from dashboard import Dashboard
+        dashboard = Dashboard(args.refresh_rate)
+        writers.append(dashboard)
+        dashboard.start()
+
+    # Waits for the launched process, so the first line of stats belongs to it and not to python.exe .
+    await process_started.wait()
+    if path != None:
+        process_path_info = os.path.split(args.path)
+    else:
+        # The executable of an attached process might not be readable, e.g. for services running as another user.
+        try:
+            process_path_info = os.path.split(psutil.Process(PID).exe())
+        except (psutil.AccessDenied, psutil.NoSuchProcess):
+            process_path_info = ("", args.name or str(PID))
+
+    # Only the collectors of the selected metric sets run, and their columns follow the base ones in every file.
+    from metrics import Metric, format_metrics, load_metric_sets, metric_columns, parse_metric_sets, schema
+    metric_sets: List[str] = parse_metric_sets(args.metrics) if args.metrics != None else load_metric_sets(["settings.ini"])
+    extended: List[Metric] = metric_columns(metric_sets)
 
     # Static data related to the process gets stored in a dictionary and gets written to static_data.json .
+    # "metrics" describes the unit and kind of every metric column, so the chosen schema can be read back.
     static_info: Dict[str, str|float|int] = {
         "process_path": process_path_info[0],
         "process_name": process_path_info[1],
-        "interval": interval
+        "interval": interval,
+        "storage": args.storage,
+        "metric_sets": metric_sets,
+        "metrics": schema(metric_sets)
     }
-    with open(abs_path_json, 'w') as jsonfile:
-        json.dump([static_info], jsonfile)   
+    # With an adaptive interval or change-based recording the rows are not evenly spaced,
+    # so their exact elapsed time is what tells when each of them was sampled.
+    if args.max_interval != None or args.delta:
+        static_info["deadband"] = {"CPU": args.deadband_cpu, "MB": args.deadband_mb, "handles": args.deadband_handles}
+    if args.max_interval != None:
+        static_info["max_interval"] = args.max_interval
+    if args.delta:
+        static_info["keyframe_interval"] = args.keyframe_interval
 
 
     # Sets the header of the data.csv .
-    titles: List[str] = ["elapsed_time", "date", "time", "CPU", "working_set", "private_bytes", "handles"]
-    with open(abs_path_csv, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames = titles)
-        writer.writeheader()
-
-
-    # counter is used for counting how many lines were written to the data.csv .
-    # The counter variable is used in conjunction with the interval to compute the elapsed time.
-    counter: int = 0
+    # The file stays open for the whole run and the rows get flushed in batches,
+    # instead of reopening data.csv for every single row.
+    titles: List[str] = ["elapsed_time", "date", "time", "CPU", "working_set", "private_bytes", "handles"] + [metric.name for metric in extended] + ["skipped_ticks"]
+    # Unless --no_index is used, data.csv and processes.csv get a sparse time index next to them, which maps times to byte offsets,
+    # so the query subcommand seeks straight to a time range instead of reading the files from the top.
+    index_options: Dict[str, bool|int|float] = {"index": not args.no_index, "index_rows": args.index_rows, "index_interval": args.index_interval}
+    # When more than one process is monitored, data.csv holds the tree-level aggregates
+    # and processes.csv holds a row for every monitored process.
+    multiple_processes: bool = args.tree or bool(args.extra_pids) or bool(args.extra_names)
+    process_titles: List[str] = ["elapsed_time", "date", "time", "pid", "name", "CPU", "working_set", "private_bytes", "handles"] + [metric.name for metric in extended]
+
+    # The Process objects and the CPU times of the previous tick are kept, so the CPU usage is the one since the previous tick
+    # instead of blocking the event loop for 100 ms. The first sample of a process only primes it and reports a CPU usage of 0,
+    # since a process is tracked in the same tick, e.g. the launched one on the first tick or a child when it gets discovered.
+    # With --workers the processes are split into shards that get sampled at the same time, which only pays off
+    # for hundreds of processes, so a shard gets at least SHARD_SIZE of them.
+    from process_tree import ProcessSet, aggregate
+    cpu_count: int = psutil.cpu_count() or 1
+    if args.workers == 1:
+        from samplers import create_sampler
+        sampler = create_sampler(args.sampler, cpu_count, args.uss, metric_sets)
+    else:
+        from shards import create_shards
+        sampler = create_shards(args.worker_mode, args.sampler, cpu_count, args.uss, metric_sets, args.workers)
+    processes = ProcessSet([PID] + args.extra_pids, tree=args.tree, name_patterns=args.extra_names,
+                           discover_interval=args.discover_interval, sampler=sampler)
+    # The workers get stopped together with the writers once monitoring finishes.
+    if args.workers > 1:
+        writers.append(processes)
+
+    # The ticks fire on monotonic deadlines, so the time spent sampling and writing doesn't add up to the interval.
+    global scheduler
+    scheduler = TickScheduler(interval)
+
+    # The wall clock time at which the elapsed time was zero. data.bin stores it in its header and the raw values
+    # with the monotonic elapsed time, so the date and time columns can be restored when exporting.
+    wall_start: float = time.time() - scheduler.elapsed()
+
+    csv_writer: BufferedCSVWriter|RotatingCSVWriter|None = None
+    processes_writer: BufferedCSVWriter|None = None
+    sample_store: "SampleStore|None" = None
+    files_opened: bool = False
+
+    def open_files() -> None:
+        '''
+        Writes static_data.json and opens data.csv, processes.csv and data.bin . With --collector this only happens
+        once the collector can't be reached, so the samples that it hasn't taken still get stored.
+        '''
 
-    # repeats the process of writing/displaying the monitoring data by using the count of
-    # seconds used as a value for the interval argument
-    while True:
-        def padStart(value: int, times: int, character: str) -> str:
+        nonlocal csv_writer, processes_writer, sample_store, files_opened
+        files_opened = True
+        with open(abs_path_json, 'w') as jsonfile:
+            json.dump([static_info], jsonfile)   
+
+        # When rotation is used, the closed segments of data.csv get compressed in the background
+        # and manifest.json next to static_data.json lists them with their time ranges.
+        if write_csv and (args.rotate_size != None or args.rotate_period != None):
+            from rotation import RotatingCSVWriter
+            csv_writer = RotatingCSVWriter(abs_path_csv, titles,
+                                           max_bytes=int(args.rotate_size * 1024 * 1024) if args.rotate_size != None else None,
+                                           period=args.rotate_period, compression=args.compression,
+                                           retain_segments=args.retain_segments, retain_days=args.retain_days,
+                                           manifest_path=os.path.join(current_path, "manifest.json"),
+                                           flush_rows=args.flush_rows, flush_interval=args.flush_interval, fsync=args.fsync, **index_options)
+            writers.append(csv_writer)
+        elif write_csv:
+            csv_writer = BufferedCSVWriter(abs_path_csv, titles, flush_rows=args.flush_rows, flush_interval=args.flush_interval, fsync=args.fsync,
+                                           **index_options)
+            writers.append(csv_writer)
+
+        if multiple_processes:
+            processes_writer = BufferedCSVWriter(os.path.join(current_path, "processes.csv"), process_titles,
+                                                 flush_rows=args.flush_rows, flush_interval=args.flush_interval, fsync=args.fsync, **index_options)
+            writers.append(processes_writer)
+
+        if write_binary:
+            from sample_store import SampleStore, sample_columns
+            sample_store = SampleStore(abs_path_bin, columns=sample_columns(extended),
+                                       static_data=os.path.basename(abs_path_json),
+                                       start_time=wall_start, interval=interval,
+                                       flush_interval=args.flush_interval, fsync=args.fsync)
+            writers.append(sample_store)
+
+    # With --collector the samples get streamed to a collector, which stores them together with the ones of other monitors.
+    global collector
+    if args.collector != None:
+        from collector import CollectorClient
+        from sample_store import process_columns, sample_columns
+        # The records that get streamed to the collector have the columns of data.bin, with the name after the PID for the single processes.
+        sample_names: List[str] = [name for name, _ in sample_columns(extended)]
+        process_names: List[str] = [name for name, _ in process_columns(extended)]
+        process_names.insert(2, "name")
+
+        def write_locally(values: Tuple[float|int, ...], process_values: List[Tuple[str|float|int, ...]]) -> None:
             '''
-            Pads the start of a string so the alignment of the cli GUI doesn't get affected.
+            Writes a sample that the collector hasn't taken to the local files, which get opened on the first one.
             '''
-            return str(value).rjust(times, character)
 
-        def calculate_elapsed_time() -> str:
-            '''
-            Calculates the elapsed time based on the interval and counter.
-            '''
+            if not files_opened:
+                print(f"\nThe collector at {args.collector} can't be reached, the data is written to local files from now on.\n")
+                open_files()
+            record(values[-1], datetime.datetime.fromtimestamp(wall_start + values[0]), values[0],
+                   [dict(zip(process_names, process)) for process in process_values], dict(zip(sample_names, values)))
+
+        try:
+            collector = CollectorClient(args.collector, args.collector_name or f"{process_path_info[1]}_{PID}", static_info, metric_sets,
+                                        wall_start, interval, write_locally, flush_rows=args.flush_rows, flush_interval=args.flush_interval)
+            writers.append(collector)
+        except OSError as error:
+            print(f"The collector at {args.collector} is not available ({error}), the data is written to local files instead.\n")
+    if collector is None:
+        open_files()
+
+    # The rollups keep constant memory however long monitoring runs, with each tier written to its own file.
+    if args.rollups:
+        from rollups import RollupEngine
+        rollups = RollupEngine(current_path, tiers=args.rollup_tiers, p95=args.p95,
+                               flush_rows=args.flush_rows, flush_interval=args.flush_interval, fsync=args.fsync)
+        writers.append(rollups)
+
+    # The monitor measures its own cost per tick, so it can be shown that it isn't what loads the machine.
+    global self_stats
+    if not args.no_self_stats:
+        from self_stats import SelfStats
+        self_stats = SelfStats(os.path.join(current_path, "monitor_stats.json"), write_interval=args.self_stats_interval)
+        writers.append(self_stats)
+
+    def record(tick_skipped: int, now: datetime.datetime, elapsed: float,
+               samples: List[Dict[str, str|float|int]], total: Dict[str, str|float|int]) -> None:
+        '''
+        Writes a sample to data.bin, processes.csv and data.csv .
+        '''
 
-            # I'm using counter - 1 to print the elapsed time starting from zero
-            # when the first line of stats, which belongs to python.exe, gets skipped.
-            time: float = interval * (counter - 1)
-            day: float = time // (24 * 3600)
-            time = time % (24 * 3600)
-            hour: float = time // 3600
-            time %= 3600
-            minutes: float = time // 60
-            time %= 60
-            seconds: float = time
-            time *= 1000
-            milliseconds: int = round(time % 1000)
-
-            return "{} day(s) {}:{}:{}.{}".format(
-                thousands_separator(day),
-                padStart(int(hour), 2, "0"), 
-                padStart(int(minutes), 2, "0"), 
-                padStart(int(seconds), 2, "0"), 
-                padStart(milliseconds, 3, "0")
-                )
-
-        global PID
-        process_stats = psutil.Process(PID)
+        # The binary store and the collector get the raw values, without any of the formatting below.
+        values: Tuple[float|int, ...] = (elapsed, total["CPU"], total["working_set"], total["private_bytes"], total["handles"],
+                                         *[total[metric.name] for metric in extended], tick_skipped)
+        if collector is not None and not collector.failed:
+            collector.write(values, [(elapsed, sample["pid"], sample["name"], sample["CPU"], sample["working_set"], sample["private_bytes"],
+                                      sample["handles"], *[sample[metric.name] for metric in extended]) for sample in samples]
+                                    if multiple_processes else [])
+            if self_stats is not None:
+                self_stats.mark("store")
+            return
+        if write_binary:
+            sample_store.write(values)
+        if self_stats is not None:
+            self_stats.mark("store")
+        if not write_csv and not multiple_processes:
+            return
+
+        timestamp: Dict[str, str] = {"elapsed_time": calculate_elapsed_time(elapsed), **format_timestamp(now)}
 
         #  Dynamic data related to process monitoring gets stored in a dictionary
-        dynamic_info: Dict[str, str|float|int] = {
-        "elapsed_time": calculate_elapsed_time(),                
-        "date": datetime.datetime.now().strftime("%d-%m-%Y"),
-        "time": datetime.datetime.now().strftime("%H:%M:%S.%f")[:-3],                  
-        "CPU": float("{:.2f}".format(process_stats.cpu_percent(interval=0.1)/psutil.cpu_count())),
-        "working_set": round(process_stats.memory_info().wset / (1024 * 1024), 2),
-        "private_bytes": round(process_stats.memory_info().private / (1024 * 1024), 2),
-        "handles": process_stats.num_handles()
-        }
-
-        # Prints all the data in the cli GUI related to the process after some formatting had been applied.
-        if show_gui:
-            # I'm using counter > 0 to not print the first line of stats, which belongs to python.exe .
-            if counter > 0:
-                print("{:<31} {:<15} {:<18} {:<11} {:<20} {:<17} {:<5}".format(
-                dynamic_info["elapsed_time"].rjust(29, " "),                     
-                dynamic_info["date"], 
-                dynamic_info["time"],
-                str(dynamic_info["CPU"]).rjust(6, " "), 
-                thousands_separator(str(dynamic_info["working_set"])).rjust(13, " "), 
-                thousands_separator(str(dynamic_info["private_bytes"])).rjust(13, " "), 
-                thousands_separator(str(dynamic_info["handles"])).rjust(7, " "), 
-                ))  
+        dynamic_info: Dict[str, str|float|int] = {**timestamp, **format_sample(total), **format_metrics(total, extended), "skipped_ticks": tick_skipped}
+
+        if multiple_processes:
+            for sample in samples:
+                processes_writer.write({**timestamp, "pid": sample["pid"], "name": sample["name"], **format_sample(sample), **format_metrics(sample, extended)})
+        if self_stats is not None:
+            self_stats.mark("format")
 
         # Writes all the data related to the process to the data.csv .
         # I had previously implemented a data.json, but I realized that if a processes is monitored for years
         # the csv format is more suitable since it takes less size by not storing the same data over and over, hence it takes
         # less write/read time than json .
-        with open(abs_path_csv, 'a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames = titles)
-            # I'm using counter > 0 to not write the first line of stats, which belongs to python.exe .
-            if counter > 0:
-                writer.writerows([dynamic_info])
-            counter += 1
-        await asyncio.sleep(interval)
-
+        # For even longer runs, the binary data.bin takes only a fixed-width record per sample.
+        if write_csv:
+            csv_writer.write(dynamic_info)
+        if self_stats is not None:
+            self_stats.mark("csv")
+
+    # With --delta only the samples that moved beyond the deadband and the keyframes get written.
+    # The filter is closed before the writers, so the last sample that was held back still gets written.
+    global change_filter
+    if args.delta:
+        from adaptive import ChangeFilter, Deadband
+        change_filter = ChangeFilter(Deadband(args.deadband_cpu, args.deadband_mb, args.deadband_handles), args.keyframe_interval)
+        writers.insert(0, change_filter)
+
+    # With --max_interval the interval stretches while the process is idle.
+    global adaptive
+    if args.max_interval != None:
+        from adaptive import AdaptiveInterval, Deadband
+        adaptive = AdaptiveInterval(interval, args.max_interval, Deadband(args.deadband_cpu, args.deadband_mb, args.deadband_handles))
+
+    # The alert rules are evaluated on every sample, each of them in constant time however long monitoring runs.
+    global alert_engine
+    from alerts import load_rules
+    rules = load_rules(["settings.ini"] + ([args.rules] if args.rules != None else []))
+    if rules:
+        from alerts import AlertEngine
+        alert_engine = AlertEngine(rules, current_path, interval)
+        writers.append(alert_engine)
 
+    # repeats the process of writing/displaying the monitoring data by using the count of
+    # seconds used as a value for the interval argument
+    while True:
+        tick = await scheduler.wait()
+        if self_stats is not None:
+            self_stats.start_tick(tick)
+        now = datetime.datetime.now()
+        samples = processes.sample()
+        # Monitoring ends once every monitored process has exited. A tick in which none of them could be read,
+        # e.g. with no file descriptors left, is skipped instead.
+        if not processes.processes:
+            return
+        if not samples:
+            if self_stats is not None:
+                self_stats.end_tick()
+            continue
+        if self_stats is not None:
+            self_stats.mark("sample")
+        elapsed: float = scheduler.elapsed(tick.fired_at)
+        total: Dict[str, str|float|int] = aggregate(samples, extended)
+
+        # The rollups get every sample, so their statistics don't depend on --delta.
+        if args.rollups:
+            rollups.add(wall_start + elapsed, total)
+        next_interval: float = adaptive.next(total) if adaptive is not None else interval
+        # An alert with a marker writes its sample to data.csv too, even within the deadband of --delta.
+        marked: bool = False
+        if alert_engine is not None:
+            marked = alert_engine.evaluate(elapsed, now, total)
+            next_interval = alert_engine.next_interval(elapsed, next_interval)
+        if next_interval != scheduler.interval:
+            scheduler.set_interval(next_interval, immediately=True)
+        if self_stats is not None:
+            self_stats.mark("aggregate")
+        if show_gui:
+            dashboard.update(elapsed, now, total, tick.skipped)
+        if self_stats is not None:
+            self_stats.mark("gui")
+
+        if change_filter is not None:
+            # The sample is bound to the call, since a held back one gets written on a later tick.
+            change_filter.offer(elapsed, total, functools.partial(record, tick.skipped, now, elapsed, samples, total), force=marked)
+        else:
+            record(tick.skipped, now, elapsed, samples, total)
+        if self_stats is not None:
+            self_stats.end_tick()
+
+
+# The subcommands run before the event loop of monitoring is started, since the collector runs an event loop of its own.
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+    SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+    sys.exit(0)
 
 try:
     if __name__ == '__main__':
@@ -135,5 +135,18 @@ class TestCLIMonitor(unittest.TestCase):
 
 
 
+    def test_attach(self):
+        parsed_data1 = parse_args(['--pid', str(os.getpid()), '-i', '1'])
+        self.assertEqual(parsed_data1.pid, os.getpid())
+        self.assertIsNone(parsed_data1.path)
+        validate(parsed_data1)
+        parsed_data2 = parse_args(['--name', 'no_such_process_name*.exe', '-i', '1'])
+        self.assertRaises(ProcessLookupError, validate, parsed_data2)
+        parsed_data3 = parse_args(['--pid', '999999999', '-i', '1'])
+        self.assertRaises(ProcessLookupError, validate, parsed_data3)
+        self.assertRaises(SystemExit, parse_args, ['-p', notepad, '--pid', '1', '-i', '1'])
+
+
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -0,0 +1,167 @@
+import errno, fnmatch, time, psutil
+from typing import Callable, Dict, Iterable, List, Set
+from samplers import sample_processes, PsutilSampler, ProcSampler
+from shards import ProcessShards, ThreadShards
+from metrics import Metric
+
+
+def matches_name(name: str|None, patterns: List[str]) -> bool:
+    '''
+    Checks case-insensitively whether a process name matches one of the lowercase patterns, e.g. "worker*.exe".
+    '''
+
+    if not name:
+        return False
+    name = name.lower()
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+
+def find_pids(pattern: str) -> List[int]:
+    '''
+    Returns the PIDs of the running processes whose names match the pattern, the oldest process first.
+    '''
+
+    found: List[psutil.Process] = [process for process in psutil.process_iter(["name", "create_time"])
+                                   if matches_name(process.info["name"], [pattern.lower()])]
+    found.sort(key=lambda process: process.info["create_time"] or 0.0)
+    return [process.pid for process in found]
+
+
+
+def aggregate(samples: List[Dict[str, str|float|int]], metrics: List[Metric]|None = None) -> Dict[str, str|float|int]:
+    '''
+    Sums up the dynamic data of all the sampled processes into a tree-level row,
+    together with the columns of the selected metric sets, which are summed up or take the maximum.
+    '''
+
+    total: Dict[str, str|float|int] = {"pid": "total", "name": f"{len(samples)} process(es)",
+                                       "CPU": 0.0, "working_set": 0, "private_bytes": 0, "handles": 0, "threads": 0}
+    for sample in samples:
+        total["CPU"] += sample["CPU"]
+        total["working_set"] += sample["working_set"]
+        total["private_bytes"] += sample["private_bytes"]
+        total["handles"] += sample["handles"]
+        total["threads"] += sample.get("threads", 0)
+    for metric in metrics or []:
+        if metric.name == "threads":
+            continue
+        values: List[float|int] = [sample[metric.name] for sample in samples]
+        total[metric.name] = (max(values) if metric.aggregate == "max" else sum(values)) if values else 0
+    return total
+
+
+
+class ProcessSet:
+    '''
+    Keeps track of the monitored processes: the root PIDs, optionally all their descendants
+    and the processes whose names match one of the name patterns.
+    The psutil.Process objects are cached across ticks, since the samplers keep the CPU times
+    of the previous tick for them. The first sample of a process reports a CPU usage of 0. Discovering new processes walks the whole process
+    table once, so it runs at most once every discover_interval seconds instead of every tick.
+    With a sharded sampler (see shards.py) the processes are sampled by its workers at the same time instead of one after another.
+    '''
+
+    def __init__(self, root_pids: Iterable[int], tree: bool = False, name_patterns: Iterable[str]|None = None,
+                 discover_interval: float = 1.0, clock: Callable[[], float] = time.monotonic,
+                 sampler: PsutilSampler|ProcSampler|ThreadShards|ProcessShards|None = None) -> None:
+        self.root_pids: Set[int] = set(root_pids)
+        self.tree: bool = tree
+        self.name_patterns: List[str] = [pattern.lower() for pattern in name_patterns or []]
+        self.discover_interval: float = discover_interval
+        self.clock: Callable[[], float] = clock
+        self.sampler: PsutilSampler|ProcSampler|ThreadShards|ProcessShards = sampler or PsutilSampler(psutil.cpu_count() or 1)
+        self.processes: Dict[int, psutil.Process] = {}
+        self.last_discovery: float|None = None
+        for pid in self.root_pids:
+            self._track_root(pid)
+
+    @property
+    def discovers(self) -> bool:
+        return self.tree or bool(self.name_patterns)
+
+    def _track_root(self, pid: int) -> None:
+        '''
+        Tracks a root PID. Unlike a discovered process, which is skipped if it can't be read,
+        a root PID that has exited or can't be read is an error that names it.
+        '''
+
+        try:
+            process = psutil.Process(pid)
+            self.sampler.track(process)
+        except psutil.NoSuchProcess:
+            raise ProcessLookupError(f"There is no running process with the PID {pid}. Please use the PID of a running process.")
+        except psutil.AccessDenied:
+            raise PermissionError(f"Access to the process with the PID {pid} is denied. Please run the tool as a user that may read it.")
+        self.processes[pid] = process
+
+    def _track(self, process: psutil.Process) -> None:
+        '''
+        Adds a process to the cache and lets the sampler check that it can be read, unless the same process is already cached.
+        '''
+
+        cached = self.processes.get(process.pid)
+        # psutil.Process compares both the PID and the creation time, so a reused PID is not mistaken for the old process.
+        if cached is not None and cached == process:
+            return
+        try:
+            self.sampler.track(process)
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            return
+        except OSError as e:
+            # With no file descriptors left the process is tracked by a later discovery instead.
+            if e.errno not in (errno.EMFILE, errno.ENFILE):
+                raise
+            return
+        self.processes[process.pid] = process
+
+    def discover(self) -> None:
+        '''
+        Walks the process table once, collecting the descendants of the root PIDs and the processes matching the name patterns.
+        '''
+
+        self.last_discovery = self.clock()
+        children: Dict[int, List[psutil.Process]] = {}
+        found: List[psutil.Process] = []
+        for process in psutil.process_iter(["ppid", "name"]):
+            if self.tree:
+                children.setdefault(process.info["ppid"], []).append(process)
+            if self.name_patterns and matches_name(process.info["name"], self.name_patterns):
+                found.append(process)
+
+        if self.tree:
+            stack: List[int] = list(self.root_pids)
+            seen: Set[int] = set(stack)
+            while stack:
+                for child in children.get(stack.pop(), []):
+                    if child.pid not in seen:
+                        seen.add(child.pid)
+                        stack.append(child.pid)
+                        found.append(child)
+
+        for process in found:
+            self._track(process)
+
+    def sample(self) -> List[Dict[str, str|float|int]]:
+        '''
+        Samples every tracked process, dropping the ones that have exited since the previous tick.
+        The samples can be empty while processes are still tracked, e.g. when no file descriptors are left for a tick,
+        so whether monitoring goes on is told by "processes" instead.
+        '''
+
+        if self.discovers and (self.last_discovery is None or self.clock() - self.last_discovery >= self.discover_interval):
+            self.discover()
+
+        samples: List[Dict[str, str|float|int]]
+        gone: List[int]
+        if isinstance(self.sampler, (ThreadShards, ProcessShards)):
+            samples, gone = self.sampler.sample_all(self.processes)
+        else:
+            samples, gone = sample_processes(self.sampler, list(self.processes.values()))
+        for pid in gone:
+            self.processes.pop(pid, None)
+            self.root_pids.discard(pid)
+        return samples
+
+    def close(self) -> None:
+        self.sampler.close()
@@ -0,0 +1,120 @@
+import unittest, errno, os, sys, subprocess, time, psutil
+from process_tree import ProcessSet, aggregate, find_pids
+from samplers import PsutilSampler, create_sampler
+from metrics import metric_columns
+
+class OutOfDescriptors(PsutilSampler):
+    def sample(self, process):
+        raise OSError(errno.EMFILE, "Too many open files")
+
+class TestProcessSet(unittest.TestCase):
+    def setUp(self):
+        # A child process that sleeps until it gets killed.
+        self.child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+
+    def tearDown(self):
+        self.child.kill()
+        self.child.wait()
+
+
+
+    def test_tree_discovers_descendants(self):
+        processes = ProcessSet([os.getpid()], tree=True)
+        self.assertEqual(list(processes.processes), [os.getpid()])
+        processes.discover()
+        self.assertIn(self.child.pid, processes.processes)
+
+
+
+    def test_without_tree_only_roots_are_tracked(self):
+        processes = ProcessSet([os.getpid()])
+        self.assertFalse(processes.discovers)
+        self.assertEqual(list(processes.processes), [os.getpid()])
+
+
+
+    def test_root_pid_that_has_exited(self):
+        self.child.kill()
+        self.child.wait()
+        with self.assertRaisesRegex(ProcessLookupError, str(self.child.pid)):
+            ProcessSet([self.child.pid])
+
+
+
+    def test_tick_without_samples(self):
+        processes = ProcessSet([self.child.pid], sampler=OutOfDescriptors(1))
+        # The process is still tracked, so a tick that can't read it doesn't end monitoring.
+        self.assertEqual(processes.sample(), [])
+        self.assertEqual(list(processes.processes), [self.child.pid])
+
+
+
+    def test_name_patterns(self):
+        name = psutil.Process(self.child.pid).name()
+        processes = ProcessSet([os.getpid()], name_patterns=[name.upper()[:3] + "*"])
+        processes.discover()
+        self.assertIn(self.child.pid, processes.processes)
+
+
+
+    def test_find_pids(self):
+        name = psutil.Process(self.child.pid).name()
+        self.assertIn(self.child.pid, find_pids(name.upper()))
+        self.assertEqual(find_pids("no_such_process_name*.exe"), [])
+
+
+
+    def test_cached_process_objects_are_reused(self):
+        processes = ProcessSet([os.getpid()], tree=True)
+        processes.discover()
+        cached = processes.processes[self.child.pid]
+        processes.discover()
+        self.assertIs(processes.processes[self.child.pid], cached)
+
+
+
+    def test_first_cpu_of_a_new_child(self):
+        # The children burn a CPU right away, so a CPU usage measured between being tracked and being sampled
+        # in the same tick would be far above what all the CPUs together can do.
+        busy = [subprocess.Popen([sys.executable, "-c", "while True: pass"]) for _ in range(3)]
+        try:
+            time.sleep(0.2)
+            for kind in ["psutil", "proc"] if sys.platform.startswith("linux") else ["psutil"]:
+                processes = ProcessSet([os.getpid()], tree=True, sampler=create_sampler(kind, psutil.cpu_count()))
+                first = {sample["pid"]: sample["CPU"] for sample in processes.sample()}
+                for child in busy:
+                    self.assertLessEqual(first[child.pid], 100 * psutil.cpu_count(), kind)
+                    # The first sample only primes the CPU usage.
+                    self.assertEqual(first[child.pid], 0.0, kind)
+                time.sleep(0.2)
+                later = {sample["pid"]: sample["CPU"] for sample in processes.sample()}
+                self.assertGreater(sum(later[child.pid] for child in busy), 0.0, kind)
+                processes.close()
+        finally:
+            for child in busy:
+                child.kill()
+                child.wait()
+
+
+
+    def test_aggregate(self):
+        samples = [
+            {"pid": 1, "name": "a", "CPU": 1.5, "working_set": 100, "private_bytes": 10, "handles": 3},
+            {"pid": 2, "name": "b", "CPU": 2.5, "working_set": 200, "private_bytes": 20, "handles": 4}
+        ]
+        total = aggregate(samples)
+        self.assertEqual(total["pid"], "total")
+        self.assertEqual(total["CPU"], 4.0)
+        self.assertEqual(total["working_set"], 300)
+        self.assertEqual(total["private_bytes"], 30)
+        self.assertEqual(total["handles"], 7)
+        samples[0].update(busiest_thread_CPU=30.0, read_bytes_per_s=1.5)
+        samples[1].update(busiest_thread_CPU=20.0, read_bytes_per_s=2.5)
+        total = aggregate(samples, metric_columns(["io", "threads"])[:1] + metric_columns(["threads"])[1:])
+        self.assertEqual(total["busiest_thread_CPU"], 30.0)
+        self.assertEqual(total["read_bytes_per_s"], 4.0)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,411 @@
+import argparse, csv, datetime, json, math, os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import numpy as np
+from typing import Deque, Dict, Iterator, List, Tuple
+from formatting import parse_elapsed_time
+from rollups import QuantileSketch
+from sample_store import SampleStoreReader, BYTE_COLUMNS
+from time_index import _open_rows
+
+# The columns of data.csv that are not metrics and how many numbers each of them is made of,
+# e.g. "0 day(s) 00:00:01.000" is made of the days, hours, minutes and seconds.
+TIME_COLUMNS: Dict[str, int] = {"elapsed_time": 4, "date": 3, "time": 3}
+
+# The columns of processes.csv that tell the processes apart instead of being metrics.
+LABEL_COLUMNS: List[str] = ["pid", "name"]
+
+# Metrics that the memory or handle leak slope is computed for.
+LEAK_METRICS: List[str] = ["private_bytes", "handles"]
+
+PERCENTILES: List[int] = [50, 95, 99]
+
+# Turns a chunk of data.csv into comma-separated numbers: the separators of the date and time
+# and the line endings become commas, while the carriage returns get removed.
+TRANSLATION: bytes = bytes.maketrans(b":-\n", b",,,")
+
+# struct format characters of data.bin as numpy types.
+NUMPY_TYPES: Dict[str, str] = {"d": "<f8", "f": "<f4", "Q": "<u8", "q": "<i8", "I": "<u4", "i": "<i4", "H": "<u2", "h": "<i2", "B": "u1", "b": "i1"}
+
+
+def days_from_civil(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    '''
+    Returns the number of days since 01-01-1970 of every date, computed for whole arrays at once.
+    '''
+
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+
+class CSVChunk:
+    '''
+    The columns of a chunk of rows: the elapsed time in seconds, the wall clock time as seconds since 01-01-1970
+    in local time and every metric, all as numpy arrays.
+    '''
+
+    def __init__(self, elapsed: np.ndarray, wall: np.ndarray, metrics: Dict[str, np.ndarray]) -> None:
+        self.elapsed: np.ndarray = elapsed
+        self.wall: np.ndarray = wall
+        self.metrics: Dict[str, np.ndarray] = metrics
+
+    def __len__(self) -> int:
+        return len(self.elapsed)
+
+
+
+def parse_csv_chunk(data: bytes, titles: List[str]) -> CSVChunk:
+    '''
+    Parses complete rows of data.csv with a single numpy call: after turning every separator into a comma,
+    the chunk is just comma-separated numbers with a fixed count per row.
+    Chunks with quoted fields, e.g. elapsed times of more than 999 days with a thousands separator, are parsed row by row,
+    like chunks with empty or non-numeric fields and the files with LABEL_COLUMNS, e.g. processes.csv .
+    Only the metric columns are parsed there: a field that isn't a number is NaN, which leaves out the columns of text,
+    while the rows whose times can't be parsed, e.g. a partially written last row, are skipped.
+    '''
+
+    widths: List[int] = [TIME_COLUMNS.get(title, 1) for title in titles]
+    metric_titles: List[str] = [title for title in titles if title not in TIME_COLUMNS and title not in LABEL_COLUMNS]
+    columns: Dict[str, np.ndarray] = {}
+    values: np.ndarray|None = None
+    if b'"' not in data and len(metric_titles) + sum(title in TIME_COLUMNS for title in titles) == len(titles):
+        text: bytes = data.replace(b" day(s) ", b",").translate(TRANSLATION, b"\r").rstrip(b",")
+        try:
+            values = np.fromstring(text, dtype=np.float64, sep=",") if text else np.empty(0)
+        except ValueError:
+            values = None
+        # numpy 1.x stops at a field that isn't a number instead of raising, so the numbers have to add up to the rows.
+        rows: int = data.count(b"\n") + (not data.endswith(b"\n"))
+        if values is not None and values.size != rows * sum(widths):
+            values = None
+    count: int = 0
+    if values is not None:
+        values = values.reshape(-1, sum(widths))
+        count = len(values)
+        offset: int = 0
+        for title, width in zip(titles, widths):
+            columns[title] = values[:, offset:offset + width]
+            offset += width
+    else:
+        times: Dict[str, List[List[float]]] = {title: [] for title in titles if title in TIME_COLUMNS}
+        fields: Dict[str, List[float]] = {title: [] for title in metric_titles}
+        for row in csv.reader(data.decode("utf-8").splitlines()):
+            if len(row) != len(titles):
+                continue
+            parts: Dict[str, List[float]] = {}
+            try:
+                for title, value in zip(titles, row):
+                    if title == "elapsed_time":
+                        parts[title] = [0, 0, 0, parse_elapsed_time(value)]
+                    elif title in TIME_COLUMNS:
+                        parts[title] = [float(part) for part in value.replace(":", "-").split("-")]
+            except ValueError:
+                continue
+            if any(len(parts[title]) != TIME_COLUMNS[title] for title in parts):
+                continue
+            count += 1
+            for title in parts:
+                times[title].append(parts[title])
+            for title, value in zip(titles, row):
+                if title in fields:
+                    fields[title].append(_number(value))
+        for title, parsed in times.items():
+            columns[title] = np.array(parsed, dtype=np.float64).reshape(-1, TIME_COLUMNS[title])
+        for title, parsed in fields.items():
+            columns[title] = np.array(parsed, dtype=np.float64).reshape(-1, 1)
+
+    elapsed: np.ndarray = np.zeros(count)
+    if "elapsed_time" in columns:
+        parts = columns["elapsed_time"]
+        elapsed = parts[:, 0] * 86400 + parts[:, 1] * 3600 + parts[:, 2] * 60 + parts[:, 3]
+    wall: np.ndarray = elapsed.copy()
+    if "date" in columns and "time" in columns:
+        date = columns["date"].astype(np.int64)
+        clock = columns["time"]
+        wall = days_from_civil(date[:, 2], date[:, 1], date[:, 0]) * 86400.0 + clock[:, 0] * 3600 + clock[:, 1] * 60 + clock[:, 2]
+    metrics: Dict[str, np.ndarray] = {title: columns[title][:, 0] for title in metric_titles}
+    return CSVChunk(elapsed, wall, metrics)
+
+
+
+def _number(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+
+def read_csv_chunks(path: str, chunk_bytes: int, workers: int = 1) -> Iterator[CSVChunk]:
+    '''
+    Reads data.csv (or a rotated, gzip or zstd compressed segment of it) in chunks of complete rows,
+    so the memory it takes doesn't depend on the size of the file.
+    With more than one worker the chunks are parsed in a process pool, at most two chunks per worker ahead
+    of the one that is returned next, and still returned in order.
+    '''
+
+    if workers <= 1:
+        for titles, data in _csv_blocks(path, chunk_bytes):
+            yield parse_csv_chunk(data, titles)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        pending: Deque[Future] = deque()
+        for titles, data in _csv_blocks(path, chunk_bytes):
+            pending.append(executor.submit(parse_csv_chunk, data, titles))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+
+def _csv_blocks(path: str, chunk_bytes: int) -> Iterator[Tuple[List[str], bytes]]:
+    '''
+    Yields the titles of the file together with each block of about "chunk_bytes" bytes that ends at a line ending.
+    '''
+
+    with _open_rows(path) as file:
+        titles: List[str] = next(csv.reader([file.readline().decode("utf-8")]))
+        remainder: bytes = b""
+        while True:
+            block: bytes = file.read(chunk_bytes)
+            if not block and not remainder:
+                return
+            data: bytes = remainder + block
+            if block:
+                cut: int = data.rfind(b"\n") + 1
+                data, remainder = data[:cut], data[cut:]
+            else:
+                remainder = b""
+            if data.strip():
+                yield titles, data
+
+
+
+def read_store_chunks(path: str, chunk_records: int) -> Iterator[CSVChunk]:
+    '''
+    Reads data.bin in chunks through numpy.memmap, converting the bytes to MB like in data.csv .
+    '''
+
+    with SampleStoreReader(path) as reader:
+        kinds: str = reader.header["format"].lstrip("<=")
+        dtype = np.dtype([(name, NUMPY_TYPES[kind]) for name, kind in zip(reader.columns, kinds)])
+        offset, length, start_time = reader.offset, len(reader), reader.header["start_time"]
+    if not length:
+        return
+    records = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(length,))
+    # The wall clock time at which monitoring has started, as local time seconds since 01-01-1970 like the ones parsed from data.csv .
+    local_start: float = (datetime.datetime.fromtimestamp(start_time) - datetime.datetime(1970, 1, 1)).total_seconds()
+    for start in range(0, length, chunk_records):
+        chunk = records[start:start + chunk_records]
+        elapsed: np.ndarray = chunk["elapsed"].astype(np.float64)
+        metrics: Dict[str, np.ndarray] = {}
+        for name in reader.columns:
+            if name == "elapsed":
+                continue
+            values: np.ndarray = chunk[name].astype(np.float64)
+            metrics[name] = np.round(values / (1024 * 1024), 2) if name in BYTE_COLUMNS else values
+        yield CSVChunk(elapsed, local_start + elapsed, metrics)
+    del records
+
+
+
+class MetricSummary:
+    '''
+    Streaming statistics of a single metric: count, min, max and the time of the peak, the mean and the standard deviation
+    merged chunk by chunk, and the percentiles through a QuantileSketch.
+    '''
+
+    def __init__(self) -> None:
+        self.count: int = 0
+        self.mean: float = 0.0
+        self.m2: float = 0.0
+        self.minimum: float = math.inf
+        self.maximum: float = -math.inf
+        self.peak_wall: float = math.nan
+        self.sketch = QuantileSketch()
+
+    def add(self, values: np.ndarray, wall: np.ndarray) -> None:
+        count: int = len(values)
+        mean: float = float(values.mean())
+        m2: float = float(((values - mean) ** 2).sum())
+        # Merges the mean and the sum of squared differences of the chunk (Chan et al.), which is numerically stable.
+        total: int = self.count + count
+        delta: float = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+        self.minimum = min(self.minimum, float(values.min()))
+        peak: int = int(values.argmax())
+        if values[peak] > self.maximum:
+            self.maximum = float(values[peak])
+            self.peak_wall = float(wall[peak])
+
+        positive: np.ndarray = values[values > 0]
+        if len(positive):
+            indexes: np.ndarray = np.ceil(np.log(positive) / self.sketch.log_gamma).astype(np.int64)
+            lowest: int = int(indexes.min())
+            counts: np.ndarray = np.bincount(indexes - lowest)
+            present: np.ndarray = np.flatnonzero(counts)
+            self.sketch.merge(dict(zip((present + lowest).tolist(), counts[present].tolist())), count - len(positive))
+        else:
+            self.sketch.merge({}, count)
+
+    def summary(self) -> Dict[str, float|str]:
+        result: Dict[str, float|str] = {
+            "min": round(self.minimum, 2),
+            "mean": round(self.mean, 2),
+            "std": round(math.sqrt(self.m2 / self.count), 2),
+            "max": round(self.maximum, 2),
+            "peak_time": format_wall(self.peak_wall)
+        }
+        for percentile in PERCENTILES:
+            # The sketch returns the middle of a bin, which can be slightly outside of the real range.
+            estimate: float = min(max(self.sketch.quantile(percentile / 100), self.minimum), self.maximum)
+            result[f"p{percentile}"] = round(estimate, 2)
+        return result
+
+
+
+class LeakSlope:
+    '''
+    Least squares linear regression of a metric over the elapsed time in hours, accumulated from sums
+    so that it takes constant memory. The slope is the growth per hour, r2 tells how linear the growth is.
+    '''
+
+    def __init__(self) -> None:
+        self.n: int = 0
+        self.x0: float|None = None
+        self.sx: float = 0.0
+        self.sy: float = 0.0
+        self.sxx: float = 0.0
+        self.sxy: float = 0.0
+        self.syy: float = 0.0
+
+    def add(self, elapsed: np.ndarray, values: np.ndarray) -> None:
+        if self.x0 is None:
+            self.x0 = float(elapsed[0])
+        x: np.ndarray = (elapsed - self.x0) / 3600
+        self.n += len(x)
+        self.sx += float(x.sum())
+        self.sy += float(values.sum())
+        self.sxx += float(x @ x)
+        self.sxy += float(x @ values)
+        self.syy += float(values @ values)
+
+    def summary(self) -> Dict[str, float]:
+        denominator: float = self.n * self.sxx - self.sx * self.sx
+        if self.n < 2 or denominator <= 0:
+            return {"slope_per_hour": 0.0, "r2": 0.0}
+        slope: float = (self.n * self.sxy - self.sx * self.sy) / denominator
+        variance: float = self.n * self.syy - self.sy * self.sy
+        r2: float = (self.n * self.sxy - self.sx * self.sy) ** 2 / (denominator * variance) if variance > 0 else 0.0
+        return {"slope_per_hour": round(slope, 4), "r2": round(r2, 4)}
+
+
+
+def format_wall(wall: float) -> str:
+    if math.isnan(wall):
+        return ""
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=wall)).strftime("%d-%m-%Y %H:%M:%S.%f")[:-3]
+
+
+
+def make_report(paths: List[str], chunk_bytes: int = 16 * 1024 * 1024, workers: int = 1) -> Dict[str, object]:
+    '''
+    Computes the summary of one or more data files of the same run, e.g. the rotated segments of data.csv in order.
+    '''
+
+    metrics: Dict[str, MetricSummary] = {}
+    leaks: Dict[str, LeakSlope] = {}
+    rows: int = 0
+    first: CSVChunk|None = None
+    last: CSVChunk|None = None
+    for path in paths:
+        chunks: Iterator[CSVChunk] = read_store_chunks(path, chunk_bytes // 64) if path.endswith(".bin") else read_csv_chunks(path, chunk_bytes, workers)
+        path_rows: int = 0
+        path_values: int = 0
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            first = first or chunk
+            last = chunk
+            rows += len(chunk)
+            path_rows += len(chunk)
+            for name, values in chunk.metrics.items():
+                wall, elapsed = chunk.wall, chunk.elapsed
+                # The fields that aren't numbers are left out, and so is a column that has none, e.g. one of text.
+                numbers: np.ndarray = ~np.isnan(values)
+                if not numbers.all():
+                    values, wall, elapsed = values[numbers], wall[numbers], elapsed[numbers]
+                    if not len(values):
+                        continue
+                path_values += len(values)
+                metrics.setdefault(name, MetricSummary()).add(values, wall)
+                if name in LEAK_METRICS:
+                    leaks.setdefault(name, LeakSlope()).add(elapsed, values)
+        if path_rows and not path_values:
+            raise ValueError(f'"{path}" has no columns of numbers to report on. Please use data.csv, processes.csv or data.bin .')
+
+    report: Dict[str, object] = {"files": paths, "rows": rows}
+    if rows:
+        report["start"] = format_wall(float(first.wall[0]))
+        report["end"] = format_wall(float(last.wall[-1]))
+        report["duration_hours"] = round((float(last.elapsed[-1]) - float(first.elapsed[0])) / 3600, 3)
+        report["metrics"] = {name: summary.summary() for name, summary in metrics.items()}
+        report["leak_slopes"] = {name: leak.summary() for name, leak in leaks.items()}
+    return report
+
+
+
+def format_report(report: Dict[str, object]) -> str:
+    '''
+    Formats the report as a compact text table.
+    '''
+
+    lines: List[str] = [f'Files: {", ".join(report["files"])}', f'Rows: {report["rows"]}']
+    if not report["rows"]:
+        return "\n".join(lines)
+    lines.append(f'From {report["start"]} to {report["end"]} ({report["duration_hours"]} h)')
+    lines.append("")
+    titles: List[str] = ["min", "mean", "std"] + [f"p{percentile}" for percentile in PERCENTILES] + ["max"]
+    # The extended metric sets have longer names than the base columns.
+    width: int = max([16] + [len(name) + 1 for name in report["metrics"]])
+    lines.append("metric".ljust(width) + "".join("{:>12}".format(title) for title in titles) + "   peak time")
+    for name, summary in report["metrics"].items():
+        lines.append(name.ljust(width) + "".join("{:>12}".format(summary[title]) for title in titles) + "   " + summary["peak_time"])
+    lines.append("")
+    for name, leak in report["leak_slopes"].items():
+        unit: str = " MB" if name in BYTE_COLUMNS else ""
+        lines.append(f'{name} slope: {leak["slope_per_hour"]:+}{unit}/h (r2 {leak["r2"]})')
+    lines.append("Percentiles are estimated with a relative error of 1%.")
+    return "\n".join(lines)
+
+
+
+def report_command(argv: List[str]) -> None:
+    '''
+    Implements the "report" subcommand.
+    '''
+
+    parser = argparse.ArgumentParser(prog="process_monitor_tool.py report",
+                                     description="Summarize data.csv or data.bin: statistics, percentiles, peak times and leak slopes")
+    parser.add_argument("files", type=str, nargs="+", help="data.csv, data.bin or rotated data.csv segments of the same run, in order")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--chunk_size", type=float, default=16, metavar=" ", help="size of the chunks read at once in MB (default: 16)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, metavar=" ",
+                        help="number of processes that parse data.csv chunks in parallel (default: number of CPUs)")
+    args = parser.parse_args(argv)
+    for path in args.files:
+        if not os.path.exists(path):
+            parser.error(f'"{path}" file path does not exist. Please use an appropriate path.')
+    try:
+        report: Dict[str, object] = make_report(args.files, max(1, int(args.chunk_size * 1024 * 1024)), max(1, args.workers))
+    except ValueError as e:
+        parser.error(str(e))
+    print(json.dumps(report, indent=1) if args.json else format_report(report))
@@ -0,0 +1,134 @@
+import unittest, os, tempfile, gzip, datetime, importlib.util
+import numpy as np
+from report import make_report, format_report, parse_csv_chunk, parse_elapsed_time
+from sample_store import SampleStore
+
+TITLES = ["elapsed_time", "date", "time", "CPU", "working_set", "private_bytes", "handles", "skipped_ticks"]
+
+def csv_row(n: int) -> str:
+    # One sample per minute, the private bytes grow by 1 MB and the handles by 10 per hour.
+    days, rest = divmod(n * 60, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes = rest // 60
+    return (f"{days} day(s) {hours:02d}:{minutes:02d}:00.000,{1 + days:02d}-06-2022,{hours:02d}:{minutes:02d}:00.000,"
+            f"{n % 10}.5,100.00,{50 + n / 60:.2f},{200 + n // 6},0\r\n")
+
+class TestReport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "data.csv")
+        with open(self.path, "w", newline="", encoding="utf-8") as file:
+            file.write(",".join(TITLES) + "\r\n")
+            for n in range(3000):
+                file.write(csv_row(n))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+
+    def test_csv_report(self):
+        # Small chunks, so rows are split across many chunks.
+        report = make_report([self.path], chunk_bytes=1000)
+        self.assertEqual(report["rows"], 3000)
+        self.assertEqual(report["start"], "01-06-2022 00:00:00.000")
+        self.assertEqual(report["end"], "03-06-2022 01:59:00.000")
+        self.assertEqual(report["duration_hours"], 49.983)
+        cpu = report["metrics"]["CPU"]
+        self.assertEqual((cpu["min"], cpu["max"], cpu["mean"]), (0.5, 9.5, 5.0))
+        self.assertEqual(cpu["peak_time"], "01-06-2022 00:09:00.000")
+        self.assertLessEqual(cpu["p99"], cpu["max"])
+        self.assertAlmostEqual(report["leak_slopes"]["private_bytes"]["slope_per_hour"], 1.0, places=2)
+        self.assertAlmostEqual(report["leak_slopes"]["handles"]["slope_per_hour"], 10.0, delta=0.1)
+        self.assertGreater(report["leak_slopes"]["handles"]["r2"], 0.99)
+        self.assertIn("private_bytes slope: +1.0", format_report(report))
+
+
+
+    def test_chunking_compression_and_workers_give_the_same_report(self):
+        with open(self.path, "rb") as source, gzip.open(self.path + ".gz", "wb") as target:
+            target.write(source.read())
+        expected = make_report([self.path])["metrics"]
+        self.assertEqual(expected, make_report([self.path + ".gz"], chunk_bytes=777)["metrics"])
+        self.assertEqual(expected, make_report([self.path], chunk_bytes=5000, workers=2)["metrics"])
+
+
+
+    def test_quoted_elapsed_time(self):
+        data = b'"1,234 day(s) 01:00:00.500",01-06-2022,12:00:00.000,1.5,2.00,3.00,4,0\r\n'
+        chunk = parse_csv_chunk(data, TITLES)
+        self.assertEqual(chunk.elapsed[0], parse_elapsed_time("1,234 day(s) 01:00:00.500"))
+        self.assertEqual(chunk.elapsed[0], 1234 * 86400 + 3600.5)
+        self.assertEqual(chunk.metrics["handles"][0], 4)
+
+
+
+    def test_fields_that_are_not_numbers(self):
+        rows = [csv_row(n).encode() for n in range(4)]
+        # An empty field, a field that isn't a number and a partially written last row make numpy's parser fail or stop early,
+        # so the chunk is parsed row by row: the fields that aren't numbers are NaN and only the complete rows are kept.
+        data = rows[0] + rows[1].replace(b",0\r\n", b",\r\n") + rows[2].replace(b"100.00", b"n/a") + rows[3] + rows[3][:30]
+        chunk = parse_csv_chunk(data, TITLES)
+        self.assertEqual(chunk.metrics["CPU"].tolist(), [0.5, 1.5, 2.5, 3.5])
+        self.assertEqual(np.isnan(chunk.metrics["working_set"]).tolist(), [False, False, True, False])
+        self.assertEqual(np.isnan(chunk.metrics["skipped_ticks"]).tolist(), [False, True, False, False])
+        self.assertEqual(len(parse_csv_chunk(b"\r\n", TITLES)), 0)
+
+
+
+    def test_processes_csv(self):
+        path = os.path.join(self.directory.name, "processes.csv")
+        titles = ["elapsed_time", "date", "time", "pid", "name", "CPU", "working_set", "private_bytes", "handles"]
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            file.write(",".join(titles) + "\r\n")
+            for n in range(100):
+                time_columns, metrics = csv_row(n).rsplit(",", 5)[0], csv_row(n).rsplit(",", 5)[1:5]
+                file.write(",".join([time_columns, str(1000 + n % 2), "worker.exe"] + metrics) + "\r\n")
+        report = make_report([path], chunk_bytes=1000)
+        self.assertEqual(report["rows"], 100)
+        # The pid and name columns are no metrics.
+        self.assertEqual(list(report["metrics"]), ["CPU", "working_set", "private_bytes", "handles"])
+        self.assertEqual(report["metrics"]["CPU"]["max"], 9.5)
+
+        # A file without any columns of numbers is an error instead of an empty report.
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            file.write("pid,name,state\r\n1000,worker.exe,running\r\n")
+        with self.assertRaisesRegex(ValueError, "no columns of numbers"):
+            make_report([path])
+
+
+
+    @unittest.skipUnless(importlib.util.find_spec("zstandard"), "zstd needs the zstandard package")
+    def test_zstd_segment(self):
+        import zstandard
+        with open(self.path, "rb") as source, open(self.path + ".zst", "wb") as target:
+            zstandard.ZstdCompressor().copy_stream(source, target)
+        self.assertEqual(make_report([self.path])["metrics"], make_report([self.path + ".zst"], chunk_bytes=777)["metrics"])
+
+
+
+    def test_binary_store_report(self):
+        path = os.path.join(self.directory.name, "data.bin")
+        store = SampleStore(path, start_time=datetime.datetime(2022, 6, 1, 12).timestamp(), interval=1)
+        for n in range(7200):
+            store.write((float(n), 2.0, 100 * 1024 * 1024, (10 + n // 360) * 1024 * 1024, 100, 0))
+        store.close()
+        report = make_report([path], chunk_bytes=64 * 100)
+        self.assertEqual(report["rows"], 7200)
+        self.assertEqual(report["start"], "01-06-2022 12:00:00.000")
+        self.assertEqual(report["metrics"]["working_set"]["max"], 100.0)
+        self.assertAlmostEqual(report["leak_slopes"]["private_bytes"]["slope_per_hour"], 10.0, delta=0.1)
+
+
+
+    def test_empty_file(self):
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write(",".join(TITLES) + "\n")
+        report = make_report([self.path])
+        self.assertEqual(report["rows"], 0)
+        self.assertNotIn("metrics", report)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+import datetime, math, os, time
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+from csv_writer import BufferedCSVWriter
+from options import TIERS
+
+# The bucket boundaries are counted from here in local wall clock time.
+EPOCH: datetime.datetime = datetime.datetime(1970, 1, 1)
+
+# Metrics that get rolled up, in the units of the sampler. The byte metrics are written in MB like in data.csv .
+METRICS: List[str] = ["CPU", "working_set", "private_bytes", "handles"]
+BYTE_METRICS: List[str] = ["working_set", "private_bytes"]
+
+
+class QuantileSketch:
+    '''
+    Estimates quantiles of positive values in constant memory with a relative error of about "accuracy".
+    Values are counted in logarithmic bins, so the number of bins only depends on the range of the values,
+    e.g. less than 2,300 bins cover everything from 1 byte to 16 EB at 1% accuracy.
+    '''
+
+    __slots__ = ("gamma", "log_gamma", "bins", "zeros", "count")
+
+    def __init__(self, accuracy: float = 0.01) -> None:
+        self.gamma: float = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma: float = math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.zeros: int = 0
+        self.count: int = 0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        index: int = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + 1
+
+    def merge(self, bins: Dict[int, int], zeros: int = 0) -> None:
+        '''
+        Adds the counts of bins that were computed elsewhere, e.g. for a whole array of values at once.
+        '''
+
+        for index, count in bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+            self.count += count
+        self.zeros += zeros
+        self.count += zeros
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return math.nan
+        rank: float = q * (self.count - 1)
+        seen: int = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+
+class MetricRollup:
+    '''
+    Streaming min/max/mean/last of a metric within a single bucket, and optionally the p95 through a QuantileSketch.
+    '''
+
+    __slots__ = ("minimum", "maximum", "total", "count", "last", "sketch")
+
+    def __init__(self, p95: bool = False) -> None:
+        self.minimum: float = math.inf
+        self.maximum: float = -math.inf
+        self.total: float = 0.0
+        self.count: int = 0
+        self.last: float = math.nan
+        self.sketch: QuantileSketch|None = QuantileSketch() if p95 else None
+
+    def add(self, value: float) -> None:
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        self.total += value
+        self.count += 1
+        self.last = value
+        if self.sketch is not None:
+            self.sketch.add(value)
+
+    def row(self, name: str, scale: float) -> Dict[str, float]:
+        row: Dict[str, float] = {
+            f"{name}_min": round(self.minimum / scale, 2),
+            f"{name}_max": round(self.maximum / scale, 2),
+            f"{name}_mean": round(self.total / self.count / scale, 2),
+            f"{name}_last": round(self.last / scale, 2)
+        }
+        if self.sketch is not None:
+            row[f"{name}_p95"] = round(self.sketch.quantile(0.95) / scale, 2)
+        return row
+
+
+
+class RollupTier:
+    '''
+    Aggregates the samples of the current bucket of a tier (e.g. the current minute) and writes a row
+    for the bucket to its own file as soon as a sample of the next bucket arrives.
+    Buckets are aligned to the local wall clock, so the daily rollup starts at midnight also after a daylight saving
+    time change, which makes that day 23 or 25 hours long. The hour that the clock repeats goes into a single bucket.
+    '''
+
+    def __init__(self, name: str, seconds: int, path: str, metrics: List[str], p95: bool, **writer_options) -> None:
+        self.name: str = name
+        self.seconds: int = seconds
+        self.metrics: List[str] = metrics
+        self.p95: bool = p95
+        titles: List[str] = ["period_start", "samples"]
+        for metric in metrics:
+            titles += [f"{metric}_{stat}" for stat in ["min", "max", "mean", "last"] + (["p95"] if p95 else [])]
+        self.writer = BufferedCSVWriter(path, titles, **writer_options)
+        self.bucket: int|None = None
+        self.rollups: Dict[str, MetricRollup] = {}
+        self.rows_written: int = 0
+
+    def add(self, local_time: float, values: Dict[str, float|int]) -> None:
+        '''
+        Adds a sample taken at "local_time", the local wall clock time in seconds since EPOCH.
+        '''
+
+        bucket: int = int(local_time // self.seconds)
+        if bucket != self.bucket:
+            self.emit()
+            self.bucket = bucket
+            self.rollups = {metric: MetricRollup(self.p95) for metric in self.metrics}
+        for metric in self.metrics:
+            self.rollups[metric].add(values[metric])
+
+    def emit(self) -> None:
+        '''
+        Writes the row of the current bucket, if it has any samples.
+        '''
+
+        if self.bucket is None or not self.rollups[self.metrics[0]].count:
+            return
+        start: datetime.datetime = EPOCH + datetime.timedelta(seconds=self.bucket * self.seconds)
+        row: Dict[str, str|float|int] = {"period_start": start.strftime("%d-%m-%Y %H:%M:%S"),
+                                         "samples": self.rollups[self.metrics[0]].count}
+        for metric in self.metrics:
+            row.update(self.rollups[metric].row(metric, 1024 * 1024 if metric in BYTE_METRICS else 1))
+        self.writer.write(row)
+        self.rows_written += 1
+        self.bucket = None
+
+    def close(self) -> None:
+        '''
+        Writes the partial bucket, so the last minutes of a run are not lost, and closes the file.
+        '''
+
+        self.emit()
+        self.writer.close()
+
+
+
+class RollupEngine:
+    '''
+    Feeds every sample to the rollup tiers (rollup_minute.csv, rollup_hour.csv, rollup_day.csv)
+    and keeps the most recent raw samples in a fixed-size ring buffer, which window() reads, e.g. for sparklines.
+    The memory it takes is constant no matter how long monitoring runs.
+    '''
+
+    def __init__(self, directory: str, tiers: List[str] = list(TIERS), metrics: List[str] = METRICS,
+                 p95: bool = False, ring_size: int = 3600, **writer_options) -> None:
+        self.tiers: List[RollupTier] = [
+            RollupTier(name, TIERS[name], os.path.join(directory, f"rollup_{name}.csv"), metrics, p95, **writer_options)
+            for name in tiers
+        ]
+        # The timestamps and values of the latest ring_size samples, the oldest first.
+        self.recent: Deque[Tuple[float, Dict[str, float|int]]] = deque(maxlen=ring_size)
+
+    @property
+    def closed(self) -> bool:
+        return all(tier.writer.closed for tier in self.tiers)
+
+    def add(self, timestamp: float, values: Dict[str, float|int]) -> None:
+        '''
+        Adds a sample taken at the "timestamp" wall clock time (seconds since the epoch).
+        '''
+
+        self.recent.append((timestamp, values))
+        # The UTC offset of every sample, as it changes with daylight saving time while monitoring runs.
+        local_time: float = timestamp + time.localtime(timestamp).tm_gmtoff
+        for tier in self.tiers:
+            tier.add(local_time, values)
+
+    def window(self, seconds: float|None = None) -> List[Tuple[float, Dict[str, float|int]]]:
+        '''
+        Returns the raw samples of the ring buffer taken within "seconds" of the latest one, or all of them, the oldest first.
+        '''
+
+        if seconds is None or not self.recent:
+            return list(self.recent)
+        since: float = self.recent[-1][0] - seconds
+        samples: List[Tuple[float, Dict[str, float|int]]] = []
+        # The latest samples are at the end of the buffer, so only the window gets walked.
+        for sample in reversed(self.recent):
+            if sample[0] < since:
+                break
+            samples.append(sample)
+        samples.reverse()
+        return samples
+
+    def close(self) -> None:
+        for tier in self.tiers:
+            tier.close()
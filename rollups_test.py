@@ -0,0 +1,101 @@
+import unittest, os, tempfile, csv, datetime, random, time
+from rollups import RollupEngine, QuantileSketch
+
+def read_rows(path: str) -> list:
+    with open(path, newline='', encoding='utf-8') as csvfile:
+        return list(csv.DictReader(csvfile))
+
+class TestRollups(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+
+    def test_minute_and_hour_rollups(self):
+        engine = RollupEngine(self.directory.name, tiers=["minute", "hour"], ring_size=10)
+        start = datetime.datetime(2022, 6, 1, 12, 0).timestamp()
+        # Two and a half minutes of samples taken every second.
+        for n in range(150):
+            engine.add(start + n, {"CPU": n % 60, "working_set": 1024 * 1024 * (n + 1), "private_bytes": 0, "handles": 100})
+        # The ring buffer keeps the raw values of the latest 10 samples only.
+        self.assertEqual([timestamp - start for timestamp, _ in engine.window()], list(range(140, 150)))
+        self.assertEqual([values["CPU"] for _, values in engine.window(2)], [27, 28, 29])
+        engine.close()
+
+        minutes = read_rows(os.path.join(self.directory.name, "rollup_minute.csv"))
+        self.assertEqual(len(minutes), 3)
+        self.assertEqual(minutes[0]["period_start"], "01-06-2022 12:00:00")
+        self.assertEqual(minutes[0]["samples"], "60")
+        self.assertEqual(minutes[0]["CPU_min"], "0.0")
+        self.assertEqual(minutes[0]["CPU_max"], "59.0")
+        self.assertEqual(minutes[0]["CPU_mean"], "29.5")
+        self.assertEqual(minutes[1]["working_set_last"], "120.0")
+        # The partial last minute is written when the engine gets closed.
+        self.assertEqual(minutes[2]["samples"], "30")
+
+        hours = read_rows(os.path.join(self.directory.name, "rollup_hour.csv"))
+        self.assertEqual(len(hours), 1)
+        self.assertEqual(hours[0]["samples"], "150")
+        self.assertEqual(hours[0]["working_set_max"], "150.0")
+        self.assertNotIn("CPU_p95", hours[0])
+
+
+
+    @unittest.skipUnless(hasattr(time, "tzset"), "needs time.tzset")
+    def test_daylight_saving_time(self):
+        timezone = os.environ.get("TZ")
+        os.environ["TZ"] = "Europe/Berlin"
+        time.tzset()
+        try:
+            engine = RollupEngine(self.directory.name, tiers=["hour", "day"])
+            # A sample every minute from 26-10-2024 12:00 on, while the clock goes back from 03:00 to 02:00 on the 27th.
+            start = datetime.datetime(2024, 10, 26, 12, 0).timestamp()
+            for n in range(48 * 60):
+                engine.add(start + 60 * n, {"CPU": 1, "working_set": 0, "private_bytes": 0, "handles": n})
+            engine.close()
+        finally:
+            if timezone is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = timezone
+            time.tzset()
+
+        days = read_rows(os.path.join(self.directory.name, "rollup_day.csv"))
+        self.assertEqual([day["period_start"] for day in days], ["26-10-2024 00:00:00", "27-10-2024 00:00:00", "28-10-2024 00:00:00"])
+        # The day of the change is 25 hours long.
+        self.assertEqual([day["samples"] for day in days], [str(12 * 60), str(25 * 60), str(11 * 60)])
+        hours = read_rows(os.path.join(self.directory.name, "rollup_hour.csv"))
+        self.assertTrue(all(hour["period_start"].endswith(":00:00") for hour in hours))
+        self.assertEqual(len(hours), 47)
+        self.assertEqual([hour["samples"] for hour in hours if hour["period_start"] == "27-10-2024 02:00:00"], ["120"])
+
+
+
+    def test_p95(self):
+        engine = RollupEngine(self.directory.name, tiers=["day"], p95=True)
+        start = datetime.datetime(2022, 6, 1, 12, 0).timestamp()
+        for n in range(1, 1001):
+            engine.add(start + n, {"CPU": n / 10, "working_set": 0, "private_bytes": 0, "handles": n})
+        engine.close()
+        day = read_rows(os.path.join(self.directory.name, "rollup_day.csv"))[0]
+        self.assertAlmostEqual(float(day["CPU_p95"]), 95.0, delta=95.0 * 0.02)
+        self.assertAlmostEqual(float(day["handles_p95"]), 950, delta=950 * 0.02)
+        self.assertEqual(day["working_set_p95"], "0.0")
+
+
+
+    def test_sketch_memory_is_bounded(self):
+        sketch = QuantileSketch()
+        generator = random.Random(1)
+        for _ in range(100000):
+            sketch.add(generator.uniform(1, 1e9))
+        self.assertLess(len(sketch.bins), 1100)
+        self.assertAlmostEqual(sketch.quantile(0.5), 5e8, delta=5e8 * 0.05)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+import datetime, json, os, re, sys, threading, time
+from typing import TYPE_CHECKING, Callable, Dict, List, Set
+from csv_writer import BufferedCSVWriter
+from options import COMPRESSIONS, ROTATE_PERIODS
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+# File extensions of the compressed segments.
+EXTENSIONS: Dict[str, str] = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def compress_file(path: str, compression: str) -> str:
+    '''
+    Compresses a closed segment next to itself, removes the uncompressed file and returns the path of the compressed one.
+    zstd compression needs the optional zstandard package.
+    '''
+
+    if compression == "none":
+        return path
+    target: str = path + EXTENSIONS[compression]
+    try:
+        with open(path, "rb") as source:
+            if compression == "gzip":
+                # gzip and shutil, which imports bz2 and lzma, are only needed once a segment gets compressed.
+                import gzip, shutil
+                with gzip.open(target, "wb") as destination:
+                    shutil.copyfileobj(source, destination, 1024 * 1024)
+            else:
+                import zstandard
+                with open(target, "wb") as destination:
+                    zstandard.ZstdCompressor().copy_stream(source, destination)
+    except BaseException:
+        # A half written file is removed, so only the uncompressed segment is left.
+        if os.path.isfile(target):
+            os.remove(target)
+        raise
+    os.remove(path)
+    return target
+
+
+
+def check_compression(compression: str) -> None:
+    '''
+    Raises an error if the compression is unknown or its optional package is not installed.
+    '''
+
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression: "{compression}". Please use one of: {", ".join(COMPRESSIONS)}.')
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ModuleNotFoundError('zstd compression needs the zstandard package. Please install it with "pip install zstandard" or use gzip.')
+
+
+
+class RotatingCSVWriter:
+    '''
+    Writes data.csv like a BufferedCSVWriter, but closes it and starts a new one when it grows over max_bytes
+    or when a new wall clock period (hour, day, week or month) begins. The closed segments get renamed to data.00001.csv,
+    data.00002.csv... and get compressed in a background thread, so the sampling loop never waits for the compression.
+    manifest.json lists the closed segments with their time ranges, the active segment is always data.csv .
+    The segments of earlier runs in the same directory stay listed and the numbering goes on from the highest of them.
+    Retention limits delete the oldest segments when there are more than retain_segments of them
+    or when they are older than retain_days. A segment that fails to be compressed or deleted stays listed as it is,
+    and the error is printed to stderr and kept in "failures".
+    '''
+
+    def __init__(self, path: str, fieldnames: List[str], max_bytes: int|None = None, period: str|None = None,
+                 compression: str = "gzip", retain_segments: int|None = None, retain_days: float|None = None,
+                 manifest_path: str|None = None, now: Callable[[], datetime.datetime] = datetime.datetime.now, **writer_options) -> None:
+        if period is not None and period not in ROTATE_PERIODS:
+            raise ValueError(f'Unknown rotation period: "{period}". Please use one of: {", ".join(ROTATE_PERIODS)}.')
+        check_compression(compression)
+        self.path: str = path
+        self.fieldnames: List[str] = fieldnames
+        self.max_bytes: int|None = max_bytes
+        self.period: str|None = period
+        self.compression: str = compression
+        self.retain_segments: int|None = retain_segments
+        self.retain_days: float|None = retain_days
+        self.manifest_path: str = manifest_path or os.path.join(os.path.dirname(path), "manifest.json")
+        self.now: Callable[[], datetime.datetime] = now
+        self.writer_options = writer_options
+        self.lock = threading.Lock()
+        # concurrent.futures and the time index are only imported once rotation is used, not with the options of the command line.
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="data.csv compression")
+        self.manifest: Dict[str, object] = {"active": os.path.basename(path), "segments": self._existing_segments()}
+        self.next_index: int = max([segment["index"] for segment in self.manifest["segments"]], default=0) + 1
+        self.rotations: int = 0
+        self.failures: List[str] = []
+        self._open_segment()
+        self._write_manifest()
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.closed
+
+    def _existing_segments(self) -> List[Dict[str, object]]:
+        '''
+        Returns the segments of earlier runs, so they aren't overwritten and the retention limits and the queries still cover them:
+        the ones in manifest.json that still exist and, by their file names, the ones that are missing from it, e.g. after a crash.
+        '''
+
+        directory: str = os.path.dirname(self.path)
+        segments: List[Dict[str, object]] = []
+        try:
+            with open(self.manifest_path) as jsonfile:
+                for segment in json.load(jsonfile)["segments"]:
+                    if isinstance(segment["index"], int) and os.path.exists(os.path.join(directory, segment["file"])):
+                        segments.append(segment)
+        except (OSError, ValueError, KeyError, TypeError):
+            segments = []
+        listed: Set[int] = {segment["index"] for segment in segments}
+        root, extension = os.path.splitext(os.path.basename(self.path))
+        pattern = re.compile(re.escape(root) + r"\.(\d{5,})" + re.escape(extension) + r"(\.gz|\.zst)?$")
+        for name in sorted(os.listdir(directory or ".")):
+            match = pattern.match(name)
+            if match is None or int(match.group(1)) in listed or not os.path.isfile(os.path.join(directory, name)):
+                continue
+            listed.add(int(match.group(1)))
+            compression: str = {".gz": "gzip", ".zst": "zstd"}.get(match.group(2), "none")
+            segments.append({"index": int(match.group(1)), "file": name, "closed_at": os.path.getmtime(os.path.join(directory, name)),
+                             "compression": compression})
+        return sorted(segments, key=lambda segment: segment["index"])
+
+    def _open_segment(self) -> None:
+        self.writer = BufferedCSVWriter(self.path, self.fieldnames, **self.writer_options)
+        self.segment_key: str|None = self.now().strftime(ROTATE_PERIODS[self.period]) if self.period else None
+        self.checked_flushes: int = self.writer.flushes
+        self.first_row: Dict[str, str|float|int]|None = None
+        self.last_row: Dict[str, str|float|int]|None = None
+        self.rows: int = 0
+
+    def _write_manifest(self) -> None:
+        '''
+        Replaces manifest.json atomically, so a reader never sees a partially written manifest.
+        '''
+
+        with self.lock:
+            temporary: str = self.manifest_path + ".tmp"
+            with open(temporary, "w") as jsonfile:
+                json.dump(self.manifest, jsonfile, indent=1)
+            os.replace(temporary, self.manifest_path)
+
+    def _should_rotate(self) -> bool:
+        if self.period and self.now().strftime(ROTATE_PERIODS[self.period]) != self.segment_key:
+            return True
+        # The size is only checked after the buffered rows have been flushed, so no extra syscall is made for every row.
+        if self.max_bytes and self.writer.flushes != self.checked_flushes:
+            self.checked_flushes = self.writer.flushes
+            return os.fstat(self.writer.file.fileno()).st_size >= self.max_bytes
+        return False
+
+    def write(self, row: Dict[str, str|float|int]) -> None:
+        if self.rows and self._should_rotate():
+            self.rotate()
+        if self.first_row is None:
+            self.first_row = row
+        self.last_row = row
+        self.rows += 1
+        self.writer.write(row)
+
+    def flush(self) -> None:
+        self.writer.flush()
+
+    def rotate(self) -> None:
+        '''
+        Closes the active segment, renames it and hands it over to the background thread for compression.
+        '''
+
+        from time_index import index_path
+        self.writer.close()
+        self.rotations += 1
+        segments: List[Dict[str, object]] = self.manifest["segments"]
+        index: int = self.next_index
+        self.next_index += 1
+        root, extension = os.path.splitext(self.path)
+        closed_path: str = f"{root}.{index:05d}{extension}"
+        os.replace(self.path, closed_path)
+        # The time index of a segment only stays useful if the segment isn't compressed, since it holds byte offsets.
+        # Compressed segments are skipped by the time ranges in manifest.json instead.
+        if os.path.exists(index_path(self.path)):
+            if self.compression == "none":
+                os.replace(index_path(self.path), index_path(closed_path))
+            else:
+                os.remove(index_path(self.path))
+        segment: Dict[str, object] = {
+            "index": index,
+            "file": os.path.basename(closed_path),
+            "first": f'{self.first_row.get("date", "")} {self.first_row.get("time", "")}'.strip(),
+            "last": f'{self.last_row.get("date", "")} {self.last_row.get("time", "")}'.strip(),
+            "first_elapsed_time": self.first_row.get("elapsed_time"),
+            "last_elapsed_time": self.last_row.get("elapsed_time"),
+            "rows": self.rows,
+            "closed_at": time.time(),
+            "compression": "none"
+        }
+        with self.lock:
+            segments.append(segment)
+        self._write_manifest()
+        self._open_segment()
+        future = self.executor.submit(self._finish_segment, segment, closed_path)
+        future.add_done_callback(lambda future: self._report(future, closed_path))
+
+    def _report(self, future: "Future", closed_path: str) -> None:
+        '''
+        Prints the error of the background thread, if the segment couldn't be compressed or the expired ones deleted.
+        '''
+
+        error: BaseException|None = future.exception()
+        if error is None:
+            return
+        failure: str = f"{os.path.basename(closed_path)}: {type(error).__name__}: {error}"
+        self.failures.append(failure)
+        print(f"\nThe background thread of the rotation of {os.path.basename(self.path)} has failed on {failure}\n", file=sys.stderr)
+
+    def _finish_segment(self, segment: Dict[str, object], closed_path: str) -> None:
+        '''
+        Runs in the background thread: compresses a closed segment and applies the retention limits.
+        '''
+
+        from time_index import index_path
+        # The manifest keeps listing the uncompressed segment until its compressed file is complete.
+        compressed_path: str = compress_file(closed_path, self.compression)
+        with self.lock:
+            segment["file"] = os.path.basename(compressed_path)
+            segment["compression"] = self.compression
+            segments: List[Dict[str, object]] = self.manifest["segments"]
+            expired: List[Dict[str, object]] = []
+            if self.retain_days is not None:
+                expired += [old for old in segments if time.time() - old["closed_at"] > self.retain_days * 24 * 3600]
+            if self.retain_segments is not None and len(segments) - len(expired) > self.retain_segments:
+                remaining: List[Dict[str, object]] = [old for old in segments if old not in expired]
+                expired += remaining[:len(remaining) - self.retain_segments]
+        # Only the segments that are deleted leave the manifest, so one that can't be deleted isn't left behind unlisted.
+        error: OSError|None = None
+        deleted: List[Dict[str, object]] = []
+        for old in expired:
+            try:
+                for expired_path in (old["file"], index_path(old["file"])):
+                    try:
+                        os.remove(os.path.join(os.path.dirname(self.path), expired_path))
+                    except FileNotFoundError:
+                        pass
+            except OSError as e:
+                error = error or e
+                continue
+            deleted.append(old)
+        with self.lock:
+            for old in deleted:
+                segments.remove(old)
+        self._write_manifest()
+        if error is not None:
+            raise error
+
+    def close(self) -> None:
+        '''
+        Drains the active segment and waits for the background thread to finish compressing the closed ones.
+        The errors of the background thread have been printed by then, see "failures".
+        '''
+
+        self.writer.close()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,164 @@
+import unittest, os, tempfile, json, gzip, datetime, time
+from rotation import RotatingCSVWriter
+
+class FakeNow:
+    def __init__(self) -> None:
+        self.value = datetime.datetime(2022, 6, 1, 23, 59)
+
+    def __call__(self) -> datetime.datetime:
+        return self.value
+
+def row(n: int) -> dict:
+    return {"elapsed_time": f"0 day(s) 00:00:{n:02d}.000", "date": "01-06-2022", "time": f"23:59:{n:02d}.000", "CPU": 1.0}
+
+class TestRotatingCSVWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "data.csv")
+        self.titles = ["elapsed_time", "date", "time", "CPU"]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def manifest(self) -> dict:
+        with open(os.path.join(self.directory.name, "manifest.json")) as jsonfile:
+            return json.load(jsonfile)
+
+
+
+    def test_rotation_by_period(self):
+        now = FakeNow()
+        writer = RotatingCSVWriter(self.path, self.titles, period="day", now=now, flush_rows=1)
+        writer.write(row(1))
+        writer.write(row(2))
+        now.value = datetime.datetime(2022, 6, 2, 0, 0)
+        writer.write(row(3))
+        writer.close()
+        segments = self.manifest()["segments"]
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(segments[0]["file"], "data.00001.csv.gz")
+        self.assertEqual(segments[0]["first"], "01-06-2022 23:59:01.000")
+        self.assertEqual(segments[0]["last"], "01-06-2022 23:59:02.000")
+        self.assertEqual(segments[0]["rows"], 2)
+        with gzip.open(os.path.join(self.directory.name, "data.00001.csv.gz"), "rt") as segment:
+            self.assertEqual(len(segment.read().splitlines()), 3)
+        with open(self.path) as active:
+            self.assertEqual(active.read().splitlines()[0], ",".join(self.titles))
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "data.00001.csv")))
+
+
+
+    def test_rotation_by_size_and_retention(self):
+        writer = RotatingCSVWriter(self.path, self.titles, max_bytes=100, retain_segments=2, flush_rows=1)
+        for n in range(20):
+            writer.write(row(n))
+        writer.close()
+        segments = self.manifest()["segments"]
+        self.assertGreater(writer.rotations, 2)
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(segments[-1]["index"], writer.rotations)
+        files = sorted(name for name in os.listdir(self.directory.name) if name.endswith(".gz"))
+        self.assertEqual(files, [segment["file"] for segment in segments])
+
+
+
+    def test_retention_by_age(self):
+        writer = RotatingCSVWriter(self.path, self.titles, max_bytes=1, retain_days=1, compression="none", flush_rows=1)
+        writer.write(row(1))
+        writer.write(row(2))
+        writer.executor.submit(time.sleep, 0).result()
+        self.assertEqual(len(self.manifest()["segments"]), 1)
+        # Makes the first segment two days old, so it gets deleted once the next one is closed.
+        writer.manifest["segments"][0]["closed_at"] -= 2 * 24 * 3600
+        writer.write(row(3))
+        writer.close()
+        self.assertEqual([segment["index"] for segment in self.manifest()["segments"]], [2])
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "data.00001.csv")))
+
+
+
+    def test_time_index_of_segments(self):
+        writer = RotatingCSVWriter(self.path, self.titles, max_bytes=1, compression="none", flush_rows=1, index=True, retain_segments=1)
+        writer.write(row(1))
+        writer.write(row(2))
+        writer.executor.submit(time.sleep, 0).result()
+        # An uncompressed segment keeps its index, which gets deleted together with the segment.
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, "data.00001.csv.idx")))
+        writer.write(row(3))
+        writer.close()
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "data.00001.csv.idx")))
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, "data.00002.csv.idx")))
+        self.assertTrue(os.path.exists(self.path + ".idx"))
+        writer = RotatingCSVWriter(self.path, self.titles, max_bytes=1, flush_rows=1, index=True)
+        writer.write(row(1))
+        writer.write(row(2))
+        writer.close()
+        # The offsets of a compressed segment are of no use.
+        self.assertEqual(sorted(name for name in os.listdir(self.directory.name) if name.endswith(".idx")), ["data.00002.csv.idx", "data.csv.idx"])
+
+
+
+    def test_next_run_continues_the_numbering(self):
+        writer = RotatingCSVWriter(self.path, self.titles, max_bytes=1, flush_rows=1)
+        for n in range(3):
+            writer.write(row(n))
+        writer.close()
+        self.assertEqual([segment["index"] for segment in self.manifest()["segments"]], [1, 2])
+        # A segment that a crashed run has closed but not listed in manifest.json yet.
+        with gzip.open(os.path.join(self.directory.name, "data.00003.csv.gz"), "wt") as segment:
+            segment.write(",".join(self.titles) + "\n")
+
+        writer = RotatingCSVWriter(self.path, self.titles, max_bytes=1, retain_segments=3, flush_rows=1)
+        self.assertEqual([segment["index"] for segment in self.manifest()["segments"]], [1, 2, 3])
+        for n in range(3):
+            writer.write(row(n))
+        writer.close()
+        segments = self.manifest()["segments"]
+        self.assertEqual([segment["file"] for segment in segments], ["data.00003.csv.gz", "data.00004.csv.gz", "data.00005.csv.gz"])
+        self.assertEqual(segments[0]["compression"], "gzip")
+        files = sorted(name for name in os.listdir(self.directory.name) if name.endswith(".gz"))
+        self.assertEqual(files, [segment["file"] for segment in segments])
+        # The retention limit applies to the segments of both runs.
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "data.00001.csv.gz")))
+
+
+
+    def test_failures_of_the_background_thread(self):
+        # A directory in the way of the compressed file makes the compression fail.
+        os.mkdir(os.path.join(self.directory.name, "data.00001.csv.gz"))
+        writer = RotatingCSVWriter(self.path, self.titles, max_bytes=1, flush_rows=1)
+        for n in range(3):
+            writer.write(row(n))
+        writer.close()
+        self.assertEqual(len(writer.failures), 1)
+        self.assertTrue(writer.failures[0].startswith("data.00001.csv: IsADirectoryError"))
+        # The segment that failed stays listed uncompressed, the next one gets compressed.
+        segments = self.manifest()["segments"]
+        self.assertEqual([(segment["file"], segment["compression"]) for segment in segments if segment["index"] == 1],
+                         [("data.00001.csv", "none")])
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, "data.00001.csv")))
+        self.assertEqual(segments[-1]["file"], "data.00002.csv.gz")
+
+        # A segment that can't be deleted by the retention limit stays listed, here the directory that os.remove() fails on.
+        os.remove(os.path.join(self.directory.name, "data.00001.csv"))
+        segments[0]["file"] = "data.00001.csv.gz"
+        with open(os.path.join(self.directory.name, "manifest.json"), "w") as jsonfile:
+            json.dump({"active": "data.csv", "segments": segments}, jsonfile)
+        writer = RotatingCSVWriter(self.path, self.titles, max_bytes=1, retain_segments=1, flush_rows=1)
+        writer.write(row(1))
+        writer.write(row(2))
+        writer.close()
+        self.assertEqual(len(writer.failures), 1)
+        self.assertEqual([segment["file"] for segment in self.manifest()["segments"]], ["data.00001.csv.gz", "data.00003.csv.gz"])
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "data.00002.csv.gz")))
+
+
+
+    def test_invalid_options(self):
+        self.assertRaises(ValueError, RotatingCSVWriter, self.path, self.titles, period="year")
+        self.assertRaises(ValueError, RotatingCSVWriter, self.path, self.titles, compression="rar")
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import argparse, csv, datetime, json, mmap, os, struct, time
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+from csv_writer import FSYNC_POLICIES
+from formatting import calculate_elapsed_time, format_timestamp
+from metrics import Metric
+
+# data.bin starts with the magic bytes, the version of the format and the length of a JSON header,
+# which is followed by the fixed-width records until the end of the file.
+MAGIC: bytes = b"PMTS"
+VERSION: int = 1
+PREFIX = struct.Struct("<4sHI")
+
+# The columns of a record as (name, struct format character).
+# elapsed is the measured monotonic time in seconds since monitoring has started,
+# the memory columns are stored in bytes and converted to MB only when exported.
+COLUMNS: List[Tuple[str, str]] = [
+    ("elapsed", "d"),
+    ("CPU", "f"),
+    ("working_set", "Q"),
+    ("private_bytes", "Q"),
+    ("handles", "I"),
+    ("skipped_ticks", "I")
+]
+
+# Columns that get converted from bytes to MB when exported to .csv .
+BYTE_COLUMNS: List[str] = ["working_set", "private_bytes"]
+
+
+def sample_columns(extended: List[Metric]) -> List[Tuple[str, str]]:
+    '''
+    Returns the columns of an aggregated record, which are the same as the ones of data.bin .
+    '''
+    return COLUMNS[:-1] + [(metric.name, metric.store) for metric in extended] + COLUMNS[-1:]
+
+
+
+def process_columns(extended: List[Metric]) -> List[Tuple[str, str]]:
+    '''
+    Returns the columns of the record of a single process that gets streamed to the collector. Its name is sent apart, only when the PID is new or renamed.
+    '''
+    return [("elapsed", "d"), ("pid", "I")] + COLUMNS[1:-1] + [(metric.name, metric.store) for metric in extended]
+
+
+
+class SampleStore:
+    '''
+    Appends fixed-width numeric records to a binary file. The records are packed into a preallocated block,
+    which gets written to the file when it is full, when flush_interval seconds have passed or when the store gets closed.
+    It can be closed the same way as a BufferedCSVWriter, so both are drained by print_data_csv_location().
+    '''
+
+    def __init__(self, path: str, columns: List[Tuple[str, str]] = COLUMNS, static_data: str = "static_data.json",
+                 start_time: float|None = None, interval: float|None = None, block_records: int = 256,
+                 flush_interval: float = 5.0, fsync: str = "never", clock: Callable[[], float] = time.monotonic) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy: "{fsync}". Please use one of: {", ".join(FSYNC_POLICIES)}.')
+        self.path: str = path
+        self.columns: List[Tuple[str, str]] = columns
+        self.record = struct.Struct("<" + "".join(kind for _, kind in columns))
+        self.block = bytearray(self.record.size * max(1, block_records))
+        self.block_records: int = max(1, block_records)
+        self.pending: int = 0
+        self.records_written: int = 0
+        self.flush_interval: float = flush_interval
+        self.fsync: str = fsync
+        self.clock: Callable[[], float] = clock
+        self.last_flush: float = clock()
+
+        header: Dict[str, object] = {
+            "columns": [name for name, _ in columns],
+            "format": self.record.format,
+            "static_data": static_data,
+            "start_time": time.time() if start_time is None else start_time,
+            "interval": interval
+        }
+        encoded: bytes = json.dumps(header).encode("utf-8")
+        self.file = open(path, "wb")
+        self.file.write(PREFIX.pack(MAGIC, VERSION, len(encoded)) + encoded)
+        self.file.flush()
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def write(self, values: Sequence[float|int]) -> None:
+        '''
+        Packs a record into the current block, in the order of the columns.
+        '''
+
+        self.record.pack_into(self.block, self.pending * self.record.size, *values)
+        self.pending += 1
+        if self.pending == self.block_records or self.clock() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        '''
+        Writes the packed records of the current block to the file and applies the fsync policy.
+        '''
+
+        if self.pending:
+            self.file.write(memoryview(self.block)[:self.pending * self.record.size])
+            self.records_written += self.pending
+            self.pending = 0
+        self.file.flush()
+        if self.fsync == "flush":
+            os.fsync(self.file.fileno())
+        self.last_flush = self.clock()
+
+    def close(self) -> None:
+        '''
+        Drains the current block and closes the file. Calling it more than once is harmless.
+        '''
+
+        if self.file.closed:
+            return
+        self.flush()
+        if self.fsync == "close":
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+
+
+class SampleStoreReader:
+    '''
+    Gives random access to the records of a binary sample store by memory-mapping it.
+    A partially written last record, e.g. after a power loss, is ignored.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = PREFIX.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.map.close()
+            raise ValueError(f'"{path}" is not a sample store file.')
+        if version != VERSION:
+            self.map.close()
+            raise ValueError(f'"{path}" uses version {version} of the sample store format, only version {VERSION} is supported.')
+        self.header: Dict[str, object] = json.loads(self.map[PREFIX.size:PREFIX.size + header_length].decode("utf-8"))
+        self.columns: List[str] = self.header["columns"]
+        self.record = struct.Struct(self.header["format"])
+        self.offset: int = PREFIX.size + header_length
+        self.length: int = (len(self.map) - self.offset) // self.record.size
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> Tuple[float|int, ...]:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("sample store index out of range")
+        return self.record.unpack_from(self.map, self.offset + index * self.record.size)
+
+    def records(self, start: int = 0, stop: int|None = None, chunk_records: int = 4096) -> Iterator[Tuple[float|int, ...]]:
+        '''
+        Iterates over the records from start up to stop. The mapped file is read in chunks,
+        so iterating over a file larger than the memory doesn't load all of it at once.
+        '''
+
+        stop = self.length if stop is None else min(stop, self.length)
+        size: int = self.record.size
+        for chunk_start in range(max(0, start), stop, chunk_records):
+            chunk_stop: int = min(chunk_start + chunk_records, stop)
+            yield from self.record.iter_unpack(self.map[self.offset + chunk_start * size:self.offset + chunk_stop * size])
+
+    def column(self, name: str) -> List[float|int]:
+        '''
+        Returns every value of a single column.
+        '''
+
+        index: int = self.columns.index(name)
+        return [record[index] for record in self.records()]
+
+    def close(self) -> None:
+        self.map.close()
+
+    def __enter__(self) -> "SampleStoreReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+
+def export_csv(store_path: str, csv_path: str) -> int:
+    '''
+    Converts a binary sample store to the layout of data.csv and returns the number of exported rows.
+    The date and time columns are derived from the wall clock time at which monitoring has started plus the elapsed time.
+    '''
+
+    with SampleStoreReader(store_path) as reader:
+        columns: List[str] = [name for name in reader.columns if name != "elapsed"]
+        titles: List[str] = ["elapsed_time", "date", "time"] + columns
+        elapsed_index: int = reader.columns.index("elapsed")
+        start_time: float = reader.header["start_time"]
+        rows: int = 0
+        with open(csv_path, "w", newline="", encoding="utf-8") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(titles)
+            for record in reader.records():
+                elapsed: float = record[elapsed_index]
+                timestamp: Dict[str, str] = format_timestamp(datetime.datetime.fromtimestamp(start_time + elapsed))
+                row: List[str|float|int] = [calculate_elapsed_time(elapsed), timestamp["date"], timestamp["time"]]
+                for name, value in zip(reader.columns, record):
+                    if name == "elapsed":
+                        continue
+                    elif name in BYTE_COLUMNS:
+                        row.append(round(value / (1024 * 1024), 2))
+                    elif isinstance(value, float):
+                        row.append(float("{:.2f}".format(value)))
+                    else:
+                        row.append(value)
+                writer.writerow(row)
+                rows += 1
+    return rows
+
+
+
+def export_command(argv: List[str]) -> None:
+    '''
+    Implements the "export" subcommand, which converts data.bin to the layout of data.csv .
+    '''
+
+    parser = argparse.ArgumentParser(prog="process_monitor_tool.py export", description="Convert a binary sample store (data.bin) to data.csv")
+    parser.add_argument("store", type=str, help="path of the data.bin file")
+    parser.add_argument("-o", "--output", type=str, metavar=" ", help="path of the .csv file (default: data.csv next to data.bin)")
+    args = parser.parse_args(argv)
+    output: str = args.output or os.path.join(os.path.dirname(os.path.abspath(args.store)), "data.csv")
+    rows: int = export_csv(args.store, output)
+    print(f"\n{rows} row(s) were exported to: \n{output}\n")
@@ -0,0 +1,75 @@
+import unittest, os, tempfile, csv, datetime
+from sample_store import SampleStore, SampleStoreReader, export_csv
+
+class TestSampleStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "data.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_samples(self, count: int, **kwargs) -> None:
+        store = SampleStore(self.path, start_time=datetime.datetime(2022, 6, 1, 12).timestamp(), interval=0.5, **kwargs)
+        for n in range(count):
+            store.write((n * 0.5, 1.25, 10 * 1024 * 1024 + n, 20 * 1024 * 1024, 100 + n, 0))
+        store.close()
+
+
+
+    def test_round_trip(self):
+        self.write_samples(1000, block_records=64)
+        with SampleStoreReader(self.path) as reader:
+            self.assertEqual(len(reader), 1000)
+            self.assertEqual(reader.header["static_data"], "static_data.json")
+            self.assertEqual(reader.header["interval"], 0.5)
+            self.assertEqual(reader[0], (0.0, 1.25, 10 * 1024 * 1024, 20 * 1024 * 1024, 100, 0))
+            self.assertEqual(reader[-1][4], 1099)
+            self.assertEqual(reader[500][0], 250.0)
+            self.assertEqual(len(list(reader.records(10, 20))), 10)
+            self.assertEqual(reader.column("handles")[:3], [100, 101, 102])
+            self.assertRaises(IndexError, reader.__getitem__, 1000)
+
+
+
+    def test_block_is_drained_on_close(self):
+        store = SampleStore(self.path, block_records=1000, flush_interval=3600)
+        store.write((0.0, 0.0, 1, 2, 3, 0))
+        with SampleStoreReader(self.path) as reader:
+            self.assertEqual(len(reader), 0)
+        store.close()
+        store.close()
+        with SampleStoreReader(self.path) as reader:
+            self.assertEqual(len(reader), 1)
+
+
+
+    def test_partial_record_is_ignored(self):
+        self.write_samples(3)
+        with open(self.path, "ab") as file:
+            file.write(b"\0" * 5)
+        with SampleStoreReader(self.path) as reader:
+            self.assertEqual(len(reader), 3)
+
+
+
+    def test_not_a_sample_store(self):
+        with open(self.path, "wb") as file:
+            file.write(b"elapsed_time,date,time\n")
+        self.assertRaises(ValueError, SampleStoreReader, self.path)
+
+
+
+    def test_export_csv(self):
+        self.write_samples(3)
+        csv_path = os.path.join(self.directory.name, "data.csv")
+        self.assertEqual(export_csv(self.path, csv_path), 3)
+        with open(csv_path, newline='', encoding='utf-8') as csvfile:
+            rows = list(csv.reader(csvfile))
+        self.assertEqual(rows[0], ["elapsed_time", "date", "time", "CPU", "working_set", "private_bytes", "handles", "skipped_ticks"])
+        self.assertEqual(rows[2], ["0 day(s) 00:00:00.500", "01-06-2022", "12:00:00.500", "1.25", "10.0", "20.0", "101", "0"])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,546 @@
+import errno, os, sys, time, psutil
+from typing import Dict, Iterable, List, Set, Tuple
+from metrics import RateTracker
+from options import SAMPLERS
+
+# Every sampler returns the same keys, so the writers don't need to know which one is used:
+# "working_set" is the working set on Windows and the RSS on Linux,
+# "private_bytes" is the private bytes on Windows and the resident minus the shared pages on Linux,
+# or the exact USS (private clean + private dirty pages) if the /proc sampler is asked for it,
+# "handles" is the number of handles on Windows and the number of open file descriptors elsewhere.
+# The columns of the selected metric sets (see metrics.py) are added to these keys, with the counters already turned into rates.
+
+
+class PsutilSampler:
+    '''
+    Samples processes through psutil, reading all the values of a process in one psutil.Process.oneshot() batch,
+    together with the selected metric sets only. This works on every platform psutil supports and is the fallback of the /proc sampler.
+    Page faults are reported on Windows and macOS only, since psutil doesn't read them on Linux.
+    The CPU usage is the delta of the user + system CPU time between consecutive samples, divided by the number of CPUs.
+    '''
+
+    name: str = "psutil"
+
+    def __init__(self, cpu_count: int, metric_sets: List[str]|None = None) -> None:
+        self.cpu_count: int = cpu_count
+        self.windows: bool = psutil.WINDOWS
+        self.metric_sets: List[str] = metric_sets or []
+        self.rates = RateTracker()
+        # The CPU time of every process at its previous sample and the monotonic time of that sample.
+        self.cpu_times: Dict[int, Tuple[float, float]] = {}
+
+    def track(self, process: psutil.Process, state: Tuple|None = None) -> None:
+        '''
+        Checks that the process can be read. Nothing is primed here, since a process is tracked in the same tick it gets
+        sampled in, and a CPU usage measured over the microseconds in between would be way off.
+        Like the counters of the metric sets, the first sample only primes the CPU usage and reports 0,
+        unless the state of the previous sample is handed over from another sampler, see state().
+        '''
+
+        self.forget(process.pid)
+        process.cpu_times()
+        if state is not None:
+            if state[0] is not None:
+                self.cpu_times[process.pid] = state[0]
+            self.rates.restore(process.pid, state[1:])
+
+    def state(self, pid: int) -> Tuple:
+        '''
+        Returns the CPU time and the counters of the previous sample of a process, which another sampler
+        that takes the process over goes on from, e.g. in another worker process of a sharded sampler.
+        '''
+
+        return (self.cpu_times.get(pid), *self.rates.state(pid))
+
+    def forget(self, pid: int) -> None:
+        self.cpu_times.pop(pid, None)
+        self.rates.forget(pid)
+
+    def _cpu(self, pid: int, cpu_time: float) -> float:
+        now: float = time.monotonic()
+        previous: Tuple[float, float]|None = self.cpu_times.get(pid)
+        self.cpu_times[pid] = (cpu_time, now)
+        if previous is None or now <= previous[1]:
+            return 0.0
+        # The CPU time is read a little before the monotonic time, so a preemption in between, e.g. on a single CPU,
+        # can shorten the measured interval and push a busy process over what all the CPUs together can do.
+        return min(100.0, max(0.0, (cpu_time - previous[0]) / (now - previous[1]) * 100 / self.cpu_count))
+
+    def _extended(self, process: psutil.Process, memory_info, sample: Dict[str, str|float|int]) -> None:
+        '''
+        Adds the columns of the selected metric sets to the sample. A value that can't be read, e.g. the I/O counters
+        of the processes of other users on Linux, is taken as 0 instead of dropping the whole sample.
+        '''
+
+        sets: List[str] = self.metric_sets
+        counters: Dict[str, float|int] = {}
+        if "io" in sets:
+            try:
+                io = process.io_counters()
+                counters.update(read_bytes=io.read_bytes, write_bytes=io.write_bytes, read_ops=io.read_count, write_ops=io.write_count)
+            except (psutil.AccessDenied, AttributeError):
+                counters.update(read_bytes=0, write_bytes=0, read_ops=0, write_ops=0)
+        if "ctx_switches" in sets:
+            switches = process.num_ctx_switches()
+            counters.update(voluntary_ctx_switches=switches.voluntary, involuntary_ctx_switches=switches.involuntary)
+        if "page_faults" in sets:
+            # Windows counts every page fault, macOS the faults and the page-ins, which are the major faults.
+            counters.update(page_faults=getattr(memory_info, "num_page_faults", getattr(memory_info, "pfaults", 0)),
+                            major_page_faults=getattr(memory_info, "pageins", 0))
+        if "threads" in sets:
+            try:
+                sample["busiest_thread_CPU"] = self.rates.busiest_thread(process.pid, {thread.id: thread.user_time + thread.system_time
+                                                                                        for thread in process.threads()})
+            except psutil.AccessDenied:
+                sample["busiest_thread_CPU"] = 0.0
+        if "open_files" in sets:
+            try:
+                sample["open_files"] = len(process.open_files())
+            except psutil.AccessDenied:
+                sample["open_files"] = 0
+        if counters:
+            sample.update(self.rates.rates(process.pid, counters))
+
+    def sample(self, process: psutil.Process) -> Dict[str, str|float|int]:
+        with process.oneshot():
+            memory_info = process.memory_info()
+            if self.windows:
+                working_set, private_bytes = memory_info.wset, memory_info.private
+            else:
+                # USS would need a full walk of the memory maps, so the private memory is estimated as RSS minus the shared pages.
+                working_set = memory_info.rss
+                private_bytes = max(0, memory_info.rss - getattr(memory_info, "shared", 0))
+            # The descriptors of the processes of other users can't be counted on Linux, like /proc/<pid>/fd for the /proc sampler,
+            # so they are taken as 0 instead of dropping the whole sample.
+            try:
+                handles: int = process.num_handles() if self.windows else process.num_fds()
+            except psutil.AccessDenied:
+                handles = 0
+            sample: Dict[str, str|float|int] = {
+                "pid": process.pid,
+                "name": process.name(),
+                "CPU": self._cpu(process.pid, sum(process.cpu_times()[:2])),
+                "working_set": working_set,
+                "private_bytes": private_bytes,
+                "handles": handles,
+                "threads": process.num_threads()
+            }
+            if self.metric_sets:
+                self._extended(process, memory_info, sample)
+            return sample
+
+    def close(self) -> None:
+        pass
+
+
+
+class ProcReader:
+    '''
+    Keeps the /proc/<pid>/stat, statm and smaps_rollup files, the status and io files if their metric sets are selected,
+    and the /proc/<pid>/fd directory of a single process open and reads them with os.preadv() into preallocated buffers,
+    so a tick doesn't open any file.
+    The open file descriptors stay bound to the process they were opened for, so a reused PID results in ESRCH
+    instead of the data of another process.
+    '''
+
+    def __init__(self, pid: int, uss: bool = False, status: bool = False, io: bool = False) -> None:
+        self.pid: int = pid
+        self.stat_fd: int|None = None
+        self.statm_fd: int|None = None
+        self.status_fd: int|None = None
+        self.io_fd: int|None = None
+        self.smaps_fd: int|None = None
+        self.fd_dir: int|None = None
+        # The descriptors that have been opened already are closed again if one of them can't be opened, e.g. with EMFILE.
+        try:
+            self._open_all(pid, uss, status, io)
+        except BaseException:
+            self.close()
+            raise
+        self.stat_buffer = bytearray(1024)
+        self.statm_buffer = bytearray(128)
+        self.smaps_buffer = bytearray(2048)
+        self.status_buffer = bytearray(4096) if status else None
+        self.io_buffer = bytearray(512) if io else None
+        self.name: str = ""
+        self.cpu_ticks: int|None = None
+        self.cpu_time: float = 0.0
+
+    @staticmethod
+    def descriptors(uss: bool = False, status: bool = False, io: bool = False) -> int:
+        '''
+        Returns the number of file descriptors that a reader with these options keeps open at most.
+        '''
+
+        return 3 + int(uss) + int(status) + int(io)
+
+    def _open_all(self, pid: int, uss: bool, status: bool, io: bool) -> None:
+        self.stat_fd = self._open(f"/proc/{pid}/stat")
+        self.statm_fd = self._open(f"/proc/{pid}/statm")
+        self.status_fd = self._open(f"/proc/{pid}/status") if status else None
+        # The io file is only readable for the processes of the same user, otherwise the I/O rates are 0.
+        if io:
+            try:
+                self.io_fd = self._open(f"/proc/{pid}/io")
+                os.preadv(self.io_fd, [bytearray(1)], 0)
+            except PermissionError:
+                if self.io_fd is not None:
+                    os.close(self.io_fd)
+                self.io_fd = None
+        # smaps_rollup is missing before Linux 4.14 and is not readable for the processes of other users.
+        if uss:
+            try:
+                self.smaps_fd = os.open(f"/proc/{pid}/smaps_rollup", os.O_RDONLY)
+                os.preadv(self.smaps_fd, [bytearray(1)], 0)
+            except (PermissionError, FileNotFoundError):
+                if self.smaps_fd is not None:
+                    os.close(self.smaps_fd)
+                self.smaps_fd = None
+        try:
+            self.fd_dir = os.open(f"/proc/{pid}/fd", os.O_RDONLY | os.O_DIRECTORY)
+        except PermissionError:
+            self.fd_dir = None
+
+    def _open(self, path: str) -> int:
+        try:
+            return os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            raise psutil.NoSuchProcess(self.pid)
+
+    def _read(self, fd: int, buffer: bytearray) -> int:
+        '''
+        Reads a whole /proc file into its preallocated buffer and returns the length of the data.
+        '''
+
+        try:
+            length: int = os.preadv(fd, [buffer], 0)
+        except ProcessLookupError:
+            raise psutil.NoSuchProcess(self.pid)
+        except OSError as e:
+            if e.errno in (errno.ESRCH, errno.ENOENT):
+                raise psutil.NoSuchProcess(self.pid)
+            raise
+        if length == 0:
+            raise psutil.NoSuchProcess(self.pid)
+        return length
+
+    def stat(self) -> List[bytearray]:
+        '''
+        Returns the fields of /proc/<pid>/stat that follow the process name, starting with the state (field 3).
+        '''
+
+        buffer: bytearray = self.stat_buffer
+        length: int = self._read(self.stat_fd, buffer)
+        # The name is in parentheses and can contain spaces or parentheses itself, so the fields start after the last ")".
+        end: int = buffer.rfind(b")", 0, length)
+        if not self.name:
+            self.name = buffer[buffer.find(b"(", 0, length) + 1:end].decode("utf-8", "replace")
+        return buffer[end + 2:length].split()
+
+    def statm(self) -> List[bytearray]:
+        return self.statm_buffer[:self._read(self.statm_fd, self.statm_buffer)].split()
+
+    def private_bytes(self) -> int|None:
+        '''
+        Returns the USS from smaps_rollup, or None if it can't be read.
+        '''
+
+        if self.smaps_fd is None:
+            return None
+        buffer: bytearray = self.smaps_buffer
+        length: int = self._read(self.smaps_fd, buffer)
+        total: int = 0
+        for key in (b"Private_Clean:", b"Private_Dirty:"):
+            start: int = buffer.find(key, 0, length)
+            if start >= 0:
+                total += int(buffer[start + len(key):buffer.index(b"kB", start, length)]) * 1024
+        return total
+
+    def _fields(self, fd: int|None, buffer: bytearray|None, keys: List[bytes]) -> List[int]:
+        '''
+        Returns the numbers that follow the given keys, each at the start of a line, in a "key: value" /proc file.
+        '''
+
+        if fd is None:
+            return [0] * len(keys)
+        # The leading line ending makes the first key match like the others.
+        text: bytes = b"\n" + buffer[:self._read(fd, buffer)]
+        values: List[int] = []
+        for key in keys:
+            start: int = text.find(b"\n" + key)
+            if start < 0:
+                values.append(0)
+                continue
+            start += len(key) + 1
+            end: int = text.find(b"\n", start)
+            values.append(int(text[start:end if end >= 0 else len(text)]))
+        return values
+
+    def ctx_switches(self) -> List[int]:
+        return self._fields(self.status_fd, self.status_buffer, [b"voluntary_ctxt_switches:", b"nonvoluntary_ctxt_switches:"])
+
+    def io(self) -> List[int]:
+        return self._fields(self.io_fd, self.io_buffer, [b"read_bytes:", b"write_bytes:", b"syscr:", b"syscw:"])
+
+    def open_files(self) -> int:
+        '''
+        Counts the file descriptors that point at regular files, i.e. at a path outside of /dev, unlike sockets, pipes or the terminal.
+        This reads the link of every descriptor, so it costs more than the number of descriptors.
+        '''
+
+        if self.fd_dir is None:
+            return 0
+        count: int = 0
+        try:
+            for name in os.listdir(self.fd_dir):
+                try:
+                    target: str = os.readlink(name, dir_fd=self.fd_dir)
+                except FileNotFoundError:
+                    # The descriptor was closed in the meantime.
+                    continue
+                if target.startswith("/") and not target.startswith("/dev/"):
+                    count += 1
+        except (FileNotFoundError, ProcessLookupError):
+            raise psutil.NoSuchProcess(self.pid)
+        return count
+
+    def thread_cpu_times(self, clock_ticks: int) -> Dict[int, float]:
+        '''
+        Returns the CPU time of every thread in seconds by its ID, read from /proc/<pid>/task/<tid>/stat .
+        The threads come and go, so their files are opened on every call.
+        '''
+
+        times: Dict[int, float] = {}
+        try:
+            tids: List[str] = os.listdir(f"/proc/{self.pid}/task")
+        except FileNotFoundError:
+            raise psutil.NoSuchProcess(self.pid)
+        for tid in tids:
+            try:
+                with open(f"/proc/{self.pid}/task/{tid}/stat", "rb") as file:
+                    data: bytes = file.read()
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+            fields: List[bytes] = data[data.rfind(b")") + 2:].split()
+            times[int(tid)] = (int(fields[11]) + int(fields[12])) / clock_ticks
+        return times
+
+    def open_fds(self) -> int:
+        if self.fd_dir is None:
+            return 0
+        try:
+            # Since Linux 6.2 the size of the /proc/<pid>/fd directory is the number of open file descriptors.
+            size: int = os.fstat(self.fd_dir).st_size
+            return size if size else len(os.listdir(self.fd_dir))
+        except (FileNotFoundError, ProcessLookupError):
+            raise psutil.NoSuchProcess(self.pid)
+
+    def close(self) -> None:
+        for fd in (self.stat_fd, self.statm_fd, self.smaps_fd, self.status_fd, self.io_fd, self.fd_dir):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        # The numbers may be handed out again right away, so they must not be closed a second time.
+        self.stat_fd = self.statm_fd = self.smaps_fd = self.status_fd = self.io_fd = self.fd_dir = None
+
+
+
+class ProcSampler:
+    '''
+    Samples processes on Linux straight from /proc, which costs a few pread() calls per process and tick
+    instead of opening and parsing the files through psutil.
+    The CPU usage is the delta of utime + stime between consecutive ticks, divided by the number of CPUs like psutil's.
+    The exact USS is only read if "uss" is set, since the kernel walks every page table of the process for smaps_rollup,
+    which costs about ten times as much as all the other reads together.
+    Of the metric sets, the threads and page faults come from the stat file that is read anyway, the context switches
+    add a read of the status file and the I/O a read of the io file, while the busiest thread and the open files
+    have to look at every thread or file descriptor.
+    Every process keeps 3 to 6 file descriptors open, so the readers may take up to "fd_budget" descriptors, half of the limit
+    of open files by default. The processes past the budget, and the ones whose files can't be opened since the process
+    or the system has run out of file descriptors, are sampled through psutil, which opens and closes the files on every tick.
+    '''
+
+    name: str = "proc"
+
+    def __init__(self, cpu_count: int, uss: bool = False, metric_sets: List[str]|None = None, fd_budget: int|None = None) -> None:
+        self.cpu_count: int = cpu_count
+        self.uss: bool = uss
+        self.metric_sets: List[str] = metric_sets or []
+        self.clock_ticks: int = os.sysconf("SC_CLK_TCK")
+        self.page_size: int = os.sysconf("SC_PAGE_SIZE")
+        self.readers: Dict[int, ProcReader] = {}
+        self.rates = RateTracker()
+        self.fd_budget: int = default_fd_budget() if fd_budget is None else fd_budget
+        self.reader_fds: int = ProcReader.descriptors(uss, "ctx_switches" in self.metric_sets, "io" in self.metric_sets)
+        self.fallback = PsutilSampler(cpu_count, metric_sets)
+        self.fallback_pids: Set[int] = set()
+
+    def track(self, process: psutil.Process, state: Tuple|None = None) -> None:
+        self.forget(process.pid)
+        if (len(self.readers) + 1) * self.reader_fds > self.fd_budget:
+            self._track_fallback(process, state)
+            return
+        try:
+            reader = ProcReader(process.pid, self.uss, status="ctx_switches" in self.metric_sets, io="io" in self.metric_sets)
+        except OSError as e:
+            if e.errno not in (errno.EMFILE, errno.ENFILE):
+                raise
+            self._track_fallback(process, state)
+            return
+        self.readers[process.pid] = reader
+        # Reading the stat file checks that the process is still there, but like with the psutil sampler,
+        # the first sample primes the CPU usage and the counters instead, unless their state is handed over.
+        reader.stat()
+        if state is not None:
+            if state[0] is not None:
+                reader.cpu_ticks, reader.cpu_time = round(state[0][0] * self.clock_ticks), state[0][1]
+            self.rates.restore(process.pid, state[1:])
+
+    def _track_fallback(self, process: psutil.Process, state: Tuple|None) -> None:
+        self.fallback_pids.add(process.pid)
+        self.fallback.track(process, state)
+
+    def state(self, pid: int) -> Tuple:
+        '''
+        Returns the CPU time in seconds and the counters of the previous sample of a process, in the layout of PsutilSampler.state().
+        '''
+
+        if pid in self.fallback_pids:
+            return self.fallback.state(pid)
+        reader = self.readers.get(pid)
+        cpu: Tuple[float, float]|None = None
+        if reader is not None and reader.cpu_ticks is not None:
+            cpu = (reader.cpu_ticks / self.clock_ticks, reader.cpu_time)
+        return (cpu, *self.rates.state(pid))
+
+    def forget(self, pid: int) -> None:
+        reader = self.readers.pop(pid, None)
+        if reader is not None:
+            reader.close()
+        if pid in self.fallback_pids:
+            self.fallback_pids.discard(pid)
+            self.fallback.forget(pid)
+        self.rates.forget(pid)
+
+    def _extended(self, reader: ProcReader, stat: List[bytearray], sample: Dict[str, str|float|int]) -> None:
+        '''
+        Adds the columns of the selected metric sets to the sample.
+        '''
+
+        sets: List[str] = self.metric_sets
+        counters: Dict[str, int] = {}
+        if "io" in sets:
+            read_bytes, write_bytes, read_ops, write_ops = reader.io()
+            counters.update(read_bytes=read_bytes, write_bytes=write_bytes, read_ops=read_ops, write_ops=write_ops)
+        if "ctx_switches" in sets:
+            voluntary, involuntary = reader.ctx_switches()
+            counters.update(voluntary_ctx_switches=voluntary, involuntary_ctx_switches=involuntary)
+        if "page_faults" in sets:
+            # minflt and majflt are the fields 10 and 12 of /proc/<pid>/stat.
+            major: int = int(stat[9])
+            counters.update(page_faults=int(stat[7]) + major, major_page_faults=major)
+        if "threads" in sets:
+            sample["busiest_thread_CPU"] = self.rates.busiest_thread(reader.pid, reader.thread_cpu_times(self.clock_ticks))
+        if "open_files" in sets:
+            sample["open_files"] = reader.open_files()
+        if counters:
+            sample.update(self.rates.rates(reader.pid, counters))
+
+    def _cpu(self, reader: ProcReader, stat: List[bytearray]) -> float:
+        # utime and stime are the fields 14 and 15 of /proc/<pid>/stat, which are at index 11 and 12 after the state.
+        ticks: int = int(stat[11]) + int(stat[12])
+        now: float = time.monotonic()
+        percent: float = 0.0
+        if reader.cpu_ticks is not None and now > reader.cpu_time:
+            # Capped like the CPU usage of the psutil sampler.
+            percent = min(100.0, (ticks - reader.cpu_ticks) / self.clock_ticks / (now - reader.cpu_time) * 100 / self.cpu_count)
+        reader.cpu_ticks, reader.cpu_time = ticks, now
+        return percent
+
+    def sample(self, process: psutil.Process) -> Dict[str, str|float|int]:
+        reader = self.readers.get(process.pid)
+        if reader is None and process.pid not in self.fallback_pids:
+            self.track(process)
+            reader = self.readers.get(process.pid)
+        if reader is None:
+            return self.fallback.sample(process)
+        stat: List[bytearray] = reader.stat()
+        statm: List[bytearray] = reader.statm()
+        resident: int = int(statm[1]) * self.page_size
+        private_bytes: int|None = reader.private_bytes()
+        if private_bytes is None:
+            private_bytes = resident - int(statm[2]) * self.page_size
+        sample: Dict[str, str|float|int] = {
+            "pid": reader.pid,
+            "name": reader.name,
+            "CPU": self._cpu(reader, stat),
+            "working_set": resident,
+            "private_bytes": private_bytes,
+            "handles": reader.open_fds(),
+            # num_threads is the field 20 of /proc/<pid>/stat.
+            "threads": int(stat[17])
+        }
+        if self.metric_sets:
+            self._extended(reader, stat, sample)
+        return sample
+
+    def close(self) -> None:
+        for pid in list(self.readers) + list(self.fallback_pids):
+            self.forget(pid)
+
+
+
+def default_fd_budget() -> int:
+    '''
+    Returns half of the soft limit of open files, which leaves the other half to the files, sockets and pipes of the monitor.
+    '''
+
+    import resource
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        soft = 1024 * 1024
+    return soft // 2
+
+
+
+def create_sampler(kind: str, cpu_count: int, uss: bool = False, metric_sets: List[str]|None = None) -> PsutilSampler|ProcSampler:
+    '''
+    Creates the sampler for the "sampler" argument. "auto" uses /proc on Linux and psutil everywhere else.
+    Only the collectors of the given metric sets run on every tick.
+    '''
+
+    if kind not in SAMPLERS:
+        raise ValueError(f'Unknown sampler: "{kind}". Please use one of: {", ".join(SAMPLERS)}.')
+    proc_available: bool = sys.platform.startswith("linux") and os.path.exists("/proc/self/stat")
+    if kind == "proc" and not proc_available:
+        raise OSError("The proc sampler needs the /proc file system of Linux. Please use the psutil sampler.")
+    if kind == "proc" or (kind == "auto" and proc_available):
+        return ProcSampler(cpu_count, uss, metric_sets)
+    return PsutilSampler(cpu_count, metric_sets)
+
+
+
+def sample_processes(sampler: PsutilSampler|ProcSampler, processes: Iterable[psutil.Process]) -> Tuple[List[Dict[str, str|float|int]], List[int]]:
+    '''
+    Samples the processes one after another, returning the samples together with the PIDs of the processes
+    that have exited since the previous tick, which the sampler forgets. A process that can't be read, or can't be read
+    for now since there are no file descriptors left, is skipped for the tick.
+    '''
+
+    samples: List[Dict[str, str|float|int]] = []
+    gone: List[int] = []
+    for process in processes:
+        try:
+            samples.append(sampler.sample(process))
+        except (psutil.NoSuchProcess, psutil.ZombieProcess):
+            sampler.forget(process.pid)
+            gone.append(process.pid)
+        except psutil.AccessDenied:
+            pass
+        except OSError as e:
+            # Out of file descriptors the process is tried again on the next tick.
+            if e.errno not in (errno.EMFILE, errno.ENFILE):
+                raise
+    return samples, gone
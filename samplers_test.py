@@ -0,0 +1,148 @@
+import unittest, os, sys, subprocess, psutil
+from samplers import PsutilSampler, ProcSampler, create_sampler
+from metrics import METRIC_SETS, metric_columns
+
+linux = sys.platform.startswith("linux")
+
+class DeniedDescriptors(psutil.Process):
+    '''
+    A process of another user, whose descriptors can't be counted.
+    '''
+
+    def num_fds(self):
+        raise psutil.AccessDenied(self.pid)
+
+    num_handles = num_fds
+
+class TestSamplers(unittest.TestCase):
+    def setUp(self):
+        # A child process that keeps 50 MB of private memory and a few files open until it gets killed.
+        self.child = subprocess.Popen([sys.executable, "-c",
+            "import time, sys; data = bytearray(50 * 1024 * 1024); files = [open(sys.executable, 'rb') for _ in range(5)]; "
+            "print('ready', flush=True); time.sleep(60)"], stdout=subprocess.PIPE)
+        self.child.stdout.readline()
+        self.process = psutil.Process(self.child.pid)
+
+    def tearDown(self):
+        self.child.kill()
+        self.child.wait()
+        self.child.stdout.close()
+
+
+
+    def test_psutil_sampler(self):
+        sampler = PsutilSampler(psutil.cpu_count())
+        sampler.track(self.process)
+        sample = sampler.sample(self.process)
+        self.assertEqual(sample["pid"], self.child.pid)
+        self.assertGreater(sample["working_set"], 50 * 1024 * 1024)
+        self.assertGreater(sample["private_bytes"], 40 * 1024 * 1024)
+        self.assertGreaterEqual(sample["handles"], 5)
+        self.assertGreaterEqual(sample["threads"], 1)
+
+
+
+    def test_psutil_sampler_denied_descriptors(self):
+        sampler = PsutilSampler(psutil.cpu_count())
+        process = DeniedDescriptors(self.child.pid)
+        sampler.track(process)
+        sample = sampler.sample(process)
+        self.assertEqual(sample["handles"], 0)
+        self.assertGreater(sample["working_set"], 50 * 1024 * 1024)
+
+
+
+    @unittest.skipUnless(linux, "the proc sampler needs Linux")
+    def test_proc_sampler_matches_psutil(self):
+        sampler = ProcSampler(psutil.cpu_count())
+        sampler.track(self.process)
+        sample = sampler.sample(self.process)
+        memory_info = self.process.memory_info()
+        self.assertEqual(sample["name"], self.process.name())
+        self.assertAlmostEqual(sample["working_set"], memory_info.rss, delta=1024 * 1024)
+        self.assertAlmostEqual(sample["private_bytes"], memory_info.rss - memory_info.shared, delta=1024 * 1024)
+        self.assertEqual(sample["handles"], self.process.num_fds())
+        self.assertEqual(sample["threads"], self.process.num_threads())
+        self.assertGreaterEqual(sample["CPU"], 0.0)
+        sampler.close()
+
+
+
+    @unittest.skipUnless(linux, "the proc sampler needs Linux")
+    def test_proc_sampler_uss(self):
+        sampler = ProcSampler(psutil.cpu_count(), uss=True)
+        sampler.track(self.process)
+        sample = sampler.sample(self.process)
+        self.assertAlmostEqual(sample["private_bytes"], self.process.memory_full_info().uss, delta=1024 * 1024)
+        sampler.close()
+
+
+
+    @unittest.skipUnless(linux, "the proc sampler needs Linux")
+    def test_proc_sampler_exited_process(self):
+        sampler = ProcSampler(psutil.cpu_count())
+        sampler.track(self.process)
+        self.child.kill()
+        self.child.wait()
+        self.assertRaises(psutil.NoSuchProcess, sampler.sample, self.process)
+        sampler.close()
+
+
+
+    @unittest.skipUnless(linux, "the proc sampler needs Linux")
+    def test_proc_sampler_fd_budget(self):
+        own = psutil.Process()
+        sampler = ProcSampler(psutil.cpu_count(), fd_budget=3)
+        sampler.track(self.process)
+        sampler.track(own)
+        self.assertEqual((list(sampler.readers), sampler.fallback_pids), ([self.child.pid], {own.pid}))
+        self.assertEqual(sampler.sample(own)["pid"], own.pid)
+        sampler.close()
+        self.assertEqual((sampler.readers, sampler.fallback_pids), ({}, set()))
+
+
+
+    @unittest.skipUnless(linux, "the proc sampler needs Linux")
+    def test_proc_sampler_out_of_file_descriptors(self):
+        import resource
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        sampler = ProcSampler(psutil.cpu_count(), fd_budget=1000)
+        own = psutil.Process()
+        # Leaves room for the three descriptors of one reader and one more that psutil opens and closes again.
+        resource.setrlimit(resource.RLIMIT_NOFILE, (len(os.listdir("/proc/self/fd")) + 4, limits[1]))
+        try:
+            sampler.track(self.process)
+            sampler.track(own)
+            self.assertEqual(sampler.sample(own)["pid"], own.pid)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+        self.assertEqual((list(sampler.readers), sampler.fallback_pids), ([self.child.pid], {own.pid}))
+        sampler.close()
+
+
+
+    def test_metric_sets(self):
+        samplers = [PsutilSampler(psutil.cpu_count(), list(METRIC_SETS))]
+        if linux:
+            samplers.append(ProcSampler(psutil.cpu_count(), metric_sets=list(METRIC_SETS)))
+        for sampler in samplers:
+            sampler.track(self.process)
+            sample = sampler.sample(self.process)
+            for metric in metric_columns(list(METRIC_SETS)):
+                self.assertGreaterEqual(sample[metric.name], 0, f"{sampler.name} {metric.name}")
+            self.assertGreaterEqual(sample["open_files"], 5)
+            sampler.close()
+        # Without metric sets only the base keys are sampled.
+        self.assertNotIn("read_bytes_per_s", PsutilSampler(psutil.cpu_count()).sample(self.process))
+
+
+
+    def test_create_sampler(self):
+        self.assertIsInstance(create_sampler("psutil", 1), PsutilSampler)
+        self.assertIsInstance(create_sampler("auto", 1), ProcSampler if linux else PsutilSampler)
+        self.assertRaises(ValueError, create_sampler, "wmi", 1)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
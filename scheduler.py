@@ -0,0 +1,103 @@
+import asyncio, time
+from typing import Awaitable, Callable, NamedTuple
+
+
+class Tick(NamedTuple):
+    '''
+    Describes a single tick fired by the TickScheduler.
+    '''
+
+    index: int
+    deadline: float
+    fired_at: float
+    lateness: float
+    skipped: int
+
+
+
+class TickScheduler:
+    '''
+    Fires ticks on absolute monotonic deadlines (start + n * interval), so the period doesn't drift
+    by the time spent sampling and writing between two ticks.
+    If a tick is so late that one or more of the following deadlines have already passed,
+    the missed deadlines are skipped and counted instead of being fired in a burst.
+    '''
+
+    def __init__(self, interval: float, late_threshold: float|None = None, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], Awaitable[None]] = asyncio.sleep) -> None:
+        if interval <= 0:
+            raise ValueError(f"Interval has a non-positive value: {interval}. Please use a positive value.")
+        self.interval: float = interval
+        # A tick counts as late if it fires later than 10% of the interval after its deadline, unless stated otherwise.
+        self.late_threshold: float = interval * 0.1 if late_threshold is None else late_threshold
+        self.clock: Callable[[], float] = clock
+        self.sleep: Callable[[float], Awaitable[None]] = sleep
+        self.start: float = clock()
+        self.next_deadline: float = self.start
+        self.index: int = 0
+        self.ticks: int = 0
+        self.late_ticks: int = 0
+        self.skipped_ticks: int = 0
+        self.max_lateness: float = 0.0
+
+    def elapsed(self, now: float|None = None) -> float:
+        '''
+        Returns the measured monotonic time since the scheduler was started.
+        '''
+        return (self.clock() if now is None else now) - self.start
+
+    def set_interval(self, interval: float, immediately: bool = False) -> None:
+        '''
+        Changes the interval starting with the deadline after the upcoming one,
+        or already with the upcoming one if "immediately" is set, which moves it to the last deadline plus the new interval.
+        '''
+        if interval <= 0:
+            raise ValueError(f"Interval has a non-positive value: {interval}. Please use a positive value.")
+        if immediately:
+            self.next_deadline += interval - self.interval
+        self.interval = interval
+
+    def advance(self, now: float) -> Tick:
+        '''
+        Registers a tick that fired at "now" for the current deadline and computes the next deadline.
+        This is kept separate from wait() so the deadline arithmetic can be tested without sleeping.
+        '''
+
+        deadline: float = self.next_deadline
+        lateness: float = max(0.0, now - deadline)
+        next_deadline: float = deadline + self.interval
+        skipped: int = 0
+
+        # The tick overran one or more of the following deadlines, so they are skipped
+        # and the schedule resumes on the first deadline that is still in the future.
+        if now >= next_deadline:
+            skipped = int((now - next_deadline) // self.interval) + 1
+            next_deadline += skipped * self.interval
+
+        tick = Tick(self.index, deadline, now, lateness, skipped)
+        self.index += 1 + skipped
+        self.next_deadline = next_deadline
+        self.ticks += 1
+        self.skipped_ticks += skipped
+        if lateness > self.late_threshold:
+            self.late_ticks += 1
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        return tick
+
+    async def wait(self) -> Tick:
+        '''
+        Sleeps until the next deadline and returns the tick that fired.
+        '''
+
+        delay: float = self.next_deadline - self.clock()
+        if delay > 0:
+            await self.sleep(delay)
+        return self.advance(self.clock())
+
+    def summary(self) -> str:
+        '''
+        Returns a short human readable summary of the scheduling statistics.
+        '''
+        return "{} tick(s), {} late, {} skipped, max lateness {:.3f} ms".format(
+            self.ticks, self.late_ticks, self.skipped_ticks, self.max_lateness * 1000)
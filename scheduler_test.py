@@ -0,0 +1,96 @@
+import unittest, asyncio
+from scheduler import TickScheduler
+
+class FakeClock:
+    def __init__(self, now: float = 100.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+class TestTickScheduler(unittest.TestCase):
+    def test_deadlines_do_not_drift(self):
+        clock = FakeClock()
+        scheduler = TickScheduler(0.5, clock=clock)
+        # Every tick fires 40 ms late, which must not push back the following deadlines.
+        for n in range(10):
+            clock.now = 100.0 + n * 0.5 + 0.04
+            tick = scheduler.advance(clock.now)
+            self.assertAlmostEqual(tick.deadline, 100.0 + n * 0.5)
+            self.assertAlmostEqual(tick.lateness, 0.04)
+            self.assertEqual(tick.skipped, 0)
+        self.assertAlmostEqual(scheduler.next_deadline, 105.0)
+        self.assertEqual(scheduler.late_ticks, 0)
+
+
+
+    def test_overrun_skips_missed_deadlines(self):
+        clock = FakeClock()
+        scheduler = TickScheduler(1, clock=clock)
+        scheduler.advance(100.0)
+        # The tick for 101 fires at 103.5, so the deadlines 102 and 103 are skipped.
+        tick = scheduler.advance(103.5)
+        self.assertEqual(tick.skipped, 2)
+        self.assertEqual(tick.index, 1)
+        self.assertAlmostEqual(scheduler.next_deadline, 104.0)
+        self.assertEqual(scheduler.index, 4)
+        self.assertEqual(scheduler.skipped_ticks, 2)
+        self.assertEqual(scheduler.late_ticks, 1)
+
+
+
+    def test_elapsed_time_is_measured(self):
+        clock = FakeClock()
+        scheduler = TickScheduler(0.01, clock=clock)
+        clock.now = 112.345
+        self.assertAlmostEqual(scheduler.elapsed(), 12.345)
+
+
+
+    def test_invalid_interval(self):
+        self.assertRaises(ValueError, TickScheduler, 0)
+        self.assertRaises(ValueError, TickScheduler, -1)
+
+
+
+    def test_set_interval(self):
+        clock = FakeClock()
+        scheduler = TickScheduler(1, clock=clock)
+        scheduler.advance(100.0)
+        # By default the upcoming deadline stays where it is.
+        scheduler.set_interval(4)
+        self.assertAlmostEqual(scheduler.next_deadline, 101.0)
+        scheduler.advance(101.0)
+        self.assertAlmostEqual(scheduler.next_deadline, 105.0)
+        # Immediately moves the upcoming deadline to the last one plus the new interval.
+        scheduler.set_interval(0.5, immediately=True)
+        self.assertAlmostEqual(scheduler.next_deadline, 101.5)
+        self.assertRaises(ValueError, scheduler.set_interval, 0)
+
+
+
+    def test_sub_100ms_interval(self):
+        clock = FakeClock()
+        delays = []
+        async def sleep(delay: float) -> None:
+            delays.append(delay)
+            clock.now += delay
+        async def run() -> TickScheduler:
+            scheduler = TickScheduler(0.02, clock=clock, sleep=sleep)
+            for _ in range(10):
+                await scheduler.wait()
+                # Sampling and writing take 5 ms of every tick, which the next sleep makes up for.
+                clock.now += 0.005
+            return scheduler
+        scheduler = asyncio.run(run())
+        # 10 ticks starting at zero end at 180 ms, instead of blocking for 100 ms per tick.
+        self.assertEqual(scheduler.ticks, 10)
+        self.assertEqual(scheduler.skipped_ticks, 0)
+        self.assertEqual(len(delays), 9)
+        self.assertTrue(all(abs(delay - 0.015) < 1e-9 for delay in delays))
+        self.assertAlmostEqual(clock.now - 100.0, 0.185)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
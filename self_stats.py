@@ -0,0 +1,192 @@
+import datetime, json, os, time, psutil
+from typing import Callable, Dict, List
+from scheduler import Tick
+
+# The stages of a tick of write_stats(), in the order they run.
+STAGES: List[str] = ["sample", "aggregate", "gui", "store", "format", "csv"]
+
+# Durations are counted in power-of-two buckets of microseconds, the last bucket holds everything from 2^30 µs (about 18 minutes) up.
+BUCKETS: int = 32
+
+
+class LatencyHistogram:
+    '''
+    Counts durations in power-of-two buckets of microseconds, so adding one costs a multiplication and a bit_length()
+    and the memory it takes is fixed. Quantiles are reported as the upper bound of their bucket, i.e. within a factor of 2.
+    '''
+
+    __slots__ = ("counts", "count", "total", "maximum")
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * BUCKETS
+        self.count: int = 0
+        self.total: float = 0.0
+        self.maximum: float = 0.0
+
+    def add(self, seconds: float) -> None:
+        # Bucket 0 holds durations below 1 µs, bucket k the ones from 2^(k-1) up to 2^k µs.
+        bucket: int = int(seconds * 1e6).bit_length()
+        self.counts[bucket if bucket < BUCKETS else BUCKETS - 1] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def quantile(self, q: float) -> float:
+        '''
+        Returns the upper bound of the bucket of the q-quantile in seconds, but never more than the maximum.
+        '''
+
+        rank: float = q * self.count
+        seen: int = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << bucket) / 1e6, self.maximum)
+        return self.maximum
+
+    def summary(self) -> Dict[str, object]:
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count * 1e6, 1) if self.count else 0.0,
+            "p50_us": round(self.quantile(0.5) * 1e6, 1),
+            "p99_us": round(self.quantile(0.99) * 1e6, 1),
+            "max_us": round(self.maximum * 1e6, 1),
+            # Only the buckets that were hit, keyed by their upper bound in µs.
+            "buckets_us": {str(1 << bucket): count for bucket, count in enumerate(self.counts) if count}
+        }
+
+
+
+class SelfStats:
+    '''
+    Measures what monitoring costs: the time every stage of a tick takes, how late the ticks fire, the dropped ticks,
+    and the CPU time and RSS of the monitor itself. The stats are kept in LatencyHistograms and written to a JSON
+    sidecar file every "write_interval" seconds, replacing the previous version of the file.
+    The own CPU time and RSS are only read when the file gets written, so a tick costs just a few clock reads.
+    '''
+
+    def __init__(self, path: str, write_interval: float = 60.0, stages: List[str] = STAGES,
+                 clock: Callable[[], float] = time.perf_counter) -> None:
+        self.path: str = path
+        self.write_interval: float = write_interval
+        self.clock: Callable[[], float] = clock
+        self.stages: Dict[str, LatencyHistogram] = {stage: LatencyHistogram() for stage in stages}
+        self.tick_time = LatencyHistogram()
+        self.lateness = LatencyHistogram()
+        self.ticks: int = 0
+        self.skipped_ticks: int = 0
+        self.process = psutil.Process()
+        self.cpu_count: int = psutil.cpu_count() or 1
+        self.peak_rss: int = 0
+        self.cpu_seconds: float = 0.0
+        self.rss: int = 0
+        self.closed: bool = False
+        self.in_tick: bool = False
+        self.instrumentation_cost: float = self._calibrate()
+        self.started: float = clock()
+        self.cpu_start: float = self._cpu_time()
+        self.last_write: float = self.started
+        self.tick_start: float = self.started
+        self.last_mark: float = self.started
+
+    def _calibrate(self) -> float:
+        '''
+        Measures what the instrumentation of a single tick costs, by running it 200 times on throwaway histograms.
+        '''
+
+        stages: Dict[str, LatencyHistogram] = {stage: LatencyHistogram() for stage in self.stages}
+        tick_time, lateness, clock = LatencyHistogram(), LatencyHistogram(), self.clock
+        started: float = clock()
+        for _ in range(200):
+            tick_start: float = clock()
+            lateness.add(0.0)
+            last: float = tick_start
+            for histogram in stages.values():
+                now: float = clock()
+                histogram.add(now - last)
+                last = now
+            tick_time.add(clock() - tick_start)
+        return (clock() - started) / 200
+
+    def _cpu_time(self) -> float:
+        times = self.process.cpu_times()
+        return times.user + times.system
+
+    def start_tick(self, tick: Tick) -> None:
+        self.in_tick = True
+        self.tick_start = self.last_mark = self.clock()
+        self.lateness.add(tick.lateness)
+        self.skipped_ticks += tick.skipped
+
+    def mark(self, stage: str) -> None:
+        '''
+        Records the time since the start of the tick or the previous mark as the duration of "stage".
+        Marks outside of a tick, e.g. of rows written when monitoring finishes, are ignored.
+        '''
+
+        if not self.in_tick:
+            return
+        now: float = self.clock()
+        self.stages[stage].add(now - self.last_mark)
+        self.last_mark = now
+
+    def end_tick(self) -> None:
+        self.in_tick = False
+        self.tick_time.add(self.last_mark - self.tick_start)
+        self.ticks += 1
+        if self.last_mark - self.last_write >= self.write_interval:
+            self.write()
+
+    def _read_process(self) -> None:
+        self.cpu_seconds = self._cpu_time() - self.cpu_start
+        self.rss = self.process.memory_info().rss
+        self.peak_rss = max(self.peak_rss, self.rss)
+
+    def stats(self) -> Dict[str, object]:
+        self._read_process()
+        elapsed: float = max(self.clock() - self.started, 1e-9)
+        return {
+            "updated": datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
+            "elapsed_seconds": round(elapsed, 3),
+            "ticks": self.ticks,
+            "skipped_ticks": self.skipped_ticks,
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            # Divided by the number of CPUs like the CPU column of data.csv .
+            "cpu_percent": round(self.cpu_seconds / elapsed * 100 / self.cpu_count, 3),
+            "rss_mb": round(self.rss / (1024 * 1024), 2),
+            "peak_rss_mb": round(self.peak_rss / (1024 * 1024), 2),
+            "busy_percent": round(self.tick_time.total / elapsed * 100, 3),
+            "instrumentation_us_per_tick": round(self.instrumentation_cost * 1e6, 2),
+            "tick": self.tick_time.summary(),
+            "lateness": self.lateness.summary(),
+            "stages": {stage: histogram.summary() for stage, histogram in self.stages.items()}
+        }
+
+    def write(self) -> None:
+        '''
+        Writes the stats to a temporary file first, so a reader never sees a partially written file.
+        '''
+
+        self.last_write = self.clock()
+        temporary: str = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(self.stats(), file, indent=1)
+        os.replace(temporary, self.path)
+
+    def summary(self) -> str:
+        '''
+        Returns a short human readable summary of the cost of monitoring.
+        '''
+
+        tick: Dict[str, object] = self.tick_time.summary()
+        elapsed: float = max(self.clock() - self.started, 1e-9)
+        return "{} tick(s), {} dropped, {:.3f} s CPU ({:.3f}%), RSS {:.1f} MB (peak {:.1f} MB), tick {} us mean / {} us p99, lateness p99 {:.3f} ms, instrumentation {:.1f} us per tick".format(
+            self.ticks, self.skipped_ticks, self.cpu_seconds, self.cpu_seconds / elapsed * 100 / self.cpu_count,
+            self.rss / (1024 * 1024), self.peak_rss / (1024 * 1024), tick["mean_us"], tick["p99_us"], self.lateness.quantile(0.99) * 1000,
+            self.instrumentation_cost * 1e6)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.write()
+            self.closed = True
@@ -0,0 +1,87 @@
+import unittest, os, tempfile, json
+from scheduler import Tick
+from self_stats import LatencyHistogram, SelfStats, STAGES
+
+class FakeClock:
+    def __init__(self, now: float = 100.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+class TestSelfStats(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "monitor_stats.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+
+    def test_histogram(self):
+        histogram = LatencyHistogram()
+        for _ in range(98):
+            histogram.add(0.000010)
+        histogram.add(0.0005)
+        histogram.add(2.0)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 100)
+        # 10 µs falls into the bucket from 8 to 16 µs.
+        self.assertEqual(summary["p50_us"], 16.0)
+        self.assertEqual(summary["p99_us"], 512.0)
+        self.assertEqual(summary["max_us"], 2000000.0)
+        self.assertEqual(summary["buckets_us"], {"16": 98, "512": 1, "2097152": 1})
+        # Durations of hours end up in the last bucket instead of overflowing.
+        histogram.add(7200.0)
+        self.assertEqual(histogram.counts[-1], 1)
+
+
+
+    def test_stages_and_periodic_write(self):
+        clock = FakeClock()
+        stats = SelfStats(self.path, write_interval=10.0, clock=clock)
+        for n in range(20):
+            clock.now = 100.0 + n
+            stats.start_tick(Tick(n, clock.now, clock.now + 0.002, 0.002, 1 if n == 5 else 0))
+            for stage in STAGES:
+                clock.now += 0.0001
+                stats.mark(stage)
+            stats.end_tick()
+            # The file gets written once 10 seconds have passed since the start.
+            self.assertEqual(os.path.exists(self.path), n >= 10)
+        stats.close()
+        with open(self.path, encoding="utf-8") as file:
+            data = json.load(file)
+        self.assertEqual(data["ticks"], 20)
+        self.assertEqual(data["skipped_ticks"], 1)
+        self.assertEqual(set(data["stages"]), set(STAGES))
+        self.assertEqual(data["stages"]["csv"]["mean_us"], 100.0)
+        self.assertEqual(data["tick"]["mean_us"], len(STAGES) * 100.0)
+        self.assertEqual(data["lateness"]["p99_us"], 2000.0)
+        self.assertGreater(data["rss_mb"], 0)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        self.assertIn("20 tick(s), 1 dropped", stats.summary())
+
+
+
+    def test_marks_outside_of_ticks_are_ignored(self):
+        clock = FakeClock()
+        stats = SelfStats(self.path, clock=clock)
+        clock.now += 30
+        stats.mark("csv")
+        self.assertEqual(stats.stages["csv"].count, 0)
+        stats.close()
+
+
+
+    def test_instrumentation_is_cheap(self):
+        stats = SelfStats(self.path)
+        # A few clock reads and histogram updates per tick, which is far below 1% of a 10 ms tick.
+        self.assertLess(stats.instrumentation_cost, 0.0001)
+        stats.close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,401 @@
+import signal, psutil
+from typing import TYPE_CHECKING, Dict, List, Set, Tuple
+from options import SHARD_SIZE, WORKER_MODES
+from samplers import create_sampler, sample_processes, PsutilSampler, ProcSampler
+# multiprocessing and concurrent.futures are imported by the shards that use them, so the constants here come cheap.
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+    from multiprocessing.connection import Connection
+
+# A tick of a sharded set samples the first shard in the monitor itself and every other shard in a worker at the same time:
+# in threads, which share one sampler, or in processes, which run the Python code of the samplers on cores of their own
+# but hand the samples back through a pipe.
+
+# How far the sizes of the shards may drift apart, as a fraction of their mean size, before PIDs get moved to the smallest shard.
+REBALANCE_SLACK: float = 0.25
+
+# How long closing a worker process waits for it to exit before it gets killed.
+CLOSE_TIMEOUT: float = 2.0
+
+
+class ShardPlan:
+    '''
+    Assigns the tracked PIDs to at most "workers" shards of at least "shard_size" PIDs each.
+    The PIDs that have exited are dropped, new PIDs go to the smallest shard and once the sizes drift apart
+    by more than the slack, PIDs are moved from the largest to the smallest shard, so most PIDs stay in their shard across ticks.
+    '''
+
+    def __init__(self, workers: int, shard_size: int = SHARD_SIZE) -> None:
+        self.workers: int = workers
+        self.shard_size: int = shard_size
+        self.shards: List[Set[int]] = []
+        self.assignment: Dict[int, int] = {}
+
+    def count(self, pids: int) -> int:
+        '''
+        Returns the number of shards for this many PIDs.
+        '''
+
+        return max(1, min(self.workers, pids // self.shard_size))
+
+    def _place(self, pid: int, shard: int, moves: List[Tuple[int, int|None, int]]) -> None:
+        moves.append((pid, self.assignment.get(pid), shard))
+        self.assignment[pid] = shard
+        self.shards[shard].add(pid)
+
+    def update(self, pids: List[int], limit: int|None = None) -> List[Tuple[int, int|None, int]]:
+        '''
+        Rebalances the shards for the PIDs that are tracked now, using at most "limit" shards, e.g. the workers that have started.
+        Returns a (pid, previous shard, shard) tuple for every PID that is new or has been moved, the previous shard being None
+        for a new PID and the index of a dropped shard for the PIDs of the shards that aren't needed anymore.
+        '''
+
+        present: Set[int] = set(pids)
+        for pid in [pid for pid in self.assignment if pid not in present]:
+            self.shards[self.assignment.pop(pid)].discard(pid)
+        count: int = self.count(len(present))
+        if limit is not None:
+            count = max(1, min(limit, count))
+        moves: List[Tuple[int, int|None, int]] = []
+        unplaced: List[int] = []
+        while len(self.shards) > count:
+            unplaced.extend(self.shards.pop())
+        while len(self.shards) < count:
+            self.shards.append(set())
+
+        for pid in unplaced + [pid for pid in pids if pid not in self.assignment]:
+            self._place(pid, min(range(count), key=lambda index: len(self.shards[index])), moves)
+        slack: int = max(1, int(len(present) / count * REBALANCE_SLACK))
+        while True:
+            largest: int = max(range(count), key=lambda index: len(self.shards[index]))
+            smallest: int = min(range(count), key=lambda index: len(self.shards[index]))
+            if len(self.shards[largest]) - len(self.shards[smallest]) <= slack:
+                break
+            self._place(self.shards[largest].pop(), smallest, moves)
+        return moves
+
+
+
+def merge(processes: Dict[int, psutil.Process], results: List[Tuple[List[Dict[str, str|float|int]], List[int]]]) -> Tuple[List[Dict[str, str|float|int]], List[int]]:
+    '''
+    Merges the samples of the shards into one batch in the order the processes are tracked in, which is the order
+    a serial tick returns them in, together with the PIDs that have exited in any of the shards.
+    '''
+
+    by_pid: Dict[int, Dict[str, str|float|int]] = {}
+    gone: List[int] = []
+    for samples, exited in results:
+        for sample in samples:
+            by_pid[sample["pid"]] = sample
+        gone.extend(exited)
+    return [by_pid[pid] for pid in processes if pid in by_pid], gone
+
+
+
+class ThreadShards:
+    '''
+    Samples the shards on a pool of threads that share one sampler. The sampler keeps the state of every PID apart,
+    so the threads never touch the same state and moving a PID to another shard costs nothing.
+    The threads overlap the system calls, which release the GIL, and run side by side on the builds of Python without a GIL.
+    '''
+
+    mode: str = "thread"
+
+    def __init__(self, sampler: PsutilSampler|ProcSampler, workers: int, shard_size: int = SHARD_SIZE) -> None:
+        self.sampler: PsutilSampler|ProcSampler = sampler
+        self.name: str = sampler.name
+        self.plan = ShardPlan(workers, shard_size)
+        self.pool: ThreadPoolExecutor|None = None
+
+    def track(self, process: psutil.Process) -> None:
+        self.sampler.track(process)
+
+    def forget(self, pid: int) -> None:
+        self.sampler.forget(pid)
+
+    def sample_all(self, processes: Dict[int, psutil.Process]) -> Tuple[List[Dict[str, str|float|int]], List[int]]:
+        '''
+        Samples the processes of every shard at the same time and returns the merged samples and the PIDs that have exited.
+        '''
+
+        self.plan.update(list(processes))
+        if len(self.plan.shards) == 1:
+            return sample_processes(self.sampler, list(processes.values()))
+        if self.pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.pool = ThreadPoolExecutor(self.plan.workers - 1, thread_name_prefix="shard")
+        shards: List[List[psutil.Process]] = [[processes[pid] for pid in shard] for shard in self.plan.shards]
+        futures = [self.pool.submit(sample_processes, self.sampler, shard) for shard in shards[1:]]
+        results: List[Tuple[List[Dict[str, str|float|int]], List[int]]] = [sample_processes(self.sampler, shards[0])]
+        results.extend(future.result() for future in futures)
+        return merge(processes, results)
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.sampler.close()
+
+
+
+def run_shard(sampler: PsutilSampler|ProcSampler, processes: Dict[int, psutil.Process], tracked: List[Tuple[psutil.Process, Tuple|None]],
+              forgotten: List[int], released: List[int]) -> Tuple[List[Dict[str, str|float|int]], List[int], Dict[int, Tuple]]:
+    '''
+    Runs a tick of a shard of a ProcessShards, whose processes are kept in "processes": forgets the PIDs that have moved on,
+    tracks the new ones, going on from the state that another shard has handed over, if any, and samples them all.
+    The PIDs that move to another shard are released after their last sample here, handing their state over.
+    Returns the samples, the PIDs that have exited or can't be tracked and the states of the released PIDs.
+    '''
+
+    for pid in forgotten:
+        processes.pop(pid, None)
+        sampler.forget(pid)
+    dropped: List[int] = []
+    for process, state in tracked:
+        try:
+            sampler.track(process, state)
+            processes[process.pid] = process
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            processes.pop(process.pid, None)
+            sampler.forget(process.pid)
+            dropped.append(process.pid)
+    samples, gone = sample_processes(sampler, list(processes.values()))
+    for pid in gone:
+        del processes[pid]
+    states: Dict[int, Tuple] = {}
+    for pid in released:
+        if pid in processes:
+            states[pid] = sampler.state(pid)
+            del processes[pid]
+            sampler.forget(pid)
+    return samples, dropped + gone, states
+
+
+
+def serve_shard(connection: "Connection", kind: str, cpu_count: int, uss: bool, metric_sets: List[str]) -> None:
+    '''
+    Runs in a worker process. It keeps the psutil.Process objects and a sampler of its own for the PIDs of its shard
+    and answers every tick, which brings the PIDs to track, to forget and to release, with the result of run_shard().
+    It exits once the monitor closes the pipe.
+    '''
+
+    # CTRL + C reaches the whole process group, but the monitor is the one to stop the workers once it has written its files.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sampler = create_sampler(kind, cpu_count, uss, metric_sets)
+    processes: Dict[int, psutil.Process] = {}
+    try:
+        connection.send("ready")
+        while True:
+            message: Tuple[List[Tuple[int, float, Tuple|None]], List[int], List[int]]|None = connection.recv()
+            if message is None:
+                break
+            tracked, forgotten, released = message
+            found: List[Tuple[psutil.Process, Tuple|None]] = []
+            missing: List[int] = []
+            for pid, create_time, state in tracked:
+                try:
+                    process = psutil.Process(pid)
+                    # The PID has been reused by another process since the monitor found it.
+                    if process.create_time() != create_time:
+                        raise psutil.NoSuchProcess(pid)
+                    found.append((process, state))
+                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                    forgotten.append(pid)
+                    missing.append(pid)
+            samples, gone, states = run_shard(sampler, processes, found, forgotten, released)
+            connection.send((samples, missing + gone, states))
+    except (EOFError, OSError):
+        pass
+    finally:
+        sampler.close()
+
+
+
+class ShardWorker:
+    '''
+    A worker process that samples one shard. It gets started with the "spawn" method on every platform,
+    since a forked monitor would copy the locks its other threads hold.
+    '''
+
+    def __init__(self, options: Tuple[str, int, bool, List[str]]) -> None:
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=serve_shard, args=(child, *options), name="process_monitor_shard", daemon=True)
+        self.process.start()
+        child.close()
+        self.ready: bool = False
+        self.failed: bool = False
+
+    def poll(self, timeout: float = 0.0) -> bool:
+        '''
+        Returns whether the worker has started and is ready for a shard.
+        '''
+
+        if not self.ready and not self.failed:
+            try:
+                if self.connection.poll(timeout):
+                    self.ready = self.connection.recv() == "ready"
+            except (EOFError, OSError):
+                self.failed = True
+        return self.ready
+
+    def send(self, tracked: List[Tuple[int, float, Tuple|None]], forgotten: List[int], released: List[int]) -> None:
+        self.connection.send((tracked, forgotten, released))
+
+    def receive(self) -> Tuple[List[Dict[str, str|float|int]], List[int], Dict[int, Tuple]]:
+        return self.connection.recv()
+
+    def close(self) -> None:
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.connection.close()
+        self.process.join(CLOSE_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+
+class ProcessShards:
+    '''
+    Samples the shards in worker processes, each with a sampler of its own, so the samplers run on as many cores as there are workers.
+    A worker only gets a shard once it has started, so starting one doesn't hold up the ticks.
+    A PID that is moved to another shard is sampled one last time by its previous shard, which hands the CPU time and
+    the counters of that sample over, and the new shard goes on from them on the next tick, so the move doesn't show in the samples.
+    Only the PIDs of a worker that dies or gets stopped as the set shrinks start over with a CPU usage of 0, like new PIDs.
+    A worker that dies is replaced and its PIDs are sampled by the others until the new one is ready, missing the tick it died in.
+    '''
+
+    mode: str = "process"
+
+    def __init__(self, kind: str, cpu_count: int, uss: bool = False, metric_sets: List[str]|None = None,
+                 workers: int = 1, shard_size: int = SHARD_SIZE) -> None:
+        self.options: Tuple[str, int, bool, List[str]] = (kind, cpu_count, uss, metric_sets or [])
+        self.sampler: PsutilSampler|ProcSampler = create_sampler(*self.options)
+        self.name: str = self.sampler.name
+        self.plan = ShardPlan(workers, shard_size)
+        self.workers: List[ShardWorker] = []
+        # The processes of the first shard, which is sampled by the monitor itself.
+        self.local: Dict[int, psutil.Process] = {}
+        # The PIDs whose processes have been tracked since the previous tick, which their shards have to track anew.
+        self.pending: Set[int] = set()
+        # The states of the PIDs that have been released by their previous shard on the previous tick.
+        self.handed_over: Dict[int, Tuple] = {}
+
+    def track(self, process: psutil.Process) -> None:
+        self.pending.add(process.pid)
+
+    def forget(self, pid: int) -> None:
+        self.pending.discard(pid)
+        self.handed_over.pop(pid, None)
+        self.local.pop(pid, None)
+        self.sampler.forget(pid)
+
+    def wait(self, timeout: float) -> bool:
+        '''
+        Waits up to "timeout" seconds for the workers that have been started to be ready and returns whether they are.
+        '''
+
+        return all([worker.poll(timeout) for worker in self.workers])
+
+    def _scale(self, pids: int) -> int:
+        '''
+        Starts or stops workers for the number of shards this many PIDs need and returns how many of them are ready,
+        in the order of their shards.
+        '''
+
+        needed: int = self.plan.count(pids) - 1
+        while len(self.workers) > needed:
+            self.workers.pop().close()
+        # The shards after the one of a failed worker are dropped until its replacement is ready,
+        # so their workers are replaced too instead of keeping the PIDs that have moved on.
+        failed: List[int] = [index for index, worker in enumerate(self.workers) if worker.failed]
+        if failed:
+            for worker in self.workers[failed[0]:]:
+                worker.close()
+            del self.workers[failed[0]:]
+        while len(self.workers) < needed:
+            self.workers.append(ShardWorker(self.options))
+        ready: int = 0
+        while ready < len(self.workers) and self.workers[ready].poll():
+            ready += 1
+        return ready
+
+    def sample_all(self, processes: Dict[int, psutil.Process]) -> Tuple[List[Dict[str, str|float|int]], List[int]]:
+        '''
+        Hands every worker its changes and lets it sample its shard while the first shard is sampled here,
+        then returns the merged samples and the PIDs that have exited.
+        '''
+
+        moves = self.plan.update(list(processes), limit=1 + self._scale(len(processes)))
+        count: int = len(self.plan.shards)
+        tracked: List[Dict[int, Tuple|None]] = [{} for _ in range(count)]
+        forgotten: List[List[int]] = [[] for _ in range(count)]
+        released: List[List[int]] = [[] for _ in range(count)]
+        for pid, previous, shard in moves:
+            # A PID whose state was handed over on the previous tick isn't in any shard, like a new one.
+            held: bool = previous is not None and previous < count and pid not in self.handed_over
+            if held and pid not in self.pending:
+                released[previous].append(pid)
+                continue
+            if held:
+                forgotten[previous].append(pid)
+            tracked[shard][pid] = None
+        for pid, state in self.handed_over.items():
+            if pid in processes:
+                tracked[self.plan.assignment[pid]][pid] = state
+        self.handed_over.clear()
+        # A process that has been tracked anew, e.g. under a reused PID, starts over.
+        for pid in self.pending:
+            if pid in processes:
+                tracked[self.plan.assignment[pid]][pid] = None
+        self.pending.clear()
+
+        for index, worker in enumerate(self.workers[:count - 1], 1):
+            try:
+                worker.send([(pid, processes[pid].create_time(), state) for pid, state in tracked[index].items()],
+                            forgotten[index], released[index])
+            except OSError:
+                worker.failed = True
+        results: List[Tuple[List[Dict[str, str|float|int]], List[int], Dict[int, Tuple]]] = \
+            [run_shard(self.sampler, self.local, [(processes[pid], state) for pid, state in tracked[0].items()], forgotten[0], released[0])]
+        for index, worker in enumerate(self.workers[:count - 1], 1):
+            try:
+                if not worker.failed:
+                    results.append(worker.receive())
+                    continue
+            except (EOFError, OSError):
+                worker.failed = True
+            self.pending.update(self.plan.shards[index])
+            self.pending.update(released[index])
+
+        for _, _, states in results:
+            self.handed_over.update(states)
+        # A released PID whose state didn't come back is tracked anew.
+        for pid in [pid for shard in released for pid in shard]:
+            if pid not in self.handed_over:
+                self.pending.add(pid)
+        return merge(processes, [(samples, gone) for samples, gone, _ in results])
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.close()
+        self.workers.clear()
+        self.sampler.close()
+
+
+
+def create_shards(mode: str, kind: str, cpu_count: int, uss: bool = False, metric_sets: List[str]|None = None,
+                  workers: int = 1, shard_size: int = SHARD_SIZE) -> ThreadShards|ProcessShards:
+    '''
+    Creates the sharded sampler of the "worker_mode" argument, which samples with "kind" samplers on up to "workers" threads or processes,
+    counting the monitor itself.
+    '''
+
+    if mode not in WORKER_MODES:
+        raise ValueError(f'Unknown worker mode: "{mode}". Please use one of: {", ".join(WORKER_MODES)}.')
+    if mode == "thread":
+        return ThreadShards(create_sampler(kind, cpu_count, uss, metric_sets), workers, shard_size)
+    return ProcessShards(kind, cpu_count, uss, metric_sets, workers, shard_size)
@@ -0,0 +1,171 @@
+import unittest, sys, subprocess, time
+from process_tree import ProcessSet
+from samplers import create_sampler
+from shards import ShardPlan, ProcessShards, create_shards, WORKER_MODES
+
+class TestShardPlan(unittest.TestCase):
+    def sizes(self, plan: ShardPlan) -> list:
+        return sorted(len(shard) for shard in plan.shards)
+
+
+
+    def test_shards_are_capped_by_workers_and_shard_size(self):
+        plan = ShardPlan(4, shard_size=10)
+        plan.update(list(range(25)))
+        self.assertEqual(self.sizes(plan), [12, 13])
+        plan.update(list(range(1000)))
+        self.assertEqual(self.sizes(plan), [250, 250, 250, 250])
+        plan.update(list(range(5)))
+        self.assertEqual(self.sizes(plan), [5])
+        self.assertEqual(set(plan.assignment), set(range(5)))
+
+
+
+    def test_new_pids_go_to_the_smallest_shard(self):
+        plan = ShardPlan(2, shard_size=10)
+        plan.update(list(range(40)))
+        plan.shards[0].discard(0)
+        del plan.assignment[0]
+        moves = plan.update(list(range(1, 40)) + [100, 101, 102])
+        self.assertEqual(moves, [(100, None, 0), (101, None, 0), (102, None, 1)])
+        self.assertEqual(self.sizes(plan), [21, 21])
+
+
+
+    def test_exits_rebalance_the_shards(self):
+        plan = ShardPlan(2, shard_size=10)
+        plan.update(list(range(100)))
+        moves = plan.update(sorted(plan.shards[0]) + sorted(plan.shards[1])[:10])
+        # The shards get within the slack of a quarter of their mean size instead of getting exactly even.
+        self.assertEqual(self.sizes(plan), [27, 33])
+        self.assertEqual({(previous, shard) for _, previous, shard in moves}, {(0, 1)})
+        self.assertEqual(plan.update(list(plan.assignment)), [])
+
+
+
+    def test_limit(self):
+        plan = ShardPlan(4, shard_size=10)
+        plan.update(list(range(100)), limit=1)
+        self.assertEqual(self.sizes(plan), [100])
+        moves = plan.update(list(range(100)), limit=3)
+        self.assertEqual(self.sizes(plan), [31, 31, 38])
+        self.assertEqual({previous for _, previous, _ in moves}, {0})
+
+
+
+    def test_dropped_shards_move_their_pids(self):
+        plan = ShardPlan(4, shard_size=10)
+        plan.update(list(range(100)))
+        dropped = set(plan.shards[3])
+        moves = plan.update(list(range(100)), limit=2)
+        self.assertEqual(self.sizes(plan), [50, 50])
+        self.assertTrue(dropped <= {pid for pid, previous, _ in moves if previous == 3})
+
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        # Idle children and one that keeps a CPU busy until they get killed.
+        self.children = [subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"]) for _ in range(5)]
+        self.children.append(subprocess.Popen([sys.executable, "-c", "while True: pass"]))
+        self.pids = [child.pid for child in self.children]
+
+    def tearDown(self):
+        for child in self.children:
+            child.kill()
+            child.wait()
+
+
+
+    def check(self, sampler) -> None:
+        processes = ProcessSet(self.pids, sampler=sampler)
+        processes.sample()
+        if isinstance(sampler, ProcessShards):
+            self.assertTrue(sampler.wait(30))
+        # The samples are merged in the order of the processes, like a serial tick returns them.
+        order = list(processes.processes)
+        time.sleep(0.2)
+        samples = processes.sample()
+        self.assertEqual(len(sampler.plan.shards), 3)
+        self.assertEqual([sample["pid"] for sample in samples], order)
+        self.assertTrue(all(sample["working_set"] > 0 for sample in samples))
+        self.assertGreater(samples[order.index(self.pids[-1])]["CPU"], 0.0)
+
+        self.children[0].kill()
+        self.children[0].wait()
+        order.remove(self.pids[0])
+        self.assertEqual([sample["pid"] for sample in processes.sample()], order)
+        self.assertNotIn(self.pids[0], processes.processes)
+        # Five PIDs only make two shards of at least two PIDs.
+        processes.sample()
+        self.assertEqual(sorted(len(shard) for shard in sampler.plan.shards), [2, 3])
+        if isinstance(sampler, ProcessShards):
+            self.assertEqual(len(sampler.workers), 1)
+        processes.close()
+
+
+
+    def test_thread_shards(self):
+        self.check(create_shards("thread", "psutil", 1, workers=3, shard_size=2))
+
+
+
+    def test_process_shards(self):
+        self.check(create_shards("process", "psutil", 1, workers=3, shard_size=2))
+
+
+
+    def test_dead_worker_is_replaced(self):
+        sampler = create_shards("process", "psutil", 1, workers=3, shard_size=2)
+        processes = ProcessSet(self.pids, sampler=sampler)
+        processes.sample()
+        self.assertTrue(sampler.wait(30))
+        processes.sample()
+        order = list(processes.processes)
+        sampler.workers[0].process.kill()
+        sampler.workers[0].process.join()
+        # The PIDs of the dead worker miss a tick, then the others sample them while it gets replaced.
+        self.assertEqual(len(processes.sample()), 6 - len(sampler.plan.shards[1]))
+        self.assertEqual([sample["pid"] for sample in processes.sample()], order)
+        self.assertTrue(sampler.wait(30))
+        processes.sample()
+        self.assertEqual([sample["pid"] for sample in processes.sample()], order)
+        self.assertEqual(len(sampler.plan.shards), 3)
+        processes.close()
+        self.assertEqual(sampler.workers, [])
+
+
+
+    def test_moved_pids_keep_their_cpu_times(self):
+        sampler = create_shards("process", "psutil", 1, workers=3, shard_size=2)
+        processes = ProcessSet(self.pids, sampler=sampler)
+        processes.sample()
+        self.assertTrue(sampler.wait(30))
+        # The workers get their shards on this tick: the PIDs that move are sampled one last time by the first shard,
+        # which hands their state over, so the next tick of their new shard doesn't start over from a CPU usage of 0.
+        time.sleep(0.2)
+        processes.sample()
+        self.assertEqual(set(sampler.handed_over), set(self.pids) - sampler.plan.shards[0])
+        for _ in range(2):
+            time.sleep(0.2)
+            samples = {sample["pid"]: sample for sample in processes.sample()}
+            self.assertEqual(set(samples), set(self.pids))
+            self.assertGreater(samples[self.pids[-1]]["CPU"], 0.0)
+            self.assertLessEqual(samples[self.pids[-1]]["CPU"], 100.0)
+        self.assertEqual(sampler.handed_over, {})
+        processes.close()
+
+
+
+    def test_create_shards(self):
+        self.assertEqual(WORKER_MODES, ["thread", "process"])
+        with self.assertRaises(ValueError):
+            create_shards("fiber", "psutil", 1)
+        shards = create_shards("thread", "psutil", 1, workers=2)
+        self.assertEqual(shards.name, create_sampler("psutil", 1).name)
+        shards.close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
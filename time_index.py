@@ -0,0 +1,428 @@
+import argparse, bisect, csv, datetime, json, math, mmap, os, struct, sys
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+from formatting import parse_elapsed_time
+
+# A .idx file starts with the magic bytes and the version of the format, which are followed by fixed-width entries
+# of the wall clock time of a row, the byte offset at which the row starts and its number, counted from 0 after the header.
+MAGIC: bytes = b"PMTI"
+VERSION: int = 1
+PREFIX = struct.Struct("<4sH")
+ENTRY = struct.Struct("<dQQ")
+
+# By default a row is indexed every this many rows or seconds, whichever comes first.
+INDEX_ROWS: int = 1000
+INDEX_INTERVAL: float = 60.0
+
+# The formats that --from and --to accept, besides the "date time" format of data.csv .
+TIME_FORMATS: List[str] = ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d",
+                           "%d-%m-%Y %H:%M:%S.%f", "%d-%m-%Y %H:%M:%S", "%d-%m-%Y %H:%M", "%d-%m-%Y"]
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def index_path(path: str) -> str:
+    return path + ".idx"
+
+
+
+def row_time(date: str, time: str) -> float:
+    '''
+    Converts the "date" and "time" columns of data.csv to seconds since 01-01-1970, taking the local wall clock time
+    as it is written. The times are not always ordered like the rows: they go back by an hour when daylight saving time ends,
+    so the rows of e.g. 02:00 to 03:00 are there twice, and the index and the queries don't count on them only going forward.
+    '''
+
+    day, month, year = date.split("-")
+    hours, minutes, seconds = time.split(":")
+    days: int = (datetime.date(int(year), int(month), int(day)) - EPOCH.date()).days
+    return days * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+
+def parse_time(value: str) -> float:
+    '''
+    Parses the value of --from or --to to seconds like row_time().
+    '''
+
+    for time_format in TIME_FORMATS:
+        try:
+            return (datetime.datetime.strptime(value.strip(), time_format) - EPOCH).total_seconds()
+        except ValueError:
+            continue
+    raise ValueError(f'Invalid time: "{value}". Please use e.g. "2024-05-01 03:10" or "01-05-2024 03:10:00".')
+
+
+
+def _sort_key(date: str, time: str) -> str:
+    '''
+    Rearranges the date and time columns into a string that sorts like the time, which is cheaper than converting them.
+    '''
+    return date[6:] + date[3:5] + date[:2] + time
+
+
+
+def _key_of(seconds: float) -> str:
+    return (EPOCH + datetime.timedelta(seconds=seconds)).strftime("%Y%m%d%H:%M:%S.%f")[:-3]
+
+
+
+class TimeIndexWriter:
+    '''
+    Appends an entry to the .idx file next to a .csv file every "index_rows" rows or every "index_interval" seconds.
+    The writer of the .csv file passes the rows that are due together with their byte offsets, and flushes the index
+    only after the rows themselves, so an entry never points past the data that has reached the file.
+    '''
+
+    def __init__(self, path: str, index_rows: int = INDEX_ROWS, index_interval: float = INDEX_INTERVAL, append: bool = False) -> None:
+        if index_rows < 1:
+            raise ValueError(f"Index rows has a value of {index_rows}. Please use a value of at least 1.")
+        self.path: str = path
+        self.index_rows: int = index_rows
+        self.index_interval: float = index_interval
+        self.rows_since: int = index_rows
+        self.last_time: float|None = None
+        self.entries: int = 0
+        append = append and os.path.exists(path) and os.path.getsize(path) >= PREFIX.size
+        self.file = open(path, "ab" if append else "wb")
+        if not append:
+            self.file.write(PREFIX.pack(MAGIC, VERSION))
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def due(self, now: float) -> bool:
+        '''
+        Tells whether the next row gets indexed, given the monotonic time of the writer or the time of the row.
+        A time that goes back, like the wall clock time of a row when daylight saving time ends, gets the row indexed.
+        '''
+
+        self.rows_since += 1
+        if self.rows_since >= self.index_rows or self.last_time is None or not 0 <= now - self.last_time < self.index_interval:
+            self.rows_since = 0
+            self.last_time = now
+            return True
+        return False
+
+    def add(self, row: Dict[str, str|float|int], offset: int, number: int) -> None:
+        try:
+            seconds: float = row_time(str(row["date"]), str(row["time"]))
+        except (KeyError, ValueError):
+            return
+        self.file.write(ENTRY.pack(seconds, offset, number))
+        self.entries += 1
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+
+
+class TimeIndex:
+    '''
+    Memory-maps a .idx file and finds the entry of a time by binary search, which reads a few pages
+    of the index however large the .csv file is. A partially written last entry is ignored.
+    The entries are written at least every index_interval seconds, which is much shorter than a daylight saving time change,
+    so the wall clock going back shows as an entry that is earlier than the one before it. Opening the index looks these
+    steps back up, which reads every entry, but there is only one every 1,000 rows or 60 seconds by default.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.map: mmap.mmap|None = None
+        self.length: int = 0
+        with open(path, "rb") as file:
+            size: int = os.fstat(file.fileno()).st_size
+            if size < PREFIX.size:
+                raise ValueError(f'"{path}" is not a time index file.')
+            if size > PREFIX.size:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, version = PREFIX.unpack_from(self.map, 0)
+            else:
+                magic, version = PREFIX.unpack(file.read(PREFIX.size))
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'"{path}" is not a time index file of version {VERSION}.')
+        if self.map is not None:
+            self.length = (len(self.map) - PREFIX.size) // ENTRY.size
+        # The positions of the entries that are earlier than the entry before them.
+        self.steps_back: List[int] = []
+        previous: float = -math.inf
+        for position, (seconds, _, _) in enumerate(ENTRY.iter_unpack(self.map[PREFIX.size:PREFIX.size + self.length * ENTRY.size]) if self.length else []):
+            if seconds < previous:
+                self.steps_back.append(position)
+            previous = seconds
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> Tuple[float, int, int]:
+        if not 0 <= index < self.length:
+            raise IndexError("time index out of range")
+        return ENTRY.unpack_from(self.map, PREFIX.size + index * ENTRY.size)
+
+    def seek(self, seconds: float) -> Tuple[float, int, int]|None:
+        '''
+        Returns the last entry at or before the time, from which the rows of the time can be read, or None if there is none.
+        Once the times have gone back, a row of the time may come after any later entry, so only the entries
+        before the first step back are searched.
+        '''
+
+        end: int = self.steps_back[0] if self.steps_back else self.length
+        position: int = bisect.bisect_right(self, seconds, hi=end, key=lambda entry: entry[0])
+        return self[position - 1] if position else None
+
+    def forward_offset(self) -> int:
+        '''
+        Returns the byte offset of the entry of the last step back, from which on the times of the rows only go forward.
+        '''
+
+        return self[self.steps_back[-1]][1] if self.steps_back else 0
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __enter__(self) -> "TimeIndex":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+
+def _columns(header: bytes) -> Tuple[List[str], int, int]:
+    titles: List[str] = next(csv.reader([header.decode("utf-8")]))
+    if "date" not in titles or "time" not in titles:
+        raise ValueError("The file has no date and time columns.")
+    return titles, titles.index("date"), titles.index("time")
+
+
+
+def _date_time(line: bytes, date_column: int, time_column: int) -> Tuple[str, str]:
+    # The elapsed time is quoted from 1,000 days on, since it contains a comma then.
+    fields: List[str] = next(csv.reader([line.decode("utf-8")])) if line.startswith(b'"') else line.decode("utf-8").split(",")
+    return fields[date_column], fields[time_column].rstrip()
+
+
+
+def build_index(path: str, index_rows: int = INDEX_ROWS, index_interval: float = INDEX_INTERVAL) -> int:
+    '''
+    Rebuilds the .idx file of an existing .csv file, indexing a row every "index_rows" rows or every "index_interval" seconds
+    of the times in the file. Returns the number of entries.
+    '''
+
+    with open(path, "rb") as file:
+        _, date_column, time_column = _columns(file.readline())
+        writer = TimeIndexWriter(index_path(path) + ".tmp", index_rows, index_interval)
+        offset: int = file.tell()
+        number: int = 0
+        for line in file:
+            if line.strip():
+                try:
+                    date, time = _date_time(line, date_column, time_column)
+                    if writer.due(row_time(date, time)):
+                        writer.add({"date": date, "time": time}, offset, number)
+                except (IndexError, ValueError):
+                    # A partially written last row.
+                    pass
+                number += 1
+            offset += len(line)
+        writer.close()
+    os.replace(index_path(path) + ".tmp", index_path(path))
+    return writer.entries
+
+
+
+def _seek(path: str, seconds: float|None) -> Tuple[int|None, int|None]:
+    '''
+    Returns the byte offset of the indexed row right before the time, or None if the rows have to be read from the top,
+    and the byte offset from which on the times of the rows only go forward, or None if that isn't known.
+    The index is rebuilt if it is missing or belongs to an earlier version of the file, which a mismatching row gives away.
+    '''
+
+    with open(path, "rb") as file:
+        _, date_column, time_column = _columns(file.readline())
+        for attempt in range(2):
+            if attempt or not os.path.exists(index_path(path)):
+                build_index(path)
+            try:
+                with TimeIndex(index_path(path)) as index:
+                    entry: Tuple[float, int, int]|None = index.seek(seconds) if seconds is not None else (index[len(index) - 1] if len(index) else None)
+                    forward_offset: int = index.forward_offset()
+            except ValueError:
+                continue
+            if entry is None:
+                return None, forward_offset
+            file.seek(entry[1])
+            try:
+                if row_time(*_date_time(file.readline(), date_column, time_column)) == entry[0]:
+                    return entry[1] if seconds is not None else None, forward_offset
+            except (IndexError, ValueError):
+                pass
+    return None, None
+
+
+
+def _open_rows(path: str) -> BinaryIO:
+    if path.endswith(".gz"):
+        import gzip
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        import io, zstandard
+        # The stream reader of zstandard can't read lines by itself.
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    return open(path, "rb")
+
+
+
+def query_rows(path: str, start: float|None = None, end: float|None = None) -> Iterator[bytes]:
+    '''
+    Yields the header and then the lines of the rows from "start" up to and including "end", as seconds like row_time().
+    A plain .csv file is read from the indexed row right before "start" on and up to the first row after "end"
+    once the index shows that the times don't go back anymore, so only the rows of the range are read.
+    A compressed segment can't be seeked in and has no index, so it is read from its beginning to its end.
+    '''
+
+    start_key: str = _key_of(start) if start is not None else ""
+    end_key: str|None = _key_of(end) if end is not None else None
+    offset: int|None = None
+    forward_offset: int|None = None
+    if (start is not None or end is not None) and not path.endswith((".gz", ".zst")):
+        offset, forward_offset = _seek(path, start)
+    with _open_rows(path) as file:
+        header: bytes = file.readline()
+        _, date_column, time_column = _columns(header)
+        yield header
+        position: int = len(header)
+        if offset is not None:
+            file.seek(offset)
+            position = offset
+        for line in file:
+            line_offset: int = position
+            position += len(line)
+            if not line.strip():
+                continue
+            try:
+                key: str = _sort_key(*_date_time(line, date_column, time_column))
+            except IndexError:
+                continue
+            if key < start_key:
+                continue
+            if end_key is not None and key > end_key:
+                if forward_offset is not None and line_offset >= forward_offset:
+                    return
+                continue
+            yield line
+
+
+
+def _manifest_ranges(paths: List[str]) -> Dict[str, Tuple[float, float]]:
+    '''
+    Returns the time ranges of the rotated segments listed in the manifest.json next to them, by their paths.
+    '''
+
+    ranges: Dict[str, Tuple[float, float]] = {}
+    for directory in {os.path.dirname(os.path.abspath(path)) for path in paths}:
+        try:
+            with open(os.path.join(directory, "manifest.json")) as jsonfile:
+                segments: List[Dict[str, object]] = json.load(jsonfile)["segments"]
+        except (OSError, ValueError, KeyError):
+            continue
+        for segment in segments:
+            try:
+                first: float = row_time(*segment["first"].split(" "))
+                last: float = row_time(*segment["last"].split(" "))
+            except (KeyError, ValueError, TypeError):
+                continue
+            try:
+                elapsed: float = parse_elapsed_time(segment["last_elapsed_time"]) - parse_elapsed_time(segment["first_elapsed_time"])
+            except (KeyError, ValueError, AttributeError):
+                elapsed = last - first
+            # The wall clock has gone back within a segment whose times span less than its elapsed time,
+            # so its rows may be from up to the elapsed time before its last row or after its first row.
+            if last - first < elapsed - 1:
+                first, last = min(first, last - elapsed), max(last, first + elapsed)
+            ranges[os.path.join(directory, segment["file"])] = (first, last)
+    return ranges
+
+
+
+def query(paths: List[str], start: float|None, end: float|None, output: BinaryIO) -> int:
+    '''
+    Writes the header and the rows between "start" and "end" of the given files, in order, to "output"
+    and returns the number of rows. Rotated segments whose time range in manifest.json doesn't overlap are not even opened.
+    '''
+
+    ranges: Dict[str, Tuple[float, float]] = _manifest_ranges(paths)
+    rows: int = 0
+    header_written: bool = False
+    for path in paths:
+        segment: Tuple[float, float]|None = ranges.get(os.path.abspath(path))
+        if segment is not None and ((start is not None and segment[1] < start) or (end is not None and segment[0] > end)):
+            continue
+        lines: Iterator[bytes] = query_rows(path, start, end)
+        header: bytes = next(lines)
+        if not header_written:
+            output.write(header)
+            header_written = True
+        for line in lines:
+            output.write(line)
+            rows += 1
+    return rows
+
+
+
+def query_command(argv: List[str]) -> None:
+    '''
+    Implements the "query" subcommand.
+    '''
+
+    parser = argparse.ArgumentParser(prog="process_monitor_tool.py query",
+                                     description="Print the rows of data.csv, processes.csv or rotated data.csv segments between two times")
+    parser.add_argument("files", type=str, nargs="+", help=".csv files or rotated segments of the same run, in order")
+    parser.add_argument("--from", dest="start", type=str, metavar=" ", help='first time, e.g. "2024-05-01 03:10" (default: the first row)')
+    parser.add_argument("--to", dest="end", type=str, metavar=" ", help='last time, e.g. "2024-05-01 03:20" (default: the last row)')
+    parser.add_argument("-o", "--output", type=str, metavar=" ", help="write the rows to this .csv file instead of the console")
+    args = parser.parse_args(argv)
+    for path in args.files:
+        if not os.path.exists(path):
+            parser.error(f'"{path}" file path does not exist. Please use an appropriate path.')
+    try:
+        start: float|None = parse_time(args.start) if args.start else None
+        end: float|None = parse_time(args.end) if args.end else None
+    except ValueError as e:
+        parser.error(str(e))
+    if args.output:
+        with open(args.output, "wb") as output:
+            rows: int = query(args.files, start, end, output)
+        print(f"\n{rows} row(s) were written to: \n{args.output}\n")
+    else:
+        query(args.files, start, end, sys.stdout.buffer)
+        sys.stdout.flush()
+
+
+
+def index_command(argv: List[str]) -> None:
+    '''
+    Implements the "index" subcommand, which rebuilds the time index of existing .csv files.
+    '''
+
+    parser = argparse.ArgumentParser(prog="process_monitor_tool.py index",
+                                     description="Rebuild the time index (.csv.idx) of data.csv or processes.csv, e.g. of a run without an index")
+    parser.add_argument("files", type=str, nargs="+", help="uncompressed .csv files")
+    parser.add_argument("--index_rows", type=int, default=INDEX_ROWS, metavar=" ", help=f"index a row every this many rows (default: {INDEX_ROWS})")
+    parser.add_argument("--index_interval", type=float, default=INDEX_INTERVAL, metavar=" ",
+                        help=f"index a row every this many seconds (default: {INDEX_INTERVAL:g})")
+    args = parser.parse_args(argv)
+    for path in args.files:
+        if not os.path.exists(path):
+            parser.error(f'"{path}" file path does not exist. Please use an appropriate path.')
+        if path.endswith((".gz", ".zst")):
+            parser.error(f'"{path}" is compressed, which can\'t be seeked in. Please index uncompressed .csv files.')
+    for path in args.files:
+        entries: int = build_index(path, args.index_rows, args.index_interval)
+        print(f"\n{entries} entries were written to: \n{index_path(path)}\n")
@@ -0,0 +1,166 @@
+import unittest, datetime, gzip, io, json, os, shutil, tempfile
+from csv_writer import BufferedCSVWriter
+from formatting import calculate_elapsed_time, format_timestamp
+from time_index import TimeIndex, build_index, index_path, parse_time, query, query_rows, row_time
+
+START = datetime.datetime(2024, 5, 1, 23, 50, 0)
+TITLES = ["elapsed_time", "date", "time", "CPU", "handles"]
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def write_rows(path: str, rows: int, first: int = 0, **options) -> None:
+    '''
+    Writes a row every second from START + first seconds on, with the second as the handles.
+    '''
+
+    clock = FakeClock()
+    writer = BufferedCSVWriter(path, TITLES, flush_rows=7, flush_interval=1e9, clock=clock, **options)
+    for second in range(first, first + rows):
+        clock.now = float(second)
+        writer.write({"elapsed_time": calculate_elapsed_time(second), **format_timestamp(START + datetime.timedelta(seconds=second)),
+                      "CPU": 1.5, "handles": second})
+    writer.close()
+
+def handles(data: bytes) -> list:
+    return [int(line.split(b",")[-1]) for line in data.splitlines()[1:]]
+
+class TestTimeIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "data.csv")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time("2024-05-01 23:50"), row_time("01-05-2024", "23:50:00.000"))
+        self.assertEqual(parse_time("01-05-2024 23:50:01.5"), row_time("01-05-2024", "23:50:01.500"))
+        self.assertRaises(ValueError, parse_time, "yesterday")
+
+
+
+    def test_writer_keeps_sparse_index(self):
+        write_rows(self.path, 1000, index=True, index_rows=100, index_interval=1e9)
+        with TimeIndex(index_path(self.path)) as index:
+            self.assertEqual(len(index), 10)
+            with open(self.path, "rb") as file:
+                for seconds, offset, number in index:
+                    file.seek(offset)
+                    # Every entry points at the start of the row it was made for, also within a flushed batch.
+                    self.assertEqual(int(file.readline().split(b",")[-1]), number)
+                    self.assertEqual(seconds, row_time("01-05-2024", "23:50:00.000") + number)
+        # The interval indexes a row at least every 60 seconds when there are fewer rows.
+        write_rows(self.path, 1000, index=True, index_rows=1000, index_interval=60)
+        with TimeIndex(index_path(self.path)) as index:
+            self.assertEqual(len(index), 17)
+
+
+
+    def test_query_range(self):
+        write_rows(self.path, 3600, index=True, index_rows=50)
+        output = io.BytesIO()
+        # The range crosses midnight, so the date column changes within it.
+        rows = query([self.path], parse_time("2024-05-01 23:59:30"), parse_time("2024-05-02 00:00:30"), output)
+        self.assertEqual(rows, 61)
+        self.assertEqual(handles(output.getvalue()), list(range(570, 631)))
+        self.assertTrue(output.getvalue().startswith(b"elapsed_time,date,time"))
+        self.assertEqual(handles(b"".join(query_rows(self.path, None, parse_time("2024-05-01 23:50:02")))), [0, 1, 2])
+        self.assertEqual(handles(b"".join(query_rows(self.path, parse_time("2024-05-03"), None))), [])
+
+
+
+    def test_rebuild(self):
+        write_rows(self.path, 500, index=True, index_rows=20, index_interval=1e9)
+        with open(index_path(self.path), "rb") as file:
+            written = file.read()
+        os.remove(index_path(self.path))
+        self.assertEqual(build_index(self.path, index_rows=20, index_interval=1e9), 25)
+        with open(index_path(self.path), "rb") as file:
+            self.assertEqual(file.read(), written)
+        # A missing index gets rebuilt by the query.
+        os.remove(index_path(self.path))
+        self.assertEqual(handles(b"".join(query_rows(self.path, parse_time("2024-05-01 23:55"), parse_time("2024-05-01 23:55:01")))), [300, 301])
+        self.assertTrue(os.path.exists(index_path(self.path)))
+
+
+
+    def test_stale_index(self):
+        write_rows(self.path, 500, index=True, index_rows=20)
+        # A file written without an index replaces the indexed one, so the old entries point at other rows.
+        write_rows(self.path, 500, first=1000, index=False)
+        self.assertEqual(handles(b"".join(query_rows(self.path, parse_time("2024-05-02 00:10"), parse_time("2024-05-02 00:10:02")))),
+                         [1200, 1201, 1202])
+
+
+
+    def test_rotated_segments(self):
+        segments = [os.path.join(self.directory, name) for name in ("data.00001.csv.gz", "data.00002.csv", "data.csv")]
+        write_rows(segments[1], 100, first=100, index=True, index_rows=10)
+        write_rows(segments[2], 100, first=200, index=True, index_rows=10)
+        write_rows(self.path + ".tmp", 100, first=0)
+        with open(self.path + ".tmp", "rb") as source, gzip.open(segments[0], "wb") as destination:
+            destination.write(source.read())
+        os.remove(self.path + ".tmp")
+        first = lambda second: " ".join(format_timestamp(START + datetime.timedelta(seconds=second)).values())
+        with open(os.path.join(self.directory, "manifest.json"), "w") as jsonfile:
+            json.dump({"active": "data.csv", "segments": [{"file": "data.00001.csv.gz", "first": first(0), "last": first(99)},
+                                                          {"file": "data.00002.csv", "first": first(100), "last": first(199)}]}, jsonfile)
+        output = io.BytesIO()
+        self.assertEqual(query(segments, parse_time("2024-05-01 23:51:35"), parse_time("2024-05-01 23:53:25"), output), 111)
+        self.assertEqual(handles(output.getvalue()), list(range(95, 206)))
+        # The compressed segment is not opened when its time range is outside of the query.
+        with open(segments[0], "wb") as file:
+            file.write(b"not gzip")
+        output = io.BytesIO()
+        self.assertEqual(query(segments, parse_time("2024-05-01 23:52:00"), None, output), 180)
+
+
+
+    def test_daylight_saving_time_end(self):
+        # A row every 30 seconds from 01:30 on, while the clock goes back from 03:00 to 02:00 at row 180.
+        times = [datetime.datetime(2024, 10, 27, 1, 30) + datetime.timedelta(seconds=30 * row) for row in range(360)]
+        times = times[:180] + [time - datetime.timedelta(hours=1) for time in times[180:]]
+        def write(path, rows, **options):
+            clock = FakeClock()
+            writer = BufferedCSVWriter(path, TITLES, flush_rows=7, flush_interval=1e9, clock=clock, **options)
+            for row in rows:
+                clock.now = 30.0 * row
+                writer.write({"elapsed_time": calculate_elapsed_time(30.0 * row), **format_timestamp(times[row]), "CPU": 1.5, "handles": row})
+            writer.close()
+        write(self.path, range(360), index=True, index_rows=10, index_interval=1e9)
+        both = lambda: (handles(b"".join(query_rows(self.path, parse_time("2024-10-27 02:10"), parse_time("2024-10-27 02:20")))),
+                        handles(b"".join(query_rows(self.path, parse_time("2024-10-27 02:50"), parse_time("2024-10-27 03:05")))))
+        expected = (list(range(80, 101)) + list(range(200, 221)), list(range(160, 180)) + list(range(280, 311)))
+        self.assertEqual(both(), expected)
+        self.assertEqual(handles(b"".join(query_rows(self.path, None, parse_time("2024-10-27 01:31")))), [0, 1, 2])
+        # The rebuilt index gets an entry at the row where the clock goes back.
+        os.remove(index_path(self.path))
+        self.assertEqual(both(), expected)
+        with TimeIndex(index_path(self.path)) as index:
+            self.assertEqual([index[position][2] for position in index.steps_back], [180])
+
+        # A compressed segment whose last row is earlier than a queried time may still have rows of it from before the change.
+        segment = os.path.join(self.directory, "data.00001.csv.gz")
+        write(self.path + ".tmp", range(120, 231))
+        with open(self.path + ".tmp", "rb") as source, gzip.open(segment, "wb") as destination:
+            destination.write(source.read())
+        stamp = lambda row: " ".join(format_timestamp(times[row]).values())
+        with open(os.path.join(self.directory, "manifest.json"), "w") as jsonfile:
+            json.dump({"active": "data.csv", "segments": [{"file": "data.00001.csv.gz", "first": stamp(120), "last": stamp(230),
+                                                          "first_elapsed_time": calculate_elapsed_time(3600.0),
+                                                          "last_elapsed_time": calculate_elapsed_time(6900.0)}]}, jsonfile)
+        output = io.BytesIO()
+        self.assertEqual(query([segment], parse_time("2024-10-27 02:40"), parse_time("2024-10-27 02:45"), output), 11)
+        self.assertEqual(handles(output.getvalue()), list(range(140, 151)))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
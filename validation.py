@@ -0,0 +1,143 @@
+import json, os, struct
+from typing import Dict, List
+
+# Bumped whenever a check changes, so the results that an older version has cached get ignored.
+CACHE_VERSION: int = 1
+# The least recently validated paths get dropped beyond this many, so the cache stays small in scripted loops over many files.
+CACHE_ENTRIES: int = 256
+
+# The DOS header starts with "MZ" and holds the offset of the PE signature at 0x3C. The signature is followed by
+# the 20 bytes of the COFF file header, whose 16th and 17th bytes are the size of the optional header, and by the optional header,
+# whose first 2 bytes are its magic number: 0x10b for 32 bit and 0x20b for 64 bit images.
+DOS_HEADER_SIZE: int = 64
+PE_OFFSET_POSITION: int = 0x3C
+PE_SIGNATURE: bytes = b"PE\0\0"
+COFF_HEADER_SIZE: int = 20
+OPTIONAL_HEADER_MAGICS: List[int] = [0x10b, 0x20b]
+
+
+def cache_path() -> str:
+    '''
+    Returns the path of the validation cache in the cache directory of the user: %LOCALAPPDATA% on Windows,
+    $XDG_CACHE_HOME or ~/.cache elsewhere.
+    '''
+
+    if os.name == "nt":
+        base: str = os.environ.get("LOCALAPPDATA") or os.path.expanduser(os.path.join("~", "AppData", "Local"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+    return os.path.join(base, "process_monitor_tool", "validation.json")
+
+
+
+def is_pe_file(path: str) -> bool:
+    '''
+    Tells whether a file is a Portable Executable, i.e. a real .exe, by reading only the few bytes of its headers
+    instead of parsing the whole image like pefile does, which takes seconds on large executables.
+    '''
+
+    with open(path, "rb") as file:
+        dos_header: bytes = file.read(DOS_HEADER_SIZE)
+        if len(dos_header) < DOS_HEADER_SIZE or dos_header[:2] != b"MZ":
+            return False
+        pe_offset: int = struct.unpack_from("<I", dos_header, PE_OFFSET_POSITION)[0]
+        file.seek(pe_offset)
+        headers: bytes = file.read(len(PE_SIGNATURE) + COFF_HEADER_SIZE + 2)
+    if len(headers) < len(PE_SIGNATURE) + COFF_HEADER_SIZE + 2 or headers[:4] != PE_SIGNATURE:
+        return False
+    optional_header_size: int = struct.unpack_from("<H", headers, len(PE_SIGNATURE) + 16)[0]
+    magic: int = struct.unpack_from("<H", headers, len(PE_SIGNATURE) + COFF_HEADER_SIZE)[0]
+    return optional_header_size >= 2 and magic in OPTIONAL_HEADER_MAGICS
+
+
+
+def probe_writable(directory: str) -> bool:
+    '''
+    Tells whether folders can be created in a directory by creating and removing one, creating the directory itself if needed.
+    Unlike os.access() this also holds for the access control lists of Windows.
+    '''
+
+    testpath: str = os.path.join(directory, "test_directory")
+    try:
+        os.makedirs(testpath, exist_ok=True)
+    except PermissionError:
+        return False
+    if not os.path.exists(testpath):
+        return False
+    os.rmdir(testpath)
+    return True
+
+
+
+class ValidationCache:
+    '''
+    Remembers the files and directories that have passed a check, keyed by the kind of the check and their path,
+    along with their size, modification time and mode at that point. A result only counts while all of them are unchanged,
+    so an executable that has been rebuilt or a directory whose permissions have changed gets checked again.
+    Only passed checks are cached, so a file that has been fixed never keeps failing.
+    The cache is a small .json file, and failing to read or write it only means the checks run again.
+    '''
+
+    def __init__(self, path: str|None = None) -> None:
+        self.path: str = path if path is not None else cache_path()
+        self.entries: Dict[str, List[int]] = self.load()
+        self.changed: bool = False
+
+    def load(self) -> Dict[str, List[int]]:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != CACHE_VERSION or not isinstance(data.get("entries"), dict):
+            return {}
+        return data["entries"]
+
+    @staticmethod
+    def key(kind: str, path: str) -> str:
+        return kind + ":" + os.path.normcase(os.path.abspath(path))
+
+    @staticmethod
+    def stamp(path: str) -> List[int]:
+        status: os.stat_result = os.stat(path)
+        return [status.st_size, status.st_mtime_ns, status.st_mode]
+
+    def passed(self, kind: str, path: str) -> bool:
+        try:
+            return self.entries.get(self.key(kind, path)) == self.stamp(path)
+        except OSError:
+            return False
+
+    def remember(self, kind: str, path: str) -> None:
+        try:
+            stamp: List[int] = self.stamp(path)
+        except OSError:
+            return
+        key: str = self.key(kind, path)
+        # Moves the entry to the end, so the least recently validated paths get dropped first.
+        self.entries.pop(key, None)
+        self.entries[key] = stamp
+        while len(self.entries) > CACHE_ENTRIES:
+            del self.entries[next(iter(self.entries))]
+        self.changed = True
+
+    def save(self) -> None:
+        '''
+        Writes the cache if an entry has been added. It is written to a temporary file first,
+        so monitors that start at the same time never read a half written cache.
+        '''
+
+        if not self.changed:
+            return
+        temporary: str = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump({"version": CACHE_VERSION, "entries": self.entries}, file)
+            os.replace(temporary, self.path)
+        except OSError:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+        self.changed = False
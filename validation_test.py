@@ -0,0 +1,105 @@
+import unittest, json, os, shutil, struct, tempfile
+from validation import ValidationCache, is_pe_file, probe_writable, CACHE_ENTRIES, CACHE_VERSION
+
+def pe_image(magic: int = 0x20b, pe_offset: int = 0x80) -> bytes:
+    '''
+    Builds the headers of a PE image with an optional header of the given magic number, followed by some padding.
+    '''
+
+    dos_header = bytearray(pe_offset)
+    dos_header[:2] = b"MZ"
+    struct.pack_into("<I", dos_header, 0x3C, pe_offset)
+    optional_header = struct.pack("<H", magic) + bytes(238)
+    coff_header = struct.pack("<HHIIIHH", 0x8664, 0, 0, 0, 0, len(optional_header), 0x22)
+    return bytes(dos_header) + b"PE\0\0" + coff_header + optional_header + bytes(1024)
+
+class TestValidation(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.directory, "cache", "validation.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as file:
+            file.write(data)
+        return path
+
+    def test_pe_headers(self):
+        self.assertTrue(is_pe_file(self.write("64.exe", pe_image())))
+        self.assertTrue(is_pe_file(self.write("32.exe", pe_image(magic=0x10b, pe_offset=0x40))))
+
+    def test_masked_exe(self):
+        self.assertFalse(is_pe_file(self.write("empty.exe", b"")))
+        self.assertFalse(is_pe_file(self.write("text.exe", b"echo this is not an executable\n" * 10)))
+        # A DOS header that points past the end of the file, a wrong signature and an unknown optional header.
+        self.assertFalse(is_pe_file(self.write("truncated.exe", pe_image()[:0x90])))
+        self.assertFalse(is_pe_file(self.write("signature.exe", pe_image().replace(b"PE\0\0", b"NE\0\0"))))
+        self.assertFalse(is_pe_file(self.write("magic.exe", pe_image(magic=0x107))))
+
+    def test_probe_writable(self):
+        save_path = os.path.join(self.directory, "new", "save path")
+        self.assertTrue(probe_writable(save_path))
+        self.assertTrue(os.path.isdir(save_path))
+        self.assertEqual(os.listdir(save_path), [])
+
+    def test_cache_survives_restarts(self):
+        path = self.write("app.exe", pe_image())
+        cache = ValidationCache(self.cache_path)
+        self.assertFalse(cache.passed("executable", path))
+        cache.remember("executable", path)
+        cache.save()
+        restarted = ValidationCache(self.cache_path)
+        self.assertTrue(restarted.passed("executable", path))
+        # The same path for another check hasn't passed it.
+        self.assertFalse(restarted.passed("save_path", path))
+
+    def test_changed_file_is_checked_again(self):
+        path = self.write("app.exe", pe_image())
+        cache = ValidationCache(self.cache_path)
+        cache.remember("executable", path)
+        self.write("app.exe", pe_image() + b"rebuilt")
+        self.assertFalse(cache.passed("executable", path))
+        stat = os.stat(path)
+        cache.remember("executable", path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        self.assertFalse(cache.passed("executable", path))
+        os.remove(path)
+        self.assertFalse(cache.passed("executable", path))
+
+    def test_unreadable_cache_is_ignored(self):
+        path = self.write("app.exe", pe_image())
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, "w") as file:
+            file.write("{not json")
+        self.assertEqual(ValidationCache(self.cache_path).entries, {})
+        with open(self.cache_path, "w") as file:
+            json.dump({"version": CACHE_VERSION - 1, "entries": {ValidationCache.key("executable", path): ValidationCache.stamp(path)}}, file)
+        self.assertFalse(ValidationCache(self.cache_path).passed("executable", path))
+
+    def test_unwritable_cache_is_ignored(self):
+        blocker = self.write("blocker", b"")
+        cache = ValidationCache(os.path.join(blocker, "validation.json"))
+        cache.remember("executable", blocker)
+        cache.save()
+        self.assertFalse(cache.changed)
+
+    def test_oldest_entries_get_dropped(self):
+        cache = ValidationCache(self.cache_path)
+        first = self.write("first.exe", pe_image())
+        cache.remember("executable", first)
+        for number in range(CACHE_ENTRIES):
+            cache.remember("executable", self.write(f"{number}.exe", b""))
+        cache.save()
+        self.assertEqual(len(ValidationCache(self.cache_path).entries), CACHE_ENTRIES)
+        self.assertFalse(cache.passed("executable", first))
+        self.assertTrue(cache.passed("executable", os.path.join(self.directory, f"{CACHE_ENTRIES - 1}.exe")))
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()